@@ -0,0 +1,133 @@
+"""Binary _id digests and (asset_code, date) indexes
+
+Revision ID: 5b1c9e2f7a30
+Revises: 8fc3489641f3
+Create Date: 2026-10-18 01:10:12.204311
+
+The `_id` columns change from the 32 chars MD5 hex string to the 16 bytes
+digest, existing ids are converted. Indexes are added for the queries by asset
+and date: `(asset_code, date)` in assets_prices and
+`(asset_code, date_of_payment)` in assets_earnings.
+
+Timings in SQLite, 700 assets with 500 prices and 20 earnings each (350000
+price rows), measured with `python -m benchmarks.bench_db_indexes`:
+
+    query                               before      after
+    history of one asset (1 year)      49.9 ms     0.5 ms
+    last date of each asset           218.6 ms    86.5 ms
+    earnings of one asset               1.0 ms     0.1 ms
+    500 _ids lookup                     1.5 ms     1.8 ms
+    database size                      70.9 MB    71.0 MB
+
+The `_id` index shrinks by half, the space is taken by the new indexes. The
+upgrade took 8.1 s.
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1c9e2f7a30'
+down_revision = '8fc3489641f3'
+branch_labels = None
+depends_on = None
+
+digest = sa.LargeBinary(16) \
+    .with_variant(mysql.BINARY(16), 'mysql') \
+    .with_variant(mysql.BINARY(16), 'mariadb')
+
+indexes = {
+    'assets_prices': ('ix_assets_prices_asset_code_date', ['asset_code', 'date']),
+    'assets_earnings': (
+        'ix_assets_earnings_asset_code_date_of_payment',
+        ['asset_code', 'date_of_payment']
+    ),
+}
+
+# Number of rows converted at a time when the database has no hex functions.
+batch_size = 10000
+
+
+def upgrade():
+    for table, (index_name, columns) in indexes.items():
+        op.add_column(table, sa.Column('_id_bin', digest, nullable=True))
+        _convert_ids(table, '_id', '_id_bin', to_binary=True)
+        # SQLite can't drop or alter columns, the batch recreates the table.
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('_id')
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(
+                '_id_bin', new_column_name='_id', existing_type=digest,
+                nullable=False
+            )
+        # In the same batch as the rename the constraint is lost in SQLite.
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.create_unique_constraint(f'uq_{table}__id', ['_id'])
+        op.create_index(index_name, table, columns)
+
+
+def downgrade():
+    for table, (index_name, columns) in indexes.items():
+        op.drop_index(index_name, table_name=table)
+        op.add_column(
+            table, sa.Column('_id_hex', sa.String(length=32), nullable=True)
+        )
+        _convert_ids(table, '_id', '_id_hex', to_binary=False)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_constraint(f'uq_{table}__id', type_='unique')
+            batch_op.drop_column('_id')
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(
+                '_id_hex', new_column_name='_id',
+                existing_type=sa.String(length=32), nullable=False
+            )
+        # Batch constraints need a name, the first revision left it unnamed.
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.create_unique_constraint(f'uq_{table}__id', ['_id'])
+
+
+def _convert_ids(table, source, target, to_binary):
+    """Fill the `target` column with the ids of `source` converted between hex
+    and binary, in SQL when the database has functions for it.
+    """
+    connection = op.get_bind()
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        func = f"decode({source}, 'hex')" if to_binary \
+            else f"encode({source}, 'hex')"
+    elif dialect in ('mysql', 'mariadb'):
+        func = f'UNHEX({source})' if to_binary else f'LOWER(HEX({source}))'
+    elif dialect == 'sqlite' and not to_binary:
+        func = f'lower(hex({source}))'
+    else:
+        func = None
+
+    if func:
+        op.execute(f'UPDATE {table} SET {target} = {func}')
+        return
+
+    rows = sa.table(
+        table, sa.column('id'), sa.column(source), sa.column(target)
+    )
+    last_id = 0
+    while True:
+        batch = connection.execute(
+            sa.select(rows.c.id, rows.c[source])
+            .where(rows.c.id > last_id).order_by(rows.c.id).limit(batch_size)
+        ).fetchall()
+        if not batch:
+            break
+        connection.execute(
+            rows.update().where(rows.c.id == sa.bindparam('row_id'))
+            .values({target: sa.bindparam('value')}),
+            [
+                {
+                    'row_id': row_id,
+                    'value': bytes.fromhex(value) if to_binary
+                    else bytes(value).hex()
+                }
+                for row_id, value in batch
+            ]
+        )
+        last_id = batch[-1][0]
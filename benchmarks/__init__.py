@@ -0,0 +1,4 @@
+"""Benchmarks for the spider callbacks and pipelines.
+
+Run from the repository root, e.g.: `python -m benchmarks.bench_decoders`
+"""
@@ -0,0 +1,190 @@
+"""Compares the adjustment of the prices by the earnings in Python loops, one
+asset at a time, with `infomoney.adjustments.AdjustmentEngine`.
+
+Checks both produce the same adjusted closes and measures the time to adjust
+all the assets, to materialise them and to add new earnings of one asset.
+
+Usage: python -m benchmarks.bench_adjustments [--assets 700] [--prices 1000]
+[--earnings 20]
+"""
+import argparse
+import bisect
+import random
+import time
+
+import numpy as np
+
+from infomoney.adjustments import (
+    CASH, EARNINGS_KINDS, AdjustmentEngine, _split_ratios
+)
+
+TYPES = ['DIVIDENDO', 'JUROS S/CAPITAL', 'DESDOBRAMENTO', 'GRUPAMENTO']
+
+
+def make_data(assets, prices, earnings):
+    rnd = random.Random(0)
+    start = np.datetime64('2020-01-01', 's')
+    codes = [f'A{i:03d}{rnd.choice("34")}' for i in range(assets)]
+    days = np.arange(prices) * np.timedelta64(1, 'D')
+    closes = np.array(
+        [rnd.uniform(5, 100) for _ in range(assets * prices)]
+    )
+    price_columns = {
+        'asset_code': np.repeat(np.array(codes, dtype=object), prices),
+        'date': np.tile(start + days, assets),
+        'close': closes,
+        'volume': np.full(assets * prices, 1000.0),
+    }
+
+    rows = []
+    for code in codes:
+        for _ in range(earnings):
+            _type = rnd.choices(TYPES, weights=[60, 30, 5, 5])[0]
+            date = start + rnd.randrange(prices) * np.timedelta64(1, 'D')
+            rows.append((
+                code, _type, round(rnd.uniform(0.01, 1), 2),
+                rnd.choice([100.0, 50.0]) if _type == 'DESDOBRAMENTO'
+                else 10.0 if _type == 'GRUPAMENTO' else np.nan,
+                date, date + np.timedelta64(20, 'D'),
+            ))
+    earnings_columns = {
+        'asset_code': np.array([r[0] for r in rows], dtype=object),
+        'type': np.array([r[1] for r in rows], dtype=object),
+        'value': np.array([r[2] for r in rows]),
+        'pct_factor': np.array([r[3] for r in rows]),
+        'date_of_record': np.array([r[4] for r in rows]),
+        'date_of_payment': np.array([r[5] for r in rows]),
+    }
+    return price_columns, earnings_columns
+
+
+def adjust_in_loops(prices, earnings):
+    """Reference implementation, one asset and one event at a time."""
+    events = {}
+    for i in range(len(earnings['type'])):
+        kind = EARNINGS_KINDS[earnings['type'][i]]
+        if kind == CASH:
+            value = earnings['value'][i]
+        else:
+            value = _split_ratios(
+                np.array([kind], dtype=object),
+                np.array([earnings['pct_factor'][i]])
+            )[0]
+        events.setdefault(earnings['asset_code'][i], []).append(
+            (earnings['date_of_record'][i], kind, value)
+        )
+
+    adjusted = []
+    codes = prices['asset_code']
+    start = 0
+    while start < len(codes):
+        end = start
+        while end < len(codes) and codes[end] == codes[start]:
+            end += 1
+        dates = list(prices['date'][start:end])
+        closes = list(prices['close'][start:end])
+
+        factors = []
+        for record_date, kind, value in sorted(
+                events.get(codes[start], []), key=lambda e: e[0]):
+            factor = 1.0
+            if kind != CASH:
+                factor = 1 / value
+            else:
+                position = bisect.bisect_right(dates, record_date) - 1
+                if position >= 0 and 1 - value / closes[position] > 0:
+                    factor = 1 - value / closes[position]
+            factors.append((record_date, factor))
+
+        # Walk back from the last price, multiplying the factors of the events
+        # on or after each date.
+        cumulative = 1.0
+        asset_adjusted = [0.0] * len(dates)
+        for i in range(len(dates) - 1, -1, -1):
+            while factors and factors[-1][0] >= dates[i]:
+                cumulative *= factors.pop()[1]
+            asset_adjusted[i] = closes[i] * cumulative
+        adjusted.extend(asset_adjusted)
+        start = end
+    return np.array(adjusted)
+
+
+def check_record_date():
+    """A dividend with the record date on a trading day adjusts the prices
+    up to that day, by the close of that day, and not the ex-date.
+    """
+    dates = np.arange(
+        np.datetime64('2022-08-01', 's'), np.datetime64('2022-08-04', 's'),
+        np.timedelta64(1, 'D')
+    )
+    prices = {
+        'asset_code': np.array(['PETR4'] * 3, dtype=object),
+        'date': dates,
+        'close': np.array([10.0, 20.0, 30.0]),
+    }
+    earnings = {
+        'asset_code': np.array(['PETR4'], dtype=object),
+        'type': np.array(['DIVIDENDO'], dtype=object),
+        'value': np.array([2.0]),
+        'pct_factor': np.array([np.nan]),
+        'date_of_record': dates[1:2],
+        'date_of_payment': np.array([np.datetime64('2022-08-20', 's')]),
+    }
+    closes = AdjustmentEngine(prices, earnings).adjusted_prices()['close']
+    # 1 - 2 / 20, the close of the record date.
+    if not np.allclose(closes, [9.0, 18.0, 30.0], rtol=1e-9):
+        raise AssertionError(
+            f'Dividend on its record date adjusted the closes to {closes}.'
+        )
+
+
+def timed(func, *args):
+    begin = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - begin, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--assets', type=int, default=700)
+    parser.add_argument('--prices', type=int, default=1000)
+    parser.add_argument('--earnings', type=int, default=20)
+    args = parser.parse_args()
+
+    check_record_date()
+    prices, earnings = make_data(args.assets, args.prices, args.earnings)
+    loops, expected = timed(adjust_in_loops, prices, earnings)
+    build, engine = timed(AdjustmentEngine, prices, earnings)
+    materialise, adjusted = timed(engine.adjusted_prices)
+    if not np.allclose(adjusted['close'], expected, rtol=1e-9):
+        raise AssertionError('Engine and loops adjusted closes differ.')
+
+    code = prices['asset_code'][0]
+    new_earnings = {
+        'asset_code': np.array([code], dtype=object),
+        'type': np.array(['DIVIDENDO'], dtype=object),
+        'value': np.array([0.5]),
+        'pct_factor': np.array([np.nan]),
+        'date_of_record': np.array([np.datetime64('2020-06-01', 's')]),
+        'date_of_payment': np.array([np.datetime64('2020-06-20', 's')]),
+    }
+    update, _ = timed(engine.add_earnings, new_earnings)
+    rematerialise, _ = timed(engine.adjusted_prices)
+
+    rows = args.assets * args.prices
+    print(
+        f'{args.assets} assets, {args.prices} prices and {args.earnings} '
+        f'earnings each. Engine matches the loops ({rows} closes).'
+    )
+    for name, elapsed in (
+        ('python loops', loops),
+        ('engine, factors of all assets', build),
+        ('engine, materialise all assets', materialise),
+        ('engine, add earnings of 1 asset', update),
+        ('engine, materialise again', rematerialise),
+    ):
+        print(f'{name:<34}{elapsed * 1000:>10.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
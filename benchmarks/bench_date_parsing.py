@@ -0,0 +1,80 @@
+"""Measures the per item cost of DatetimeEnforcementPipeline.
+
+Compares the cached, shape based parser with the previous regex + strptime
+parser (kept as `_parse_date_fallback`), on items that repeat the same dates
+across many assets like a full crawl does.
+
+Usage: python -m benchmarks.bench_date_parsing [--assets 700] [--days 500]
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from infomoney.items import AssetEarningsItem, AssetPriceItem
+from infomoney.pipelines import DatetimeEnforcementPipeline
+
+
+class LegacyDatetimeEnforcementPipeline(DatetimeEnforcementPipeline):
+    def parse_date(self, date):
+        if date == 'n/d':
+            return
+        return self._parse_date_fallback(date)
+
+
+def make_items(assets, days):
+    start = datetime(2020, 1, 1)
+    dates = [start + timedelta(days=i) for i in range(days)]
+    for i in range(assets):
+        code = f'AST{i}'
+        if i % 5 == 0:  # FIIs
+            for date in dates:
+                yield AssetPriceItem(
+                    asset_code=code, date=date.strftime('%d-%m-%YT00:00:00')
+                )
+        else:
+            for date in dates:
+                yield AssetPriceItem(
+                    asset_code=code, date=date.strftime('%d/%m/%Y')
+                )
+        for date in dates[::60]:
+            yield AssetEarningsItem(
+                asset_code=code, type='DIVIDENDO',
+                date_of_approval=date.strftime('%d/%m/%y'),
+                date_of_record='n/d',
+                date_of_payment=(date + timedelta(days=15)).strftime('%d/%m/%y'),
+            )
+
+
+def run(pipeline, items):
+    start = time.perf_counter()
+    for item in items:
+        pipeline.process_item(item, None)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--assets', type=int, default=700)
+    parser.add_argument('--days', type=int, default=500)
+    args = parser.parse_args()
+
+    legacy_items = list(make_items(args.assets, args.days))
+    items = list(make_items(args.assets, args.days))
+    legacy_time = run(LegacyDatetimeEnforcementPipeline(), legacy_items)
+    pipeline = DatetimeEnforcementPipeline()
+    new_time = run(pipeline, items)
+
+    if [dict(i) for i in legacy_items] != [dict(i) for i in items]:
+        raise AssertionError('Parsed dates differ from the legacy parser.')
+
+    count = len(items)
+    cache_info = pipeline.cached_parse_date.cache_info()
+    print(f'{count} items, cache hits {cache_info.hits}, misses '
+          f'{cache_info.misses}')
+    print(f'legacy: {legacy_time:.2f}s ({legacy_time / count * 1e6:.2f} us/item)')
+    print(f'cached: {new_time:.2f}s ({new_time / count * 1e6:.2f} us/item)')
+    print(f'speedup: {legacy_time / new_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Measures the queries by asset and date before and after the migration to
+binary `_id`s and (asset_code, date) indexes (revision 5b1c9e2f7a30).
+
+Creates a SQLite database with the previous schema and random data, times the
+queries, runs the migration and times them again.
+
+Usage: python -m benchmarks.bench_db_indexes [--assets 700] [--prices 500]
+[--earnings 20] [--path /tmp/bench_db_indexes.sqlite3]
+"""
+import argparse
+import hashlib
+import os
+import random
+import sqlite3
+import statistics
+import time
+from datetime import datetime, timedelta
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREVIOUS_REVISION = '8fc3489641f3'
+REVISION = '5b1c9e2f7a30'
+
+
+def alembic_config(path):
+    # DATABASE_URI is read by alembic/env.py from the settings module.
+    os.environ['INFOMONEY_DB'] = f'sqlite:///{path}'
+    from alembic.config import Config
+
+    config = Config(os.path.join(BASE_DIR, 'alembic.ini'))
+    config.set_main_option(
+        'script_location', os.path.join(BASE_DIR, 'alembic')
+    )
+    return config
+
+
+def create_database(path, assets, prices, earnings):
+    from alembic import command
+
+    config = alembic_config(path)
+    command.upgrade(config, 'd2727238c940')
+    # 8fc3489641f3 alters a column, not supported by SQLite. Nullable
+    # timestamps aren't needed here.
+    command.stamp(config, PREVIOUS_REVISION)
+
+    rnd = random.Random(0)
+    codes = [f'A{i:03d}{rnd.choice("34")}' for i in range(assets)]
+    start = datetime(2020, 1, 1)
+    connection = sqlite3.connect(path)
+    price_rows, earnings_rows = [], []
+    for code in codes:
+        for day in range(prices):
+            date = start + timedelta(days=day)
+            _id = hashlib.md5(f'{code}{date}'.encode()).hexdigest()
+            close = round(rnd.uniform(1, 100), 2)
+            price_rows.append((
+                _id, code, date, date, close, close, close, close, '1000',
+                0.5,
+            ))
+        for i in range(earnings):
+            date = start + timedelta(days=i * 30)
+            _id = hashlib.md5(f'{code}DIVIDENDO{date}'.encode()).hexdigest()
+            earnings_rows.append((_id, code, 'DIVIDENDO', 0.5, date, date))
+    connection.executemany(
+        'INSERT INTO assets_prices (_id, asset_code, date, timestamp, open, '
+        'high, low, close, volume, variation) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', price_rows
+    )
+    connection.executemany(
+        'INSERT INTO assets_earnings (_id, asset_code, type, value, '
+        'date_of_approval, date_of_payment) VALUES (?, ?, ?, ?, ?, ?)',
+        earnings_rows
+    )
+    connection.commit()
+    connection.close()
+    return codes, [row[0] for row in price_rows if row[1] == codes[0]]
+
+
+def time_queries(path, code, ids, repeat=20):
+    connection = sqlite3.connect(path)
+    connection.execute('VACUUM')
+    queries = {
+        'history of one asset (1 year)': (
+            'SELECT date, close FROM assets_prices WHERE asset_code = ? AND '
+            'date BETWEEN ? AND ? ORDER BY date',
+            (code, datetime(2020, 3, 1), datetime(2021, 3, 1)),
+        ),
+        'last date of each asset': (
+            'SELECT asset_code, MAX(date) FROM assets_prices '
+            'GROUP BY asset_code', (),
+        ),
+        'earnings of one asset': (
+            'SELECT * FROM assets_earnings WHERE asset_code = ? '
+            'ORDER BY date_of_payment', (code,),
+        ),
+        f'{len(ids)} _ids lookup': (
+            f'SELECT _id, id FROM assets_prices WHERE _id IN '
+            f'({", ".join("?" * len(ids))})', tuple(ids),
+        ),
+    }
+    results = {}
+    for name, (query, params) in queries.items():
+        times = []
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            connection.execute(query, params).fetchall()
+            times.append(time.perf_counter() - begin)
+        results[name] = statistics.median(times) * 1000
+    connection.close()
+    results['database size'] = os.path.getsize(path) / 1024 / 1024
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--assets', type=int, default=700)
+    parser.add_argument('--prices', type=int, default=500)
+    parser.add_argument('--earnings', type=int, default=20)
+    parser.add_argument('--path', default='/tmp/bench_db_indexes.sqlite3')
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        os.remove(args.path)
+    codes, ids = create_database(
+        args.path, args.assets, args.prices, args.earnings
+    )
+    before = time_queries(args.path, codes[0], ids)
+
+    from alembic import command
+    begin = time.perf_counter()
+    command.upgrade(alembic_config(args.path), REVISION)
+    elapsed = time.perf_counter() - begin
+    after = time_queries(args.path, codes[0], [bytes.fromhex(i) for i in ids])
+
+    print(
+        f'{args.assets} assets, {args.prices} prices and {args.earnings} '
+        f'earnings each. Migration took {elapsed:.1f} s.'
+    )
+    print(f'{"query":<34}{"before":>12}{"after":>12}')
+    for name in before:
+        unit = 'MB' if name == 'database size' else 'ms'
+        print(
+            f'{name:<34}{before[name]:>9.1f} {unit}{after[name]:>9.1f} {unit}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Compares the batch decoders with the ItemLoader path they replaced.
+
+Checks both produce the same items (including edge cases like "n/d", empty and
+missing values) and measures the time to decode 500 rows of each endpoint.
+
+Usage: python -m benchmarks.bench_decoders [--rows 500] [--repeat 20]
+"""
+import argparse
+import random
+import timeit
+
+from infomoney.decoders import (
+    decode_earnings, decode_fii_earnings, decode_fii_prices, decode_prices
+)
+from infomoney.items import AssetEarningsItem, AssetPriceItem
+from infomoney.loaders import AssetEarningsLoader, AssetPriceLoader
+
+
+def load_prices(rows, code):
+    for row in rows:
+        loader = AssetPriceLoader(item=AssetPriceItem())
+        loader.add_value('asset_code', code)
+        loader.add_value('date', row[0].get('display'))
+        loader.add_value('timestamp', row[0].get('timestamp'))
+        loader.add_value('open', row[1])
+        loader.add_value('high', row[5])
+        loader.add_value('low', row[4])
+        loader.add_value('close', row[2])
+        loader.add_value('volume', row[6])
+        loader.add_value('variation', row[3])
+        yield loader.load_item()
+
+
+def load_earnings(rows, code):
+    for row in rows:
+        loader = AssetEarningsLoader(item=AssetEarningsItem())
+        loader.add_value('asset_code', code)
+        loader.add_value('type', row[0])
+        loader.add_value('value', row[1])
+        loader.add_value('pct_factor', row[2])
+        loader.add_value('emission_value', row[3])
+        loader.add_value('date_of_approval', row[4])
+        loader.add_value('date_of_record', row[5])
+        loader.add_value('date_of_payment', row[6])
+        yield loader.load_item()
+
+
+def load_fii_prices(rows, code):
+    for row in rows:
+        loader = AssetPriceLoader(item=AssetPriceItem())
+        loader.add_value('asset_code', code)
+        loader.add_value('date', row.get('data'))
+        loader.add_value('close', row['valor'])
+        yield loader.load_item()
+
+
+def load_fii_earnings(rows, code):
+    for row in rows:
+        loader = AssetEarningsLoader(item=AssetEarningsItem())
+        loader.add_value('asset_code', code)
+        loader.add_value('type', 'Rendimento')
+        loader.add_value('value', row['rendimento'])
+        loader.add_value('pct_factor', row['yield'])
+        loader.add_value('date_of_payment', row['data'])
+        yield loader.load_item()
+
+
+def _number(rnd):
+    """Random value in one of the formats returned by the APIs."""
+    return rnd.choice([
+        f'{rnd.uniform(1, 5000):,.2f}'.replace(',', 'X').replace('.', ',')
+        .replace('X', '.'),
+        round(rnd.uniform(1, 100), 2),
+        'n/d', '', None, 0,
+    ])
+
+
+def make_rows(count, seed=0):
+    rnd = random.Random(seed)
+    prices = [
+        [
+            {'display': f'{1 + i % 28:02d}/01/2022', 'timestamp': str(i)},
+            _number(rnd), _number(rnd), _number(rnd), _number(rnd),
+            _number(rnd), rnd.choice(['1.234.500', 987, '', None]),
+        ]
+        for i in range(count)
+    ]
+    earnings = [
+        [
+            rnd.choice(['DIVIDENDO', 'JUROS S/CAPITAL', 'DESDOBRAMENTO']),
+            _number(rnd), rnd.choice(['1.234,56', '10,00', 'n/d', '']),
+            _number(rnd), '01/02/22', rnd.choice(['03/02/22', 'n/d']),
+            rnd.choice(['15/02/22', '', None]),
+        ]
+        for i in range(count)
+    ]
+    fii_prices = [
+        {'data': f'{1 + i % 28:02d}-01-2022T00:00:00', 'valor': _number(rnd)}
+        for i in range(count)
+    ]
+    fii_earnings = [
+        {
+            'rendimento': _number(rnd), 'yield': _number(rnd),
+            'data': f'{1 + i % 28:02d}-01-2022T00:00:00',
+        }
+        for i in range(count)
+    ]
+    return {
+        'prices': (prices, load_prices, decode_prices),
+        'earnings': (earnings, load_earnings, decode_earnings),
+        'fii_prices': (fii_prices, load_fii_prices, decode_fii_prices),
+        'fii_earnings': (fii_earnings, load_fii_earnings, decode_fii_earnings),
+    }
+
+
+def check_equivalence(rows_by_endpoint):
+    for endpoint, (rows, loader, decoder) in rows_by_endpoint.items():
+        expected = [dict(item) for item in loader(rows, 'PETR4')]
+        result = [dict(item) for item in decoder(rows, 'PETR4')]
+        if expected != result:
+            for i, (a, b) in enumerate(zip(expected, result)):
+                if a != b:
+                    raise AssertionError(
+                        f'{endpoint} row {i}: loader {a} != decoder {b}'
+                    )
+            raise AssertionError(f'{endpoint}: different number of items')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rows_by_endpoint = make_rows(args.rows)
+    check_equivalence(rows_by_endpoint)
+    print(f'Decoders output matches the loaders ({args.rows} rows/endpoint).')
+
+    print(f'{"endpoint":<14}{"loader ms":>12}{"decoder ms":>12}{"speedup":>10}')
+    for endpoint, (rows, loader, decoder) in rows_by_endpoint.items():
+        times = []
+        for func in (loader, decoder):
+            total = timeit.timeit(
+                lambda: list(func(rows, 'PETR4')), number=args.repeat
+            )
+            times.append(total / args.repeat * 1000)
+        print(
+            f'{endpoint:<14}{times[0]:>12.2f}{times[1]:>12.2f}'
+            f'{times[0] / times[1]:>9.1f}x'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Compares the JSON decoding of the API responses: `response.json()` (the
+previous path), the JsonDecoder backends and the streaming parser.
+
+Measures the time to decode a FII price history response and yield its items,
+and the peak memory (tracemalloc) of each path. Then the peak memory of each
+path for histories of a growing number of years, the streaming parser should
+stay flat while the others grow with the body.
+
+Usage: python -m benchmarks.bench_json [--rows 20000] [--repeat 10]
+       [--years 1 5 10 20 80]
+"""
+import argparse
+import json
+import timeit
+import tracemalloc
+from datetime import date, timedelta
+
+from scrapy.http import Request, TextResponse
+
+from infomoney.decoders import decode_fii_prices
+from infomoney.json_decoder import JsonDecoder, ijson, orjson
+
+
+# Trading days in a year, rows of the history by year.
+ROWS_BY_YEAR = 250
+
+
+def make_response(rows):
+    # Newest first, one row by weekday, as returned by the API.
+    day = date(2022, 12, 30)
+    data = {'dataValor': []}
+    while len(data['dataValor']) < rows:
+        if day.weekday() < 5:
+            data['dataValor'].append({
+                'data': day.strftime('%d-%m-%YT00:00:00'),
+                'valor': round(100 + len(data['dataValor']) % 1000 / 7, 2),
+            })
+        day -= timedelta(days=1)
+    url = 'https://fii-api.infomoney.com.br/api/v1/fii/cotacao/historico/'
+    return TextResponse(
+        url, body=json.dumps(data).encode(), encoding='utf-8',
+        request=Request(url),
+    )
+
+
+def response_json(response):
+    # New response object each time, TextResponse caches the decoded JSON.
+    response = response.replace()
+    return sum(1 for _ in decode_fii_prices(
+        response.json()['dataValor'], 'HGLG11'
+    ))
+
+
+def make_decode(backend):
+    decoder = JsonDecoder(backend)
+
+    def decode(response):
+        data = decoder.decode(response.body)
+        return sum(1 for _ in decode_fii_prices(data['dataValor'], 'HGLG11'))
+    return decode
+
+
+def make_stream():
+    decoder = JsonDecoder('json', stream_min_size=1)
+
+    def stream(response):
+        rows = decoder.iter_array(response.body, 'dataValor')
+        return sum(1 for _ in decode_fii_prices(rows, 'HGLG11'))
+    return stream
+
+
+def peak_memory(func, response):
+    tracemalloc.start()
+    func(response)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--years', type=int, nargs='+', default=[1, 5, 10, 20, 80])
+    args = parser.parse_args()
+
+    response = make_response(args.rows)
+    paths = {'response.json()': response_json, 'json': make_decode('json')}
+    if orjson:
+        paths['orjson'] = make_decode('orjson')
+    if ijson:
+        paths['ijson stream'] = make_stream()
+
+    print(
+        f'{len(response.body) / 1024:.0f} KiB body, {args.rows} rows\n'
+        f'{"path":<18}{"ms":>10}{"peak MiB":>10}{"speedup":>10}'
+    )
+    baseline = None
+    for name, func in paths.items():
+        assert func(response) == args.rows
+        total = timeit.timeit(lambda: func(response), number=args.repeat)
+        elapsed = total / args.repeat * 1000
+        baseline = baseline or elapsed
+        print(
+            f'{name:<18}{elapsed:>10.2f}{peak_memory(func, response):>10.2f}'
+            f'{baseline / elapsed:>9.1f}x'
+        )
+
+    print(
+        f'\nPeak MiB by years of dataValor ({ROWS_BY_YEAR} rows by year)\n'
+        f'{"years":>6}{"KiB":>8}' + ''.join(f'{name:>18}' for name in paths)
+    )
+    for years in args.years:
+        response = make_response(years * ROWS_BY_YEAR)
+        peaks = ''.join(
+            f'{peak_memory(func, response):>18.2f}' for func in paths.values()
+        )
+        print(f'{years:>6}{len(response.body) / 1024:>8.0f}{peaks}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Compares loading the prices of all the assets through the ORM, converting
+row by row (what the consumers did before), with `infomoney.query` reading the
+database and the CSV files, without and with the cache.
+
+Usage: python -m benchmarks.bench_query [--assets 700] [--prices 1000]
+[--directory /tmp/bench_query]
+"""
+import argparse
+import csv
+import hashlib
+import os
+import random
+import shutil
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from infomoney.models import AssetPriceModel, Base
+from infomoney.query import AssetDataLoader
+from infomoney.utils import parse_volume
+
+CSV_HEADER = [
+    'asset_code', 'date', 'timestamp', 'open', 'high', 'low', 'close',
+    'volume', 'variation'
+]
+
+
+def create_data(directory, assets, prices):
+    """Write the same random prices to a SQLite database and to CSV files, in
+    the formats of the pipelines.
+    """
+    database = os.path.join(directory, 'prices.sqlite3')
+    Base.metadata.create_all(create_engine(f'sqlite:///{database}'))
+
+    rnd = random.Random(0)
+    codes = [f'A{i:03d}{rnd.choice("34")}' for i in range(assets)]
+    start = datetime(2020, 1, 1)
+    connection = sqlite3.connect(database)
+    for code in codes:
+        rows = []
+        for day in range(prices):
+            date = start + timedelta(days=day)
+            close = f'{rnd.uniform(1, 100):.2f}'
+            volume = f'{rnd.randint(1000, 10 ** 8):,}'.replace(',', '.')
+            timestamp = str(int(date.timestamp()))
+            rows.append([
+                code, str(date), timestamp, close, close, close, close,
+                volume, '0.50'
+            ])
+        connection.executemany(
+            'INSERT INTO assets_prices (_id, asset_code, date, timestamp, '
+            'open, high, low, close, volume, variation) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (hashlib.md5(f'{code}{row[2]}'.encode()).digest(), code,
+                 row[1] + '.000000', row[1] + '.000000', *row[3:])
+                for row in rows
+            ]
+        )
+        with open(os.path.join(directory, f'{code}.csv'), 'w',
+                  newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(CSV_HEADER)
+            writer.writerows(rows)
+    connection.commit()
+    connection.close()
+    return database, codes
+
+
+def load_orm(database, codes):
+    """Previous path, ORM objects converted one by one."""
+    engine = create_engine(f'sqlite:///{database}')
+    rows = []
+    with Session(engine) as session:
+        query = session.query(AssetPriceModel).filter(
+            AssetPriceModel.asset_code.in_(codes[:500])
+        ).all() + session.query(AssetPriceModel).filter(
+            AssetPriceModel.asset_code.in_(codes[500:])
+        ).all()
+        for record in query:
+            rows.append((
+                record.asset_code, record.date,
+                float(record.close) if isinstance(record.close, Decimal)
+                else None,
+                parse_volume(record.volume),
+            ))
+    return len(rows)
+
+
+def timed(func, *args):
+    begin = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - begin, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--assets', type=int, default=700)
+    parser.add_argument('--prices', type=int, default=1000)
+    parser.add_argument('--directory', default='/tmp/bench_query')
+    args = parser.parse_args()
+
+    shutil.rmtree(args.directory, ignore_errors=True)
+    os.makedirs(args.directory)
+    database, codes = create_data(args.directory, args.assets, args.prices)
+    database_loader = AssetDataLoader(
+        'database', database_uri=f'sqlite:///{database}'
+    )
+    csv_loader = AssetDataLoader('csv', files_directory=args.directory)
+
+    results = [('ORM objects', *timed(load_orm, database, codes))]
+    for name, loader in (('database', database_loader), ('csv', csv_loader)):
+        for run in ('', ' (cached)'):
+            elapsed, columns = timed(loader.prices, codes)
+            results.append((name + run, elapsed, len(columns['date'])))
+    elapsed, frame = timed(database_loader.prices, codes, None, None, True)
+    results.append(('database DataFrame (cached)', elapsed, len(frame)))
+
+    print(f'{args.assets} assets, {args.prices} prices each.')
+    print(f'{"path":<30}{"seconds":>10}{"rows":>10}')
+    for name, elapsed, rows in results:
+        print(f'{name:<30}{elapsed:>10.2f}{rows:>10}')
+
+
+if __name__ == '__main__':
+    main()
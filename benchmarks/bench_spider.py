@@ -0,0 +1,460 @@
+"""Replays the responses of every endpoint through the spider callbacks, then
+the scraped items through the ITEM_PIPELINES chain, against a temporary SQLite
+database and CSV directory.
+
+Reports the time, items per second and peak memory (tracemalloc, measured in a
+second run) of each callback and pipeline. The responses are built by
+`benchmarks.fixtures`, or read from `{endpoint}.json` files with --recorded.
+With --compare the suite runs on the code of the given commits (the second one
+defaults to the working tree) and exits with 1 when a stage is slower, or uses
+more memory, than --threshold percent.
+
+Usage: python -m benchmarks.bench_spider [--assets 10] [--rows 250]
+[--earnings 20] [--repeat 1] [--recorded DIR] [--output results.json]
+       python -m benchmarks.bench_spider --compare BASE [TARGET]
+[--threshold 10]
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+from benchmarks import fixtures
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Smaller differences aren't regressions, whatever the percent.
+MIN_SECONDS_CHANGE = 0.01
+MIN_PEAK_MB_CHANGE = 0.5
+# Callback, endpoint and kind of asset it's requested for.
+CALLBACKS = (
+    ('parse_prices_data', 'price_api', 'stock'),
+    ('parse_earnings_data', 'earnings_api', 'stock'),
+    ('parse_fii_prices', 'fii_price_api', 'fii'),
+    ('parse_fii_earnings', 'fii_earnings_api', 'fii'),
+)
+
+
+def build_responses(args, spider):
+    """Responses of each callback, built before the measurements.
+    :returns: Dict of lists of (response, code) by callback.
+    """
+    from scrapy import Request
+    from scrapy.http import TextResponse
+
+    recorded = fixtures.load_recorded(args.recorded) if args.recorded else {}
+    codes = {
+        'stock': fixtures.stock_codes(args.assets),
+        'fii': fixtures.fii_codes(args.assets),
+    }
+
+    def response(url, endpoint, callback, body, code=None):
+        request = Request(
+            url, callback=getattr(spider, callback), meta={'endpoint': endpoint},
+            cb_kwargs={'code': code} if code else {}, dont_filter=True,
+        )
+        return TextResponse(
+            url, body=body, encoding='utf-8', request=request
+        )
+
+    listing = codes['stock'] + codes['fii']
+    size = spider.results_per_page
+    responses = {'parse': []}
+    for page in range(1, -(-len(listing) // size) + 1):
+        url = spider.start_url.format(page=page, size=size)
+        body = recorded.get('start_url') or fixtures.dumps(
+            fixtures.listing_page(listing, page, size)
+        )
+        responses['parse'].append(
+            (response(url, 'start_url', 'parse', body), None)
+        )
+
+    for callback, endpoint, kind in CALLBACKS:
+        responses[callback] = []
+        for code in codes[kind]:
+            url = getattr(spider, endpoint).format(asset_code=code)
+            body = recorded.get(endpoint) or fixtures.dumps(fixtures.payload(
+                endpoint, code, rows=args.rows, earnings=args.earnings
+            ))
+            responses[callback].append((
+                response(url, endpoint, callback, body, code), code
+            ))
+    return responses
+
+
+def run_callbacks(spider, responses, trace):
+    """Call each callback with its responses.
+    :returns: List of the scraped items and dict of the results by stage.
+    """
+    from scrapy import Request
+
+    items = []
+    results = {}
+    for callback in ['parse'] + [c[0] for c in CALLBACKS]:
+        method = getattr(spider, callback)
+        outputs = 0
+        if trace:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        begin = time.perf_counter()
+        for response, code in responses[callback]:
+            results_iter = method(response, code) if code else method(response)
+            for result in results_iter:
+                outputs += 1
+                if not isinstance(result, Request):
+                    items.append(result)
+        results[callback] = _stage(time.perf_counter() - begin, outputs)
+        if trace:
+            results[callback]['peak_mb'] = _peak_mb(start_memory)
+    return items, results
+
+
+def load_pipelines(crawler):
+    """Instances of the enabled ITEM_PIPELINES, in order."""
+    from scrapy.exceptions import NotConfigured
+    from scrapy.utils.conf import build_component_list
+    from scrapy.utils.misc import load_object
+
+    pipelines = []
+    for path in build_component_list(
+            crawler.settings.getwithbase('ITEM_PIPELINES')):
+        pipeline_class = load_object(path)
+        try:
+            if hasattr(pipeline_class, 'from_crawler'):
+                pipeline = pipeline_class.from_crawler(crawler)
+            else:
+                pipeline = pipeline_class()
+        except NotConfigured:
+            continue
+        pipelines.append((pipeline_class.__name__, pipeline))
+    return pipelines
+
+
+def run_pipelines(crawler, spider, items, trace):
+    """Process the items through the pipelines, one at a time, the Deferreds
+    returned by the pipelines are waited like the engine does.
+    :returns: Deferred firing with the dict of the results by stage.
+    """
+    from scrapy.exceptions import DropItem
+    from twisted.internet import defer
+
+    @defer.inlineCallbacks
+    def run():
+        pipelines = load_pipelines(crawler)
+        elapsed = {name: 0.0 for name, _ in pipelines}
+        processed = {name: 0 for name, _ in pipelines}
+        dropped = 0
+        if trace:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+
+        begin = time.perf_counter()
+        for name, pipeline in pipelines:
+            if hasattr(pipeline, 'open_spider'):
+                yield defer.maybeDeferred(pipeline.open_spider, spider)
+        opened = time.perf_counter()
+
+        for item in items:
+            for name, pipeline in pipelines:
+                stage_begin = time.perf_counter()
+                try:
+                    item = yield defer.maybeDeferred(
+                        pipeline.process_item, item, spider
+                    )
+                except DropItem:
+                    dropped += 1
+                    break
+                finally:
+                    elapsed[name] += time.perf_counter() - stage_begin
+                    processed[name] += 1
+        processed_at = time.perf_counter()
+
+        for name, pipeline in pipelines:
+            if hasattr(pipeline, 'close_spider'):
+                yield defer.maybeDeferred(pipeline.close_spider, spider)
+        end = time.perf_counter()
+
+        results = {
+            f'{name}.process_item': _stage(elapsed[name], processed[name])
+            for name, _ in pipelines
+        }
+        results['pipelines.open_spider'] = _stage(opened - begin, 0)
+        results['pipelines.close_spider'] = _stage(end - processed_at, 0)
+        results['pipelines (total)'] = _stage(end - begin, len(items))
+        results['pipelines (total)']['dropped'] = dropped
+        if trace:
+            results['pipelines (total)']['peak_mb'] = _peak_mb(start_memory)
+        return results
+
+    return run()
+
+
+def run_suite(args, directory, trace=False):
+    """Run the callbacks and pipelines with an empty database and new output
+    directories.
+    :returns: Deferred firing with the dict of the results by stage.
+    """
+    from scrapy.utils.test import get_crawler
+
+    run_directory = tempfile.mkdtemp(dir=directory)
+    # Decimal columns in SQLite warn on every query.
+    warnings.filterwarnings('ignore', message='Dialect sqlite')
+    settings = get_settings(directory, run_directory)
+    # The database engine is created when infomoney.models is imported.
+    models = importlib.import_module('infomoney.models')
+    models.Base.metadata.create_all(models.engine)
+    spider_module = importlib.import_module(
+        'infomoney.spiders.infomoney_spider'
+    )
+    crawler = get_crawler(spider_module.InfomoneySpider, settings)
+    spider = spider_module.InfomoneySpider.from_crawler(crawler)
+    crawler.spider = spider
+    crawler.stats.open_spider(spider)
+
+    responses = build_responses(args, spider)
+    if trace:
+        tracemalloc.start()
+    items, results = run_callbacks(spider, responses, trace)
+    del responses
+    results['callbacks (total)'] = _stage(
+        sum(r['seconds'] for r in results.values()), len(items)
+    )
+    if trace:
+        results['callbacks (total)']['peak_mb'] = max(
+            r['peak_mb'] for r in results.values() if 'peak_mb' in r
+        )
+
+    def cleanup(result):
+        if trace:
+            tracemalloc.stop()
+        models.Session.remove()
+        models.Base.metadata.drop_all(models.engine)
+        shutil.rmtree(run_directory, ignore_errors=True)
+        return result
+
+    d = run_pipelines(crawler, spider, items, trace)
+    d.addCallback(lambda pipeline_results: {**results, **pipeline_results})
+    return d.addBoth(cleanup)
+
+
+def get_settings(directory, run_directory):
+    """Project settings, with the database and the outputs in the temporary
+    directories and the caches disabled.
+    """
+    database = f'sqlite:///{os.path.join(directory, "bench.sqlite3")}'
+    os.environ['INFOMONEY_DB'] = database
+    # The CSV pipeline expects an existing directory.
+    os.makedirs(os.path.join(run_directory, 'csv_output'))
+    project_settings = importlib.import_module('infomoney.settings')
+    settings = {
+        name: getattr(project_settings, name)
+        for name in dir(project_settings) if name.isupper()
+    }
+    settings.update({
+        'DATABASE_URI': database,
+        'FILES_STORAGE_PATH': os.path.join(run_directory, 'csv_output'),
+        'PARQUET_STORAGE_PATH': os.path.join(run_directory, 'parquet_output'),
+        'ASSET_CACHE_PATH': None,
+        'HTTPCACHE_ENABLED': False,
+        'LOG_ENABLED': False,
+    })
+    return settings
+
+
+def _stage(seconds, items):
+    return {
+        'seconds': seconds,
+        'items': items,
+        'items_per_sec': items / seconds if seconds and items else None,
+    }
+
+
+def _peak_mb(start_memory):
+    return (tracemalloc.get_traced_memory()[1] - start_memory) / 2 ** 20
+
+
+def git_revision(source):
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=source,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(reactor, args):
+    """Best time of --repeat runs, then a run measuring the memory."""
+    from twisted.internet import defer
+
+    @defer.inlineCallbacks
+    def run():
+        directory = tempfile.mkdtemp(prefix='bench_spider_')
+        stages = {}
+        for _ in range(args.repeat):
+            results = yield run_suite(args, directory)
+            for name, result in results.items():
+                if name not in stages or \
+                        result['seconds'] < stages[name]['seconds']:
+                    stages[name] = result
+        traced = yield run_suite(args, directory, trace=True)
+        shutil.rmtree(directory, ignore_errors=True)
+        for name, result in traced.items():
+            if 'peak_mb' in result and name in stages:
+                stages[name]['peak_mb'] = result['peak_mb']
+
+        report = {
+            'revision': git_revision(args.source or BASE_DIR),
+            'source': args.source or BASE_DIR,
+            'arguments': {
+                'assets': args.assets, 'rows': args.rows,
+                'earnings': args.earnings, 'recorded': args.recorded,
+            },
+            'stages': stages,
+        }
+        print_report(report)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(report, file, indent=2)
+
+    return run()
+
+
+def print_report(report):
+    arguments = report['arguments']
+    print(
+        f'Revision {report["revision"]}: {arguments["assets"]} stocks and '
+        f'{arguments["assets"]} FIIs, {arguments["rows"]} prices and '
+        f'{arguments["earnings"]} earnings each.'
+    )
+    print(f'{"stage":<42}{"seconds":>10}{"items":>10}{"items/s":>12}'
+          f'{"peak MB":>10}')
+    for name, stage in report['stages'].items():
+        print(
+            f'{name:<42}{stage["seconds"]:>10.3f}{stage["items"]:>10}'
+            f'{_format(stage["items_per_sec"], ".0f"):>12}'
+            f'{_format(stage.get("peak_mb"), ".1f"):>10}'
+        )
+
+
+def compare(args):
+    """Run the suite on the code of each revision, in a git worktree, and
+    report the changes from the first to the second.
+    :returns: Exit status, 1 when there are regressions.
+    """
+    revisions = args.compare if len(args.compare) == 2 else \
+        args.compare + [None]
+    reports = []
+    for revision in revisions:
+        directory = tempfile.mkdtemp(prefix='bench_spider_')
+        source = BASE_DIR
+        if revision:
+            source = os.path.join(directory, 'source')
+            subprocess.run(
+                ['git', 'worktree', 'add', '--detach', source, revision],
+                cwd=BASE_DIR, check=True, capture_output=True
+            )
+        output = os.path.join(directory, 'results.json')
+        try:
+            # A new process, the modules of each revision are imported from
+            # its worktree.
+            command = [
+                sys.executable, '-m', 'benchmarks.bench_spider',
+                '--source', source, '--output', output,
+                '--assets', str(args.assets), '--rows', str(args.rows),
+                '--earnings', str(args.earnings),
+                '--repeat', str(args.repeat),
+            ]
+            if args.recorded:
+                command += ['--recorded', args.recorded]
+            subprocess.run(command, cwd=BASE_DIR, check=True)
+            with open(output) as file:
+                reports.append(json.load(file))
+        finally:
+            if revision:
+                subprocess.run(
+                    ['git', 'worktree', 'remove', '--force', source],
+                    cwd=BASE_DIR, capture_output=True
+                )
+            shutil.rmtree(directory, ignore_errors=True)
+
+    base, target = reports
+    labels = [revision or 'working tree' for revision in revisions]
+    print(f'\nChanges from {labels[0]} to {labels[1]}:')
+    print(f'{"stage":<42}{"seconds":>12}{"items/s":>12}{"peak MB":>12}')
+    regressions = []
+    for name, stage in target['stages'].items():
+        before = base['stages'].get(name)
+        if not before:
+            continue
+        time_change = _change(before['seconds'], stage['seconds'])
+        speed_change = _change(before['items_per_sec'], stage['items_per_sec'])
+        memory_change = _change(before.get('peak_mb'), stage.get('peak_mb'))
+        print(
+            f'{name:<42}{_format(time_change, "+.1f", "%"):>12}'
+            f'{_format(speed_change, "+.1f", "%"):>12}'
+            f'{_format(memory_change, "+.1f", "%"):>12}'
+        )
+        slower = (time_change or 0) > args.threshold and \
+            stage['seconds'] - before['seconds'] > MIN_SECONDS_CHANGE
+        bigger = (memory_change or 0) > args.threshold and \
+            stage['peak_mb'] - before['peak_mb'] > MIN_PEAK_MB_CHANGE
+        if slower or bigger:
+            regressions.append(name)
+
+    if regressions:
+        print(f'Regressions over {args.threshold}%: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+def _change(before, after):
+    if not before or after is None:
+        return None
+    return (after / before - 1) * 100
+
+
+def _format(value, spec, suffix=''):
+    return '-' if value is None else f'{value:{spec}}{suffix}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--assets', type=int, default=10,
+                        help='Number of stocks, and of FIIs.')
+    parser.add_argument('--rows', type=int, default=250,
+                        help='Price records of each asset.')
+    parser.add_argument('--earnings', type=int, default=20,
+                        help='Earnings records of each asset.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs measuring the time, the best is kept.')
+    parser.add_argument('--recorded',
+                        help='Directory with {endpoint}.json responses.')
+    parser.add_argument('--output', help='Save the results as JSON.')
+    parser.add_argument('--source',
+                        help='Directory of the infomoney code to measure.')
+    parser.add_argument('--compare', nargs='+', metavar='REVISION',
+                        help='Compare the code of two git revisions.')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='Percent of change reported as regression.')
+    args = parser.parse_args()
+
+    if args.compare:
+        if len(args.compare) > 2:
+            parser.error('--compare takes one or two revisions.')
+        sys.exit(compare(args))
+
+    if args.source:
+        sys.path.insert(0, os.path.abspath(args.source))
+    from twisted.internet import task
+    task.react(benchmark, [args])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""Local server emulating the Infomoney APIs requested by the spider, for
+end-to-end load tests.
+
+Serves the assets listing, the details pages and their redirects (the assets
+of `InfomoneySpider.broken_asset_urls` are redirected to an image, like in the
+website), the price and earnings APIs of stocks and FIIs, with the payloads of
+`benchmarks.fixtures` ending today. Each Infomoney host is served in its own
+port, from --port on, and the INFOMONEY_HOST_OVERRIDES pointing the spider to
+them is printed at start. The counts of responses are printed at exit.
+
+Usage: python -m benchmarks.emulator [--assets 700] [--history 1000]
+[--earnings 20] [--fii-ratio 0.1] [--latency 0] [--error-rate 0]
+[--empty-rate 0] [--port 8080]
+"""
+import argparse
+import json
+import random
+import time
+from collections import Counter
+from datetime import date, datetime
+from functools import lru_cache
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+from benchmarks import fixtures
+
+HOSTS = (
+    'api.infomoney.com.br', 'www.infomoney.com.br', 'fii-api.infomoney.com.br'
+)
+# Assets of InfomoneySpider.broken_asset_urls, included in the listing.
+BROKEN_ASSETS = ('BRPR3', 'FRAS3', 'HAGA4', 'ROMI3', 'TELB4', 'TPIS3', 'USIM3')
+# Endpoints that may return empty bodies, the listing isn't validated by the
+# spider.
+DATA_ENDPOINTS = (
+    'price_api', 'earnings_api', 'fii_price_api', 'fii_earnings_api'
+)
+DETAILS_PAGE = b'<html><body>Cotacao</body></html>'
+# Only the URL of the image is checked by the spider.
+IMAGE = b'\x89PNG\r\n\x1a\n'
+
+
+class InfomoneyEmulator(resource.Resource):
+    """Routes the requests of all the hosts, by path."""
+    isLeaf = True
+
+    def __init__(self, codes, history=1000, earnings=20, latency=0,
+                 error_rate=0, empty_rate=0, seed=0, cache_size=4096):
+        super().__init__()
+        self.codes = codes
+        self.known_codes = set(codes)
+        self.history = history
+        self.earnings = earnings
+        self.latency = latency
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.random = random.Random(seed)
+        self.end = date.today()
+        # (endpoint, status): number of responses
+        self.responses = Counter()
+        self.started = time.monotonic()
+        # Histories of the recently requested assets, the same asset is
+        # requested again after errors and empty responses.
+        self._history = lru_cache(maxsize=cache_size)(self._build_history)
+        self._body = lru_cache(maxsize=cache_size)(self._build_body)
+
+    def render(self, request):
+        path = request.path.decode()
+        endpoint, handler = self._route(path)
+        if endpoint in DATA_ENDPOINTS and \
+                self.random.random() < self.empty_rate:
+            status, headers, body = 200, {}, b''
+        elif self.random.random() < self.error_rate:
+            status, headers, body = 503, {}, b''
+        else:
+            status, headers, body = handler(request, path)
+        self.responses[endpoint, status] += 1
+
+        if not self.latency:
+            return self._respond(request, status, headers, body)
+        call = reactor.callLater(
+            self.latency * self.random.uniform(0.5, 1.5),
+            self._finish, request, status, headers, body
+        )
+        # Client disconnected before the response.
+        request.notifyFinish().addErrback(lambda _: call.cancel())
+        return server.NOT_DONE_YET
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        total = sum(self.responses.values())
+        print(f'{total} responses in {elapsed:.1f}s '
+              f'({total / elapsed if elapsed else 0:.1f}/s)')
+        for (endpoint, status), count in sorted(self.responses.items()):
+            print(f'{endpoint:<20}{status:>5}{count:>10}')
+
+    def _route(self, path):
+        if path.startswith('/markets/high-low/'):
+            return 'start_url', self._listing
+        if path == '/wp-json/infomoney/v1/quotes/history':
+            return 'price_api', self._prices
+        if path == '/wp-json/infomoney/v1/quotes/earnings':
+            return 'earnings_api', self._earnings
+        if path == '/api/v1/fii/cotacao/historico/grafico':
+            return 'fii_price_api', self._fii_prices
+        if path == '/api/v1/fii/provento/historico':
+            return 'fii_earnings_api', self._fii_earnings
+        if path.startswith('/cotacoes/b3/'):
+            return 'details_page', self._details_page
+        if path.startswith('/wp-content/uploads/'):
+            return 'image', self._image
+        return 'base_details_url', self._redirect
+
+    def _listing(self, request, path):
+        page = int(_arg(request, 'pageIndex') or 1)
+        size = int(_arg(request, 'pageSize') or 500)
+        return self._json(fixtures.listing_page(self.codes, page, size))
+
+    def _redirect(self, request, path):
+        code = path.strip('/').upper()
+        if code not in self.known_codes:
+            return 404, {}, b''
+        if code in BROKEN_ASSETS:
+            location = f'/wp-content/uploads/{code.lower()}.png'
+        else:
+            location = fixtures.details_path(code)
+        base = f'http://{request.getHeader("host")}'
+        return 301, {'Location': base + location}, b''
+
+    def _details_page(self, request, path):
+        code = path.strip('/').rsplit('-', 1)[-1].upper()
+        if code not in self.known_codes:
+            return 404, {}, b''
+        return 200, {'Content-Type': 'text/html'}, DETAILS_PAGE
+
+    def _image(self, request, path):
+        return 200, {'Content-Type': 'image/png'}, IMAGE
+
+    def _prices(self, request, path):
+        code = _arg(request, 'symbol')
+        if code not in self.known_codes:
+            return self._json([])
+        start = _ordinal(_arg(request, 'initialDate'), '%d/%m/%Y')
+        end = _ordinal(_arg(request, 'finalDate'), '%d/%m/%Y')
+        return self._json(self._filter('price_api', code, start, end))
+
+    def _earnings(self, request, path):
+        code = _arg(request, 'symbol')
+        if code not in self.known_codes:
+            return self._json({'aaData': []})
+        return self._json_body(self._body('earnings_api', code))
+
+    def _fii_prices(self, request, path):
+        code = _arg(request, 'Ticker')
+        if code not in self.known_codes:
+            return self._json({'dataValor': []})
+        start = _ordinal(_arg(request, 'DataInicio'), '%d-%m-%Y')
+        end = _ordinal(_arg(request, 'DataFim'), '%d-%m-%Y')
+        return self._json({
+            'dataValor': self._filter('fii_price_api', code, start, end)
+        })
+
+    def _fii_earnings(self, request, path):
+        code = _arg(request, 'Ticker')
+        if code not in self.known_codes:
+            return self._json([])
+        return self._json_body(self._body('fii_earnings_api', code))
+
+    def _filter(self, endpoint, code, start, end):
+        rows, days = self._history(endpoint, code)
+        if start is None and end is None:
+            return rows
+        start = start or 0
+        end = end or self.end.toordinal()
+        return [
+            row for row, day in zip(rows, days) if start <= day <= end
+        ]
+
+    def _build_history(self, endpoint, code):
+        """Price rows of the asset and the date ordinal of each row, read
+        from the row itself.
+        """
+        rows = fixtures.payload(endpoint, code, rows=self.history,
+                                end=self.end)
+        if endpoint == 'fii_price_api':
+            rows = rows['dataValor']
+            days = [_ordinal(row['data'], '%d-%m-%YT%H:%M:%S') for row in rows]
+        else:
+            days = [_ordinal(row[0]['display'], '%d/%m/%Y') for row in rows]
+        return rows, days
+
+    def _build_body(self, endpoint, code):
+        return fixtures.dumps(fixtures.payload(
+            endpoint, code, earnings=self.earnings, end=self.end
+        ))
+
+    def _json(self, data):
+        return self._json_body(fixtures.dumps(data))
+
+    def _json_body(self, body):
+        return 200, {'Content-Type': 'application/json'}, body
+
+    def _finish(self, request, status, headers, body):
+        request.write(self._respond(request, status, headers, body))
+        request.finish()
+
+    def _respond(self, request, status, headers, body):
+        request.setResponseCode(status)
+        for name, value in headers.items():
+            request.setHeader(name, value)
+        return body
+
+
+def _arg(request, name):
+    values = request.args.get(name.encode())
+    return values[0].decode() if values else None
+
+
+def _ordinal(value, date_format):
+    if not value:
+        return None
+    return datetime.strptime(value, date_format).toordinal()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--assets', type=int, default=700)
+    parser.add_argument('--history', type=int, default=1000,
+                        help='Price records of each asset.')
+    parser.add_argument('--earnings', type=int, default=20,
+                        help='Earnings records of each asset.')
+    parser.add_argument('--fii-ratio', type=float, default=0.1,
+                        help='Fraction of the assets that are FIIs.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Mean seconds before each response, +/- 50%%.')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of the responses with status 503.')
+    parser.add_argument('--empty-rate', type=float, default=0,
+                        help='Fraction of the API responses with empty body.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--interface', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port of the first host, one port per host.')
+    args = parser.parse_args()
+
+    broken = BROKEN_ASSETS[:args.assets]
+    codes = list(broken) + fixtures.asset_codes(
+        args.assets - len(broken), args.fii_ratio
+    )
+    emulator = InfomoneyEmulator(
+        codes, history=args.history, earnings=args.earnings,
+        latency=args.latency, error_rate=args.error_rate,
+        empty_rate=args.empty_rate, seed=args.seed,
+    )
+    site = server.Site(emulator)
+    site.noisy = False
+    overrides = {}
+    for port, host in enumerate(HOSTS, args.port):
+        reactor.listenTCP(port, site, interface=args.interface)
+        overrides[host] = f'http://{args.interface}:{port}'
+    reactor.addSystemEventTrigger('before', 'shutdown', emulator.report)
+
+    print(f'Emulating {len(codes)} assets, {args.history} prices each.')
+    print('scrapy crawl infomoney -s INFOMONEY_HOST_OVERRIDES=\''
+          f'{json.dumps(overrides)}\'')
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
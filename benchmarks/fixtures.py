@@ -0,0 +1,217 @@
+"""Payloads of the endpoints requested by the spider, with the same layout and
+value formats of the Infomoney responses: Brazilian decimal separators, the
+date format of each API and the newest first order of the price history.
+
+The values are generated from the asset code, so the same arguments always
+build the same payloads. Used by the benchmarks and the API emulator, doesn't
+import the project to work with the code of other commits.
+"""
+import json
+import os
+import random
+import string
+from datetime import date, datetime, time, timedelta, timezone
+
+# Last day of the generated histories.
+END_DATE = date(2022, 8, 31)
+ENDPOINTS = (
+    'start_url', 'price_api', 'earnings_api', 'fii_price_api',
+    'fii_earnings_api'
+)
+STOCK_EARNINGS_TYPES = (
+    ('DIVIDENDO', 60), ('JUROS S/CAPITAL', 30), ('DESDOBRAMENTO', 4),
+    ('BONIFICACAO', 3), ('GRUPAMENTO', 3),
+)
+
+
+def stock_codes(count, start=0):
+    """Codes of stocks: four letters and 3 or 4."""
+    return [_letters(i) + ('3' if i % 3 else '4') for i in range(
+        start, start + count
+    )]
+
+
+def fii_codes(count, start=0):
+    """Codes of FIIs: four letters and 11."""
+    return [_letters(i) + '11' for i in range(start, start + count)]
+
+
+def asset_codes(count, fii_ratio=0.1):
+    """Stocks and FIIs mixed, one FII every `1 / fii_ratio` assets."""
+    every = round(1 / fii_ratio) if fii_ratio else 0
+    codes = []
+    for i in range(count):
+        if every and i % every == every - 1:
+            codes.append(fii_codes(1, start=i)[0])
+        else:
+            codes.append(stock_codes(1, start=i)[0])
+    return codes
+
+
+def is_fii(code):
+    return code.endswith('11')
+
+
+def details_path(code):
+    """Path of the details page the asset URL redirects to."""
+    kind = 'fii' if is_fii(code) else 'acao'
+    return f'/cotacoes/b3/{kind}/{code[:4].lower()}-{code.lower()}/'
+
+
+def listing_page(codes, page, size):
+    """Page of the assets listing (`start_url`), pages start at 1."""
+    total_pages = max(1, -(-len(codes) // size))
+    return {
+        'PageIndex': page,
+        'PageSize': size,
+        'TotalPages': total_pages,
+        'TotalItems': len(codes),
+        'Data': [
+            {'StockCode': code, 'StockName': code[:4]}
+            for code in codes[(page - 1) * size:page * size]
+        ],
+    }
+
+
+def price_rows(code, days, end=END_DATE):
+    """Price history (`price_api`), newest first. Each row is the date,
+    open, close, variation, low, high and volume.
+    """
+    rnd = _random(code, 'price')
+    close = rnd.uniform(5, 100)
+    rows = []
+    for day in reversed(trading_days(days, end)):
+        previous, close = close, max(0.01, close * rnd.uniform(0.95, 1.05))
+        low = min(previous, close) * rnd.uniform(0.98, 1)
+        high = max(previous, close) * rnd.uniform(1, 1.02)
+        moment = datetime.combine(day, time(), timezone.utc)
+        rows.append([
+            {
+                'display': day.strftime('%d/%m/%Y'),
+                'timestamp': int(moment.timestamp()),
+            },
+            _brl(previous), _brl(close),
+            _brl((close / previous - 1) * 100), _brl(low), _brl(high),
+            _thousands(rnd.randint(1000, 10 ** 8)),
+        ])
+    return rows[::-1]
+
+
+def earnings_data(code, count, end=END_DATE):
+    """Earnings (`earnings_api`), newest first. Each row is the type, value,
+    % / factor, emission value and the approval, ex and payment dates.
+    """
+    rnd = _random(code, 'earnings')
+    types, weights = zip(*STOCK_EARNINGS_TYPES)
+    rows = []
+    for i in range(count):
+        _type = rnd.choices(types, weights)[0]
+        approval = end - timedelta(days=30 * (i + 1) + rnd.randint(0, 20))
+        ex_date = approval + timedelta(days=rnd.randint(1, 15))
+        payment = ex_date + timedelta(days=rnd.randint(10, 60))
+        is_cash = _type in ('DIVIDENDO', 'JUROS S/CAPITAL')
+        rows.append([
+            _type,
+            _brl(rnd.uniform(0.01, 2)) if is_cash else '0,00',
+            _brl(rnd.uniform(0.1, 5)) if is_cash
+            else _brl(rnd.choice([100, 50, 10])),
+            '0,00',
+            approval.strftime('%d/%m/%y'),
+            ex_date.strftime('%d/%m/%y'),
+            payment.strftime('%d/%m/%y') if is_cash else 'n/d',
+        ])
+    return {'aaData': rows}
+
+
+def fii_price_data(code, days, end=END_DATE):
+    """FII price history (`fii_price_api`), oldest first."""
+    rnd = _random(code, 'fii_price')
+    value = rnd.uniform(50, 150)
+    rows = []
+    for day in reversed(trading_days(days, end)):
+        value = max(0.01, value * rnd.uniform(0.98, 1.02))
+        rows.append({'data': _fii_date(day), 'valor': round(value, 2)})
+    return {'dataValor': rows}
+
+
+def fii_earnings_rows(code, count, end=END_DATE):
+    """FII monthly income (`fii_earnings_api`), newest first."""
+    rnd = _random(code, 'fii_earnings')
+    rows = []
+    for i in range(count):
+        day = end - timedelta(days=30 * i)
+        rows.append({
+            'rendimento': round(rnd.uniform(0.3, 1.5), 2),
+            'yield': round(rnd.uniform(0.4, 1.2), 2),
+            'data': _fii_date(day),
+        })
+    return rows
+
+
+def payload(endpoint, code, rows=500, earnings=20, end=END_DATE):
+    """Payload of the asset for the endpoint, except `start_url`."""
+    if endpoint == 'price_api':
+        return price_rows(code, rows, end)
+    if endpoint == 'earnings_api':
+        return earnings_data(code, earnings, end)
+    if endpoint == 'fii_price_api':
+        return fii_price_data(code, rows, end)
+    if endpoint == 'fii_earnings_api':
+        return fii_earnings_rows(code, earnings, end)
+    raise ValueError(f'Unknown endpoint {endpoint}')
+
+
+def load_recorded(directory):
+    """Load recorded responses, `{endpoint}.json` files in the directory,
+    used instead of the generated payloads of those endpoints.
+    :returns: Dict of the response bodies by endpoint.
+    """
+    recorded = {}
+    for endpoint in ENDPOINTS:
+        filename = os.path.join(directory, f'{endpoint}.json')
+        if os.path.exists(filename):
+            with open(filename, 'rb') as file:
+                recorded[endpoint] = file.read()
+    return recorded
+
+
+def dumps(data):
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def trading_days(count, end):
+    """Last `count` weekdays until `end`, newest first."""
+    days = []
+    day = end
+    while len(days) < count:
+        if day.weekday() < 5:
+            days.append(day)
+        day -= timedelta(days=1)
+    return days
+
+
+def _letters(index):
+    letters = ''
+    for _ in range(4):
+        index, remainder = divmod(index, 26)
+        letters = string.ascii_uppercase[remainder] + letters
+    return letters
+
+
+def _random(code, kind):
+    return random.Random(f'{code}-{kind}')
+
+
+def _brl(value):
+    """Number in the Brazilian format, 1.234,56."""
+    return f'{value:,.2f}'.replace(',', 'X').replace('.', ',').replace(
+        'X', '.'
+    )
+
+
+def _thousands(value):
+    return f'{value:,}'.replace(',', '.')
+
+
+def _fii_date(day):
+    return day.strftime('%d-%m-%YT00:00:00')
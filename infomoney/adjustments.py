@@ -0,0 +1,407 @@
+"""Adjusts the price history of the assets by their corporate actions
+(dividends, JCP, splits, reverse splits and stock bonuses), read from the
+earnings.
+
+Events are dated by their record date ("data com"), the last day the shares
+carry the event, so the ex-date is the first trading day after it. Each event
+gets a price factor: `1 - value / close` for cash events, using the close of
+the record date (or of the last day before it), and `1 / ratio` for splits,
+where `ratio` is the number of shares after the event for each share before
+it. A price is multiplied by the product of the factors of all the events of
+its asset with the record date on or after the price date. The volume is
+divided by the product of the split factors only.
+
+The factors of all the assets are computed at once with NumPy, on price and
+earnings columns as returned by `infomoney.query`. New prices and earnings can
+be added later, only the factors of the affected assets are recomputed.
+
+Usage:
+    from infomoney.adjustments import AdjustmentEngine
+    from infomoney.query import get_loader
+    engine = AdjustmentEngine.from_loader(get_loader(), ['PETR4', 'VALE3'])
+    adjusted = engine.adjusted_prices('PETR4', as_frame=True)
+"""
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+CASH = 'cash'
+SPLIT = 'split'
+REVERSE_SPLIT = 'reverse_split'
+
+# Kind of event of each earnings type, other types are ignored.
+EARNINGS_KINDS = {
+    'DIVIDENDO': CASH,
+    'JUROS S/CAPITAL': CASH,
+    'JRS CAP PROPRIO': CASH,
+    'RENDIMENTO': CASH,
+    'DESDOBRAMENTO': SPLIT,
+    'BONIFICACAO': SPLIT,
+    'BONIFICAÇÃO': SPLIT,
+    'GRUPAMENTO': REVERSE_SPLIT,
+}
+ADJUSTED_COLUMNS = ('open', 'high', 'low', 'close')
+
+# Rows are identified by a single integer, asset id * DAY_SPAN + days since
+# the epoch (shifted by DAY_OFFSET to be positive), so prices and events of
+# all the assets are searched in one sorted array.
+DAY_SPAN = 2 ** 22
+DAY_OFFSET = 2 ** 21
+
+logger = logging.getLogger(__name__)
+
+
+class AdjustmentEngine:
+    """Cumulative adjustment factors of the prices of many assets.
+
+    Adjusted prices are only materialised when requested, and kept until the
+    prices or the events of the asset change.
+    """
+
+    def __init__(self, prices, earnings=None, kinds=None):
+        """
+        :param prices: Price columns, as returned by `infomoney.query`.
+        :type prices: dict
+        :param earnings: Earnings columns, as returned by `infomoney.query`.
+        :type earnings: dict
+        :param kinds: Kind of event (`cash`, `split` or `reverse_split`) of
+        each earnings type, default to `EARNINGS_KINDS`.
+        :type kinds: dict
+        """
+        if np is None:
+            raise ImportError('numpy is required to adjust the prices.')
+        self.kinds = {
+            _type.upper(): kind
+            for _type, kind in (kinds or EARNINGS_KINDS).items()
+        }
+        # Earnings rows not used as events, by reason.
+        self.skipped = {'unknown_type': 0, 'no_date': 0, 'invalid_value': 0}
+
+        self.codes = []
+        self._asset_ids = {}
+        self.prices = None
+        self._price_keys = np.array([], dtype=np.int64)
+        self.price_factors = np.array([], dtype=np.float64)
+        self.volume_factors = np.array([], dtype=np.float64)
+
+        self._event_keys = np.array([], dtype=np.int64)
+        self._event_split = np.array([], dtype=bool)
+        # Cash value per share, or the split ratio.
+        self._event_values = np.array([], dtype=np.float64)
+        self.event_factors = np.array([], dtype=np.float64)
+        self._event_ids = set()
+
+        self._adjusted = None
+        self._dirty = set()
+
+        self.add_prices(prices)
+        if earnings is not None:
+            self.add_earnings(earnings)
+
+    @classmethod
+    def from_loader(cls, loader, assets, start=None, end=None, kinds=None):
+        """Build the engine with the prices of the assets between the dates
+        and all their earnings, events after `end` still adjust the prices.
+        :param loader: Loader of the stored data.
+        :type loader: infomoney.query.AssetDataLoader
+        """
+        return cls(
+            loader.prices(assets, start, end), loader.earnings(assets),
+            kinds=kinds
+        )
+
+    def add_prices(self, prices):
+        """Add or replace price rows (same asset and date) and recompute the
+        factors of their assets.
+        :returns: Codes of the affected assets.
+        """
+        ids = self._get_asset_ids(prices['asset_code'])
+        keys = _build_keys(ids, prices['date'])
+        valid = keys >= 0
+        new = {
+            name: np.asarray(column)[valid] for name, column in prices.items()
+        }
+        keys = keys[valid]
+
+        if self.prices is None:
+            merged, merged_keys = new, keys
+            factors = volume_factors = np.ones(len(keys))
+        else:
+            merged = {
+                name: np.concatenate((column, new[name]))
+                for name, column in self.prices.items() if name in new
+            }
+            merged_keys = np.concatenate((self._price_keys, keys))
+            factors = np.concatenate((self.price_factors, np.ones(len(keys))))
+            volume_factors = np.concatenate(
+                (self.volume_factors, np.ones(len(keys)))
+            )
+        # Stable sort, the added row is the last one of equal keys.
+        order = np.argsort(merged_keys, kind='stable')
+        merged_keys = merged_keys[order]
+        keep = np.append(merged_keys[1:] != merged_keys[:-1], True)
+        order = order[keep]
+
+        self.prices = {name: column[order] for name, column in merged.items()}
+        self._price_keys = merged_keys[keep]
+        self.price_factors = factors[order]
+        self.volume_factors = volume_factors[order]
+        # Rows moved, materialised again on the next request.
+        self._adjusted = None
+
+        ids = np.unique(ids[valid])
+        self._recompute(ids)
+        return [self.codes[i] for i in ids]
+
+    def add_earnings(self, earnings):
+        """Add the events of the earnings rows, rows already added are
+        ignored, and recompute the factors of their assets.
+        :returns: Codes of the affected assets.
+        """
+        types = np.array(earnings['type'], dtype=str)
+        kinds = np.array(
+            [self.kinds.get(t.upper()) for t in types], dtype=object
+        )
+        # Record date, the payment date when it's missing (FIIs).
+        dates = np.where(
+            np.isnat(earnings['date_of_record']),
+            earnings['date_of_payment'], earnings['date_of_record']
+        )
+        values = np.asarray(earnings['value'], dtype=np.float64)
+        ratios = _split_ratios(
+            kinds, np.asarray(earnings['pct_factor'], dtype=np.float64)
+        )
+
+        known = kinds != None  # noqa: E711, elementwise comparison
+        dated = ~np.isnat(dates)
+        is_cash = kinds == CASH
+        event_values = np.where(is_cash, values, ratios)
+        valid = np.isfinite(event_values) & (event_values > 0)
+        self.skipped['unknown_type'] += int(np.count_nonzero(~known))
+        self.skipped['no_date'] += int(np.count_nonzero(known & ~dated))
+        self.skipped['invalid_value'] += int(
+            np.count_nonzero(known & dated & ~valid)
+        )
+
+        rows = np.flatnonzero(known & dated & valid)
+        codes = np.asarray(earnings['asset_code'])[rows]
+        day = dates[rows].astype('datetime64[D]').astype(np.int64)
+        new = np.array([
+            (code, _type, d, value) not in self._event_ids
+            for code, _type, d, value in zip(
+                codes, types[rows], day, event_values[rows]
+            )
+        ], dtype=bool)
+        self._event_ids.update(zip(
+            codes[new], types[rows][new], day[new], event_values[rows][new]
+        ))
+        rows = rows[new]
+        if not len(rows):
+            return []
+
+        ids = self._get_asset_ids(codes[new])
+        keys = np.concatenate(
+            (self._event_keys, _build_keys(ids, dates[rows]))
+        )
+        order = np.argsort(keys, kind='stable')
+        self._event_keys = keys[order]
+        self._event_split = np.concatenate(
+            (self._event_split, ~is_cash[rows])
+        )[order]
+        self._event_values = np.concatenate(
+            (self._event_values, event_values[rows])
+        )[order]
+        self.event_factors = np.concatenate(
+            (self.event_factors, np.ones(len(rows)))
+        )[order]
+
+        ids = np.unique(ids)
+        self._recompute(ids)
+        logger.debug(
+            'Added %s events of %s assets, skipped rows: %s', len(rows),
+            len(ids), self.skipped
+        )
+        return [self.codes[i] for i in ids]
+
+    def factors(self, assets=None):
+        """Cumulative factors of each price row of the assets (all by
+        default): `factor` multiplies the prices, `volume_factor` divides the
+        volume.
+        """
+        rows = self._get_rows(assets)
+        return {
+            'asset_code': self.prices['asset_code'][rows],
+            'date': self.prices['date'][rows],
+            'factor': self.price_factors[rows],
+            'volume_factor': self.volume_factors[rows],
+        }
+
+    def adjusted_prices(self, assets=None, as_frame=False):
+        """Price columns of the assets (all by default) with the open, high,
+        low and close adjusted by the events, and the volume by the splits.
+        :param as_frame: Return a pandas DataFrame instead of the arrays.
+        :type as_frame: bool
+        """
+        self._materialise()
+        rows = self._get_rows(assets)
+        columns = {
+            name: column[rows] for name, column in self._adjusted.items()
+        }
+        columns['factor'] = self.price_factors[rows]
+        if as_frame:
+            if pd is None:
+                raise ImportError('pandas is required to load a DataFrame.')
+            return pd.DataFrame(columns)
+        return columns
+
+    def _materialise(self):
+        """Apply the factors to the prices of the assets changed since the
+        last request.
+        """
+        if self._adjusted is None:
+            self._adjusted = {
+                name: column.copy() for name, column in self.prices.items()
+            }
+            rows = slice(None)
+        elif self._dirty:
+            rows = np.isin(
+                self._price_keys // DAY_SPAN, np.fromiter(self._dirty, int)
+            )
+        else:
+            return
+        self._dirty.clear()
+
+        for name in ADJUSTED_COLUMNS:
+            if name in self.prices:
+                self._adjusted[name][rows] = (
+                    self.prices[name][rows] * self.price_factors[rows]
+                )
+        if 'volume' in self.prices:
+            self._adjusted['volume'][rows] = (
+                self.prices['volume'][rows] / self.volume_factors[rows]
+            )
+
+    def _recompute(self, ids):
+        """Compute the factors of the events of the assets and the cumulative
+        factors of their prices.
+        :param ids: Asset ids.
+        """
+        event_rows = np.flatnonzero(np.isin(self._event_keys // DAY_SPAN, ids))
+        price_rows = np.flatnonzero(np.isin(self._price_keys // DAY_SPAN, ids))
+        event_keys = self._event_keys[event_rows]
+        price_keys = self._price_keys[price_rows]
+        self._dirty.update(int(i) for i in ids)
+        if not len(event_rows) or not len(price_rows):
+            return
+
+        # Price factor of each event.
+        split = self._event_split[event_rows]
+        values = self._event_values[event_rows]
+        factors = np.ones(len(event_rows))
+        factors[split] = 1 / values[split]
+        # Close of the record date of the cash events, the last day before
+        # the ex-date.
+        cash = np.flatnonzero(~split)
+        position = np.searchsorted(
+            price_keys, event_keys[cash], side='right'
+        ) - 1
+        has_price = (position >= 0) & (
+            price_keys[position] // DAY_SPAN == event_keys[cash] // DAY_SPAN
+        )
+        close = self.prices['close'][price_rows][position]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cash_factors = 1 - values[cash] / close
+        # Events before the first price or without a valid close don't adjust
+        # any price.
+        cash_factors[
+            ~has_price | ~np.isfinite(cash_factors) | (cash_factors <= 0)
+        ] = 1
+        factors[cash] = cash_factors
+        self.event_factors[event_rows] = factors
+
+        # Products of the factors of the events on or after the date of each
+        # price (same asset), differences of cumulative sums of their logs.
+        logs = np.log(factors)
+        cumulative = np.concatenate(([0], np.cumsum(logs)))
+        cumulative_split = np.concatenate(
+            ([0], np.cumsum(np.where(split, logs, 0)))
+        )
+        first = np.searchsorted(event_keys, price_keys)
+        last = np.searchsorted(
+            event_keys, (price_keys // DAY_SPAN + 1) * DAY_SPAN
+        )
+        self.price_factors[price_rows] = np.exp(
+            cumulative[last] - cumulative[first]
+        )
+        self.volume_factors[price_rows] = np.exp(
+            cumulative_split[last] - cumulative_split[first]
+        )
+
+    def _get_asset_ids(self, codes):
+        """Integer id of each asset code, new codes get the next ids. Rows
+        are usually grouped by asset, so the codes are mapped by runs.
+        """
+        codes = np.asarray(codes, dtype=object)
+        if not len(codes):
+            return np.array([], dtype=np.int64)
+        starts = np.flatnonzero(
+            np.concatenate(([True], codes[1:] != codes[:-1]))
+        )
+        run_ids = []
+        for code in codes[starts]:
+            if code not in self._asset_ids:
+                self._asset_ids[code] = len(self.codes)
+                self.codes.append(code)
+            run_ids.append(self._asset_ids[code])
+        return np.repeat(
+            np.array(run_ids, dtype=np.int64),
+            np.diff(np.append(starts, len(codes)))
+        )
+
+    def _get_rows(self, assets):
+        """Rows of the prices of the assets, all the rows if None."""
+        if assets is None:
+            return slice(None)
+        codes = [assets] if isinstance(assets, str) else assets
+        ids = [
+            self._asset_ids[code] for code in codes if code in self._asset_ids
+        ]
+        return np.flatnonzero(np.isin(self._price_keys // DAY_SPAN, ids))
+
+
+def adjust_prices(prices, earnings, kinds=None, as_frame=False):
+    """Adjust the prices by the earnings without keeping the engine."""
+    return AdjustmentEngine(prices, earnings, kinds=kinds).adjusted_prices(
+        as_frame=as_frame
+    )
+
+
+def _split_ratios(kinds, pct_factors):
+    """Shares after the event for each share before it. Splits and bonuses
+    inform the percentage of new shares (100 is 1:2), reverse splits the
+    number of shares grouped into one (10 is 10:1), or the ratio itself when
+    it's below 1.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.select(
+            [kinds == SPLIT, (kinds == REVERSE_SPLIT) & (pct_factors >= 1),
+             kinds == REVERSE_SPLIT],
+            [1 + pct_factors / 100, 1 / pct_factors, pct_factors],
+            default=np.nan,
+        )
+
+
+def _build_keys(ids, dates):
+    """Key of each row, -1 for rows without date."""
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    keys = ids * DAY_SPAN + dates.astype(np.int64) + DAY_OFFSET
+    keys[np.isnat(dates)] = -1
+    return keys
@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import time
+
+
+class AssetResolutionCache:
+    """On-disk cache of the pages the asset details URLs redirect to.
+
+    Resolving an asset costs one request to `base_details_url`, the response
+    tells the URL of the asset page, if the asset is a FII or if the page no
+    longer exists (404). The mapping rarely changes, so it's kept in a JSON
+    file between executions.
+    """
+
+    def __init__(self, path, ttl, not_found_ttl):
+        """
+        :param path: Path of the JSON file.
+        :type path: str
+        :param ttl: Seconds a resolved asset is considered fresh.
+        :type ttl: int
+        :param not_found_ttl: Seconds an asset that returned 404 is skipped.
+        :type not_found_ttl: int
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self.entries = {}
+        # Codes updated in this execution
+        self.updated = set()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.logger.exception(
+                'Failed to load the asset cache %s, ignoring it.', self.path
+            )
+            self.entries = {}
+        else:
+            self.logger.info(
+                'Loaded %s assets from the cache %s.',
+                len(self.entries), self.path
+            )
+
+    def save(self):
+        """Write the updated entries, merged with the ones in the file, so
+        processes running at the same time don't overwrite each other.
+        """
+        if not self.updated:
+            return
+        entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding='utf-8') as file:
+                    entries = json.load(file)
+            except (OSError, ValueError):
+                entries = {}
+        entries.update({code: self.entries[code] for code in self.updated})
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(entries, file, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+        self.updated = set()
+
+    def get(self, code):
+        """Return the cached entry of the asset if it hasn't expired.
+        :returns: Dict with `url`, `fii`, `status` and `updated_at` keys.
+        """
+        entry = self.entries.get(code)
+        if not entry:
+            return
+        ttl = self.not_found_ttl if entry['status'] == 404 else self.ttl
+        if time.time() - entry['updated_at'] > ttl:
+            return
+        return entry
+
+    def set_resolved(self, code, url, is_fii):
+        self._set(code, url=url, fii=is_fii, status=200)
+
+    def set_not_found(self, code):
+        self._set(code, url=None, fii=None, status=404)
+
+    def _set(self, code, **entry):
+        entry['updated_at'] = int(time.time())
+        self.entries[code] = entry
+        self.updated.add(code)
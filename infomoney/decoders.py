@@ -0,0 +1,102 @@
+"""Batch decoders for the API responses.
+
+The responses are arrays with a fixed layout, so the rows are converted into
+items in a single pass instead of going through an ItemLoader for each row.
+The output is the same of the loaders in `infomoney.loaders`: the first value
+that isn't None or empty is taken, the decimal separator processors are applied
+and fields without a value are left unset.
+"""
+from infomoney.items import AssetEarningsItem, AssetPriceItem
+from infomoney.loaders import (
+    pct_factor_decimal_separator, replace_decimal_separator
+)
+
+
+def take_first(value):
+    """Equivalent of the TakeFirst processor for a single added value."""
+    if isinstance(value, (list, tuple)):
+        for v in value:
+            if v is not None and v != '':
+                return v
+        return
+    if value is None or value == '':
+        return
+    return value
+
+
+def _decimal(value):
+    value = take_first(value)
+    return None if value is None else replace_decimal_separator(value)
+
+
+def _pct_factor(value):
+    value = take_first(value)
+    return None if value is None else pct_factor_decimal_separator(value)
+
+
+def _build_item(item_cls, fields):
+    return item_cls(
+        {name: value for name, value in fields if value is not None}
+    )
+
+
+def decode_prices(rows, code):
+    """Convert the rows of the `price_api` response into items.
+    :param rows: Rows of the response, in the order they should be yielded.
+    :type rows: Iterable[list]
+    :param code: Asset code.
+    :type code: str
+    """
+    code = take_first(code)
+    for row in rows:
+        yield _build_item(AssetPriceItem, (
+            ('asset_code', code),
+            ('date', take_first(row[0].get('display'))),
+            ('timestamp', take_first(row[0].get('timestamp'))),
+            ('open', _decimal(row[1])),
+            ('high', _decimal(row[5])),
+            ('low', _decimal(row[4])),
+            ('close', _decimal(row[2])),
+            ('volume', take_first(row[6])),
+            ('variation', _decimal(row[3])),
+        ))
+
+
+def decode_earnings(rows, code):
+    """Convert the rows of the `earnings_api` response into items."""
+    code = take_first(code)
+    for row in rows:
+        yield _build_item(AssetEarningsItem, (
+            ('asset_code', code),
+            ('type', take_first(row[0])),
+            ('value', _decimal(row[1])),
+            ('pct_factor', _pct_factor(row[2])),
+            ('emission_value', _decimal(row[3])),
+            ('date_of_approval', take_first(row[4])),
+            ('date_of_record', take_first(row[5])),
+            ('date_of_payment', take_first(row[6])),
+        ))
+
+
+def decode_fii_prices(rows, code):
+    """Convert the `dataValor` rows of the `fii_price_api` response."""
+    code = take_first(code)
+    for row in rows:
+        yield _build_item(AssetPriceItem, (
+            ('asset_code', code),
+            ('date', take_first(row.get('data'))),
+            ('close', _decimal(row['valor'])),
+        ))
+
+
+def decode_fii_earnings(rows, code):
+    """Convert the rows of the `fii_earnings_api` response into items."""
+    code = take_first(code)
+    for row in rows:
+        yield _build_item(AssetEarningsItem, (
+            ('asset_code', code),
+            ('type', 'Rendimento'),
+            ('value', _decimal(row['rendimento'])),
+            ('pct_factor', _pct_factor(row['yield'])),
+            ('date_of_payment', take_first(row['data'])),
+        ))
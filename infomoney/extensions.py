@@ -0,0 +1,519 @@
+# Define here your extensions
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+import json
+import logging
+import os
+import time
+import weakref
+from datetime import datetime
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.extensions.throttle import AutoThrottle
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet import defer, reactor
+from twisted.internet.error import CannotListenError
+from twisted.internet.task import LoopingCall
+from twisted.web.server import Site
+
+from infomoney.metrics import MetricsRegistry, MetricsResource
+from infomoney.signals import (
+    callback_processed, database_written, response_validated
+)
+from infomoney.utils import wrap_process_item
+
+
+class HostSlots:
+    """Applies the concurrency and delay configured for each host in
+    `DOWNLOAD_HOST_SLOTS` to its download slot, so a slow or rate limited
+    host doesn't hold the requests to the others.
+
+    Also reports the latency and the max queue depth of each slot in the
+    stats (`slots/*`).
+    """
+
+    def __init__(self, crawler, host_slots):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.host_slots = host_slots
+        # Slot objects already configured. The downloader drops the slots
+        # idle for a while and creates new ones with the default settings.
+        self.configured = weakref.WeakSet()
+        # Slot key: [number of responses, sum of the latencies]
+        self.latencies = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        ext = cls(crawler, crawler.settings.getdict('DOWNLOAD_HOST_SLOTS'))
+        crawler.signals.connect(
+            ext.request_reached_downloader,
+            signal=signals.request_reached_downloader
+        )
+        crawler.signals.connect(
+            ext.response_downloaded, signal=signals.response_downloaded
+        )
+        return ext
+
+    def request_reached_downloader(self, request, spider):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+        if slot not in self.configured:
+            # Runs before the first request of the slot is sent.
+            self.configured.add(slot)
+            config = self.host_slots.get(key, {})
+            if 'concurrency' in config:
+                slot.concurrency = config['concurrency']
+            if 'delay' in config:
+                slot.delay = config['delay']
+        self.stats.max_value(f'slots/{key}/queue_depth_max', len(slot.queue))
+
+    def response_downloaded(self, response, request, spider):
+        key = request.meta.get('download_slot')
+        latency = request.meta.get('download_latency')
+        if key is None or latency is None:
+            return
+        state = self.latencies.setdefault(key, [0, 0.0])
+        state[0] += 1
+        state[1] += latency
+        self.stats.set_value(f'slots/{key}/responses', state[0])
+        self.stats.set_value(
+            f'slots/{key}/latency_avg', round(state[1] / state[0], 3)
+        )
+        self.stats.max_value(f'slots/{key}/latency_max', round(latency, 3))
+
+
+class PerHostAutoThrottle(AutoThrottle):
+    """AutoThrottle using the `throttle_target` of each host in
+    `DOWNLOAD_HOST_SLOTS` instead of `AUTOTHROTTLE_TARGET_CONCURRENCY`. The
+    `delay` of the host is kept as the min delay of its slot.
+    """
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        self.default_target = self.target_concurrency
+        self.host_slots = crawler.settings.getdict('DOWNLOAD_HOST_SLOTS')
+        self.host_config = {}
+
+    def _response_downloaded(self, response, request, spider):
+        # The response isn't bound to its request yet when it's downloaded,
+        # response.meta isn't available in _adjust_delay.
+        self.host_config = self.host_slots.get(
+            request.meta.get('download_slot'), {}
+        )
+        super()._response_downloaded(response, request, spider)
+
+    def _adjust_delay(self, slot, latency, response):
+        self.target_concurrency = self.host_config.get(
+            'throttle_target', self.default_target
+        )
+        super()._adjust_delay(slot, latency, response)
+        slot.delay = max(slot.delay, self.host_config.get('delay', 0))
+
+
+class AdaptiveConcurrency:
+    """Adjusts the concurrency and delay of each download slot based on the
+    quality of the responses, not only on their latency.
+
+    Under too many concurrent requests the server doesn't fail, it returns
+    empty or malformed data. Every bad response (invalid data, a retried
+    request or a 429/5xx status) halves the slot concurrency and doubles its
+    delay, every `ADAPTIVE_CONCURRENCY_WINDOW` valid responses in a row
+    increase the concurrency by one and reduce the delay (AIMD).
+    """
+    bad_outcomes = ('empty', 'unparseable', 'malformed', 'missing_key')
+    # Min delay used when backing off from a slot without delay.
+    min_backoff_delay = 0.5
+
+    def __init__(self, crawler):
+        self.logger = logging.getLogger(__name__)
+        self.crawler = crawler
+        self.stats = crawler.stats
+        settings = crawler.settings
+        self.start_concurrency = settings.getint('ADAPTIVE_CONCURRENCY_START')
+        self.max_concurrency = settings.getint('ADAPTIVE_CONCURRENCY_MAX')
+        self.window = settings.getint('ADAPTIVE_CONCURRENCY_WINDOW')
+        self.max_delay = settings.getfloat('ADAPTIVE_CONCURRENCY_MAX_DELAY')
+        self.cooldown = settings.getfloat('ADAPTIVE_CONCURRENCY_COOLDOWN')
+        # AutoThrottle sets the delay of the slots on every response.
+        self.manage_delay = not settings.getbool('AUTOTHROTTLE_ENABLED')
+        # Slot: [valid responses in a row, time of the last back off]. By slot
+        # object, the slots recreated by the downloader start again.
+        self.slots = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        ext = cls(crawler)
+        crawler.signals.connect(ext.engine_started, signal=signals.engine_started)
+        crawler.signals.connect(
+            ext.request_reached_downloader,
+            signal=signals.request_reached_downloader
+        )
+        crawler.signals.connect(
+            ext.response_received, signal=signals.response_received
+        )
+        crawler.signals.connect(
+            ext.response_validated, signal=response_validated
+        )
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def engine_started(self):
+        downloader = self.crawler.engine.downloader
+        # CONCURRENT_REQUESTS would cap the growth of the slots.
+        if downloader.total_concurrency < self.max_concurrency:
+            self.logger.info(
+                'Raising the global concurrency from %s to %s.',
+                downloader.total_concurrency, self.max_concurrency
+            )
+            downloader.total_concurrency = self.max_concurrency
+        if not self.manage_delay:
+            self.logger.info(
+                'AutoThrottle is enabled, only the concurrency of the slots '
+                'will be adjusted.'
+            )
+
+    def request_reached_downloader(self, request, spider):
+        slot = self._get_slot(request.meta.get('download_slot'))
+        if slot is None or slot in self.slots:
+            return
+        self.slots[slot] = [0, 0]
+        # Won't start above the concurrency configured for the host.
+        slot.concurrency = min(
+            self.start_concurrency, self.max_concurrency, slot.concurrency
+        )
+        self.stats.max_value('adaptive/concurrency/max', slot.concurrency)
+
+    def response_received(self, response, request, spider):
+        endpoint = request.meta.get('endpoint', 'other')
+        if response.status == 429 or response.status >= 500:
+            self.stats.inc_value(f'adaptive/{endpoint}/http_error')
+            self._back_off(request, endpoint)
+        elif request.meta.get('retry_times'):
+            self.stats.inc_value(f'adaptive/{endpoint}/retried')
+            self._back_off(request, endpoint)
+
+    def response_validated(self, response, spider, outcome):
+        request = response.request
+        endpoint = request.meta.get('endpoint', 'other')
+        self.stats.inc_value(f'adaptive/{endpoint}/{outcome}')
+        if outcome in self.bad_outcomes:
+            self._back_off(request, endpoint)
+        elif outcome == 'valid':
+            self._speed_up(request)
+
+    def spider_closed(self, spider):
+        engine = self.crawler.engine
+        if engine is None:
+            return
+        for key, slot in engine.downloader.slots.items():
+            if slot in self.slots:
+                self.logger.info(
+                    'Final concurrency for %s: %s (delay %.2fs).',
+                    key, slot.concurrency, slot.delay
+                )
+
+    def _back_off(self, request, endpoint):
+        key = request.meta.get('download_slot')
+        slot = self._get_slot(key)
+        if slot is None or slot not in self.slots:
+            return
+        state = self.slots[slot]
+        state[0] = 0
+        # Responses of requests sent before the last back off are still
+        # arriving, wait for them before reducing the slot again.
+        now = time.monotonic()
+        if now - state[1] < self.cooldown:
+            return
+        state[1] = now
+
+        slot.concurrency = max(1, slot.concurrency // 2)
+        if self.manage_delay:
+            slot.delay = min(
+                self.max_delay, max(self.min_backoff_delay, slot.delay * 2)
+            )
+        self.stats.inc_value(f'adaptive/{endpoint}/backoff')
+        self.logger.info(
+            'Bad response from %s, concurrency of %s reduced to %s '
+            '(delay %.2fs).', endpoint, key, slot.concurrency, slot.delay
+        )
+
+    def _speed_up(self, request):
+        key = request.meta.get('download_slot')
+        slot = self._get_slot(key)
+        if slot is None or slot not in self.slots:
+            return
+        state = self.slots[slot]
+        state[0] += 1
+        if state[0] < self.window:
+            return
+        state[0] = 0
+
+        if slot.concurrency < self.max_concurrency:
+            slot.concurrency += 1
+            self.stats.max_value(
+                'adaptive/concurrency/max', slot.concurrency
+            )
+            self.logger.debug(
+                'Concurrency of %s increased to %s.', key, slot.concurrency
+            )
+        if self.manage_delay and slot.delay:
+            delay = slot.delay * 0.75
+            slot.delay = delay if delay >= 0.05 else 0
+
+    def _get_slot(self, key):
+        engine = self.crawler.engine
+        if engine is None or key is None:
+            return
+        return engine.downloader.slots.get(key)
+
+
+class Metrics:
+    """Records latency histograms of the downloads (by host), of the spider
+    callbacks and of the `process_item` of each pipeline, the database flush
+    and commit times, the items per second and the depth of the queues.
+
+    The metrics are served in the Prometheus text format at
+    `METRICS_HOST:METRICS_PORT` and written as JSON to `METRICS_DUMP_PATH`
+    every `METRICS_INTERVAL` seconds. The summary of the histograms is added
+    to the stats (`metrics/*`) when the spider closes.
+    """
+
+    def __init__(self, crawler, interval=30, host='127.0.0.1', port=0,
+                 dump_path=None):
+        self.logger = logging.getLogger(__name__)
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = interval
+        self.host = host
+        self.port = port
+        self.dump_path = dump_path
+        self.dump_task = None
+        self.listener = None
+        # Items scraped of each type and time of the last dump, for the rate.
+        self.last_items = {}
+        self.last_time = None
+
+        self.registry = MetricsRegistry()
+        self.registry.histogram(
+            'download_latency_seconds', 'Download latency by host.', 'host'
+        )
+        self.registry.histogram(
+            'callback_seconds', 'Time spent in each spider callback.',
+            'callback'
+        )
+        self.registry.histogram(
+            'pipeline_seconds', 'Time spent in process_item of each pipeline.',
+            'pipeline'
+        )
+        self.registry.histogram(
+            'database_flush_seconds',
+            'Time of the statements of each database transaction.', 'type'
+        )
+        self.registry.histogram(
+            'database_commit_seconds', 'Time of each database commit.', 'type'
+        )
+        self.registry.counter(
+            'items_scraped_total', 'Items scraped by type.', 'type'
+        )
+        self.registry.counter(
+            'database_records_total', 'Records written by type.', 'type'
+        )
+        self.registry.gauge(
+            'items_per_second', 'Items scraped per second in the last '
+            'interval.', 'type'
+        )
+        self.registry.gauge(
+            'queue_depth', 'Requests, responses or items in each queue.',
+            'queue'
+        )
+        self.registry.gauge(
+            'slot_queue_depth', 'Requests waiting in each download slot.',
+            'slot'
+        )
+        self.registry.gauge(
+            'slot_transferring', 'Requests being downloaded in each slot.',
+            'slot'
+        )
+        self.registry.gauge('stats', 'Numeric values of the stats.', 'key')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        ext = cls(
+            crawler,
+            interval=settings.getfloat('METRICS_INTERVAL', 30),
+            host=settings.get('METRICS_HOST', '127.0.0.1'),
+            port=settings.getint('METRICS_PORT'),
+            dump_path=settings.get('METRICS_DUMP_PATH'),
+        )
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(
+            ext.response_downloaded, signal=signals.response_downloaded
+        )
+        crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(
+            ext.callback_processed, signal=callback_processed
+        )
+        crawler.signals.connect(
+            ext.database_written, signal=database_written
+        )
+        return ext
+
+    def spider_opened(self, spider):
+        self._wrap_pipelines()
+        self.last_time = time.monotonic()
+        self.dump_task = LoopingCall(self.dump)
+        self.dump_task.start(self.interval, now=False)
+        if not self.port:
+            return
+        try:
+            self.listener = reactor.listenTCP(
+                self.port, Site(MetricsResource(self.render)),
+                interface=self.host
+            )
+        except CannotListenError as e:
+            self.logger.warning('Metrics endpoint not started: %s', e)
+            return
+        self.logger.info(
+            'Metrics served at http://%s:%s/metrics', self.host, self.port
+        )
+
+    def spider_closed(self, spider):
+        if self.dump_task and self.dump_task.running:
+            self.dump_task.stop()
+        self.dump()
+        for name, (_, _, values) in self.registry.histograms.items():
+            for label_value, histogram in values.items():
+                summary = histogram.summary()
+                for key in ('count', 'avg', 'p95', 'max'):
+                    self.stats.set_value(
+                        f'metrics/{name}/{label_value}/{key}', summary[key]
+                    )
+        if self.listener:
+            return self.listener.stopListening()
+
+    def response_downloaded(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is None:
+            return
+        host = request.meta.get('download_slot') or \
+            urlparse_cached(request).hostname
+        self.registry.observe('download_latency_seconds', host, latency)
+
+    def item_scraped(self, item, response, spider):
+        self.registry.inc('items_scraped_total', type(item).__name__)
+
+    def callback_processed(self, response, spider, callback, elapsed,
+                           outputs):
+        self.registry.observe('callback_seconds', callback, elapsed)
+
+    def database_written(self, spider, record_type, records, flush_time,
+                         commit_time):
+        self.registry.observe('database_flush_seconds', record_type, flush_time)
+        self.registry.observe(
+            'database_commit_seconds', record_type, commit_time
+        )
+        self.registry.inc('database_records_total', record_type, records)
+
+    def render(self):
+        self._update_gauges()
+        return self.registry.render()
+
+    def dump(self):
+        """Update the items per second, log them with the queue depths and
+        write the metrics to `METRICS_DUMP_PATH`.
+        """
+        now = time.monotonic()
+        elapsed = now - (self.last_time or now)
+        items = dict(self.registry.counters['items_scraped_total'][2])
+        for _type, count in items.items():
+            self.registry.set(
+                'items_per_second', _type,
+                round((count - self.last_items.get(_type, 0)) / elapsed, 2)
+                if elapsed else 0
+            )
+        self.last_items, self.last_time = items, now
+        self._update_gauges()
+
+        rates = self.registry.gauges['items_per_second'][2]
+        queues = self.registry.gauges['queue_depth'][2]
+        self.logger.info(
+            'Metrics: %.1f items/s, queues: %s', sum(rates.values()),
+            ', '.join(f'{name}={depth}' for name, depth in queues.items())
+        )
+        if self.dump_path:
+            snapshot = dict(
+                self.registry.snapshot(), time=datetime.now().isoformat()
+            )
+            temporary = f'{self.dump_path}.tmp'
+            with open(temporary, 'w') as file:
+                json.dump(snapshot, file, indent=2)
+            os.replace(temporary, self.dump_path)
+
+    def _update_gauges(self):
+        engine = self.crawler.engine
+        for name in ('queue_depth', 'slot_queue_depth', 'slot_transferring',
+                     'stats'):
+            self.registry.clear_gauge(name)
+        for key, value in self.stats.get_stats().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.registry.set('stats', key, value)
+        if engine is None or engine.slot is None:
+            return
+
+        self.registry.set('queue_depth', 'scheduler', len(engine.slot.scheduler))
+        self.registry.set(
+            'queue_depth', 'downloader', len(engine.downloader.active)
+        )
+        for key, slot in engine.downloader.slots.items():
+            self.registry.set('slot_queue_depth', key, len(slot.queue))
+            self.registry.set('slot_transferring', key, len(slot.transferring))
+        scraper_slot = engine.scraper.slot
+        if scraper_slot is not None:
+            self.registry.set('queue_depth', 'responses', len(scraper_slot.queue))
+            self.registry.set(
+                'queue_depth', 'items', scraper_slot.itemproc_size
+            )
+        for pipeline in engine.scraper.itemproc.middlewares:
+            if hasattr(pipeline, 'queue_depth'):
+                self.registry.set(
+                    'queue_depth', type(pipeline).__name__,
+                    pipeline.queue_depth
+                )
+
+    def _wrap_pipelines(self):
+        """Replace the process_item of each pipeline by a timed version."""
+        wrap_process_item(
+            self.crawler.engine.scraper.itemproc,
+            lambda pipeline, method: self._timed_process_item(
+                type(pipeline).__name__, method
+            )
+        )
+
+    def _timed_process_item(self, name, process_item):
+        def timed(item, spider):
+            started = time.perf_counter()
+            try:
+                result = process_item(item, spider)
+            except Exception:
+                self._observe_pipeline(None, name, started)
+                raise
+            if isinstance(result, defer.Deferred):
+                return result.addBoth(self._observe_pipeline, name, started)
+            return self._observe_pipeline(result, name, started)
+        return timed
+
+    def _observe_pipeline(self, result, name, started):
+        self.registry.observe(
+            'pipeline_seconds', name, time.perf_counter() - started
+        )
+        return result
@@ -0,0 +1,84 @@
+"""HTTP cache for the responses that rarely change, see
+https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
+"""
+from time import time
+
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.extensions.httpcache import RFC2616Policy
+
+
+class EndpointCachePolicy(RFC2616Policy):
+    """Only caches the requests of the endpoints in `HTTPCACHE_ENDPOINT_TTL`
+    (`endpoint` meta key of the requests), each one fresh for its own number
+    of seconds regardless of the cache headers sent by the server. Stale
+    responses are revalidated with `If-None-Match`/`If-Modified-Since` when
+    the server sent an `ETag`/`Last-Modified`.
+
+    POST requests are cached too, their body is part of the request
+    fingerprint, so each asset has its own entry.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.endpoint_ttl = settings.getdict('HTTPCACHE_ENDPOINT_TTL')
+
+    def should_cache_request(self, request):
+        if request.meta.get('endpoint') not in self.endpoint_ttl:
+            return False
+        return super().should_cache_request(request)
+
+    def should_cache_response(self, response, request):
+        # Empty responses are what the server returns when overloaded.
+        if response.status != 200 or not response.body:
+            return False
+        return b'no-store' not in self._parse_cachecontrol(response)
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        ttl = self.endpoint_ttl.get(request.meta.get('endpoint'))
+        if ttl is None:
+            return super().is_cached_response_fresh(cachedresponse, request)
+        age = self._compute_current_age(cachedresponse, request, time())
+        if age < ttl:
+            return True
+        self._set_conditional_validators(request, cachedresponse)
+        return False
+
+
+class EndpointHttpCacheMiddleware(HttpCacheMiddleware):
+    """HttpCacheMiddleware that also reports the bytes that weren't
+    downloaded and the hit ratio of the cache.
+
+    Requests with `httpcache_refresh` in meta skip the cached response, but
+    the new response is stored. Used to retry cached responses that turned
+    out to be invalid.
+    """
+
+    def process_request(self, request, spider):
+        if request.meta.get('httpcache_refresh'):
+            self.stats.inc_value('httpcache/refresh')
+            return
+        response = super().process_request(request, spider)
+        if response is not None:
+            self.stats.inc_value('httpcache/bytes_saved', len(response.body))
+        return response
+
+    def process_response(self, request, response, spider):
+        result = super().process_response(request, response, spider)
+        if response.status == 304 and result is not response:
+            # Revalidated, the body came from the cache.
+            self.stats.inc_value('httpcache/bytes_saved', len(result.body))
+        return result
+
+    def spider_closed(self, spider):
+        stats = self.stats
+        hits = (
+            stats.get_value('httpcache/hit', 0) +
+            stats.get_value('httpcache/revalidate', 0)
+        )
+        lookups = (
+            hits + stats.get_value('httpcache/miss', 0) +
+            stats.get_value('httpcache/invalidate', 0)
+        )
+        if lookups:
+            stats.set_value('httpcache/hit_ratio', round(hits / lookups, 3))
+        super().spider_closed(spider)
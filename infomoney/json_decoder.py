@@ -0,0 +1,98 @@
+"""JSON decoding of the API responses.
+
+The decoder backend is set by `JSON_DECODER`: `json` (standard library),
+`orjson` or `auto` (orjson when installed). Large arrays can be parsed as a
+stream with ijson, yielding the rows as they're parsed instead of building the
+whole document in memory first.
+"""
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+
+class JsonDecoder:
+
+    def __init__(self, backend='auto', stream_min_size=0):
+        """
+        :param backend: Decoder used, `json`, `orjson` or `auto`.
+        :type backend: str
+        :param stream_min_size: Min size in bytes of the bodies parsed as a
+        stream, 0 disables streaming.
+        :type stream_min_size: int
+        """
+        if backend == 'auto':
+            backend = 'orjson' if orjson else 'json'
+        if backend == 'orjson':
+            if orjson is None:
+                raise ValueError('JSON_DECODER is orjson, but it isn\'t installed.')
+            self.loads = orjson.loads
+        elif backend == 'json':
+            self.loads = json.loads
+        else:
+            raise ValueError(f'Unknown JSON_DECODER: {backend}')
+        self.backend = backend
+
+        if stream_min_size and ijson is None:
+            logger.info(
+                'JSON_STREAM_MIN_SIZE is set, but ijson isn\'t installed. '
+                'Responses won\'t be parsed as a stream.'
+            )
+            stream_min_size = 0
+        self.stream_min_size = stream_min_size
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.get('JSON_DECODER', 'auto'),
+            stream_min_size=settings.getint('JSON_STREAM_MIN_SIZE', 0),
+        )
+
+    def decode(self, body):
+        """Decode the body of a response.
+        :raises ValueError: If the body isn't a valid JSON.
+        """
+        return self.loads(body)
+
+    def should_stream(self, body):
+        return bool(self.stream_min_size) and len(body) >= self.stream_min_size
+
+    def iter_array(self, body, key):
+        """Yield the rows of the array under `key` of a JSON object as they are
+        parsed. Nothing is yielded if the key doesn't exist.
+        :raises ValueError: If the body isn't a valid JSON.
+        """
+        try:
+            # Numbers as floats, same types returned by `decode`.
+            yield from ijson.items(body, f'{key}.item', use_float=True)
+        except ijson.JSONError as e:
+            raise ValueError(str(e)) from e
+
+    def find_key(self, body, key):
+        """Scan the top level of a valid JSON document, without building its
+        values, to tell why `iter_array` yielded no rows. Stops at the key.
+        :returns: Tuple with the document being empty (no members, or a false
+        value) and the key being found.
+        """
+        is_empty = True
+        for prefix, event, value in ijson.parse(body):
+            if prefix == '' and event == 'map_key':
+                if value == key:
+                    return False, True
+                is_empty = False
+            elif prefix == 'item' or (
+                prefix == '' and event in ('string', 'number', 'boolean')
+                and value
+            ):
+                is_empty = False
+        return is_empty, False
@@ -0,0 +1,255 @@
+"""Runs the spider in several processes, each one with its own reactor and
+pipelines, and merges their stats and the outcome of each asset in a single
+report.
+
+The assets given in `-a assets=` are split among the workers. Without assets
+the workers run in distributed mode (`-a distributed=True`), sharing a new
+work queue filled with all the assets of the listing.
+
+Usage: python -m infomoney.launcher -n 4 [-a assets=PETR4,VALE3] [-a ...]
+[-s SETTING=VALUE] [--report report.json]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+from collections import defaultdict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def split_assets(assets, workers):
+    """Split the assets among the workers, round robin.
+    :returns: List of asset lists, without the empty ones.
+    """
+    shares = [assets[i::workers] for i in range(workers)]
+    return [share for share in shares if share]
+
+
+def run_worker(index, spider_kwargs, settings_overrides, results):
+    """Run the spider in the current process and put its stats and the
+    outcome of each asset in the `results` queue.
+    """
+    from scrapy import signals
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    from infomoney.items import AssetPriceItem
+    from infomoney.spiders.infomoney_spider import InfomoneySpider
+
+    # Works outside the project directory too.
+    os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'infomoney.settings')
+    settings = get_project_settings()
+    settings.update(settings_overrides, priority='cmdline')
+    if settings.getbool('METRICS_ENABLED'):
+        # Each worker serves and dumps its own metrics.
+        if settings.getint('METRICS_PORT'):
+            settings.set('METRICS_PORT', settings.getint('METRICS_PORT') + index,
+                         priority='cmdline')
+        if settings.get('METRICS_DUMP_PATH'):
+            root, ext = os.path.splitext(settings.get('METRICS_DUMP_PATH'))
+            settings.set('METRICS_DUMP_PATH', f'{root}-{index}{ext}',
+                         priority='cmdline')
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(InfomoneySpider)
+
+    items = defaultdict(lambda: {'prices': 0, 'earnings': 0})
+
+    def item_scraped(item, response, spider):
+        _type = 'prices' if isinstance(item, AssetPriceItem) else 'earnings'
+        items[item['asset_code']][_type] += 1
+
+    crawler.signals.connect(item_scraped, signal=signals.item_scraped)
+    process.crawl(crawler, **spider_kwargs)
+    process.start()
+
+    assets = {}
+    requested = spider_kwargs.get('assets', '')
+    for code in filter(None, requested.split(',')):
+        assets[code] = {'prices': 0, 'earnings': 0}
+    assets.update(items)
+    for code, reason in crawler.spider.failed_assets.items():
+        assets.setdefault(code, {'prices': 0, 'earnings': 0})
+        assets[code]['failed'] = reason
+    results.put({
+        'worker': index,
+        'stats': {
+            key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in crawler.stats.get_stats().items()
+        },
+        'assets': assets,
+    })
+
+
+def merge_stats(all_stats):
+    """Merge the stats of the workers. Counters are summed, max/min values
+    keep the max/min, averages and ratios are averaged, start and finish
+    times keep the first and the last, the elapsed time the longest.
+    """
+    merged = {}
+    values = defaultdict(list)
+    for stats in all_stats:
+        for key, value in stats.items():
+            values[key].append(value)
+
+    for key, key_values in values.items():
+        numbers = [
+            v for v in key_values
+            if isinstance(v, (int, float)) and not isinstance(v, bool)
+        ]
+        if key == 'start_time':
+            merged[key] = min(key_values)
+        elif key == 'finish_time':
+            merged[key] = max(key_values)
+        elif len(numbers) != len(key_values):
+            merged[key] = sorted(set(map(str, key_values)))
+        elif 'max' in key or key == 'elapsed_time_seconds':
+            merged[key] = max(numbers)
+        elif 'min' in key:
+            merged[key] = min(numbers)
+        elif 'avg' in key or 'ratio' in key:
+            merged[key] = round(sum(numbers) / len(numbers), 3)
+        else:
+            merged[key] = sum(numbers)
+    return merged
+
+
+def launch(workers, spider_kwargs=None, settings_overrides=None):
+    """Run `workers` processes of the spider.
+    :param workers: Number of processes.
+    :type workers: int
+    :param spider_kwargs: Spider arguments, the `assets` are split among the
+    workers.
+    :type spider_kwargs: dict
+    :param settings_overrides: Settings applied to all the workers.
+    :type settings_overrides: dict
+    :returns: Report with the merged stats, the stats of each worker and the
+    outcome of each asset.
+    """
+    spider_kwargs = dict(spider_kwargs or {})
+    settings_overrides = dict(settings_overrides or {})
+    assets = [a for a in spider_kwargs.pop('assets', '').split(',') if a]
+
+    worker_args = []
+    queue_dir = None
+    if assets:
+        for share in split_assets(assets, workers):
+            worker_args.append(dict(spider_kwargs, assets=','.join(share)))
+    else:
+        # A new queue for each launch, not shared with other runs.
+        queue_dir = tempfile.mkdtemp(prefix='infomoney-queue-')
+        settings_overrides.setdefault(
+            'WORK_QUEUE_PATH', os.path.join(queue_dir, 'work_queue.sqlite3')
+        )
+        for index in range(workers):
+            worker_args.append(dict(
+                spider_kwargs, distributed='True', worker_id=f'worker-{index}'
+            ))
+
+    # spawn: each worker starts a clean interpreter and reactor.
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = []
+    for index, kwargs in enumerate(worker_args):
+        process = context.Process(
+            target=run_worker, args=(index, kwargs, settings_overrides, results)
+        )
+        process.start()
+        processes.append(process)
+    logger.info('Started %s worker(s).', len(processes))
+
+    reports = []
+    for process in processes:
+        # Read the results before joining, a full queue blocks the worker.
+        while process.is_alive() or not results.empty():
+            try:
+                reports.append(results.get(timeout=1))
+            except queue.Empty:
+                continue
+        process.join()
+        if process.exitcode:
+            logger.error(
+                'Worker %s exited with code %s.', process.pid,
+                process.exitcode
+            )
+    if queue_dir:
+        for filename in os.listdir(queue_dir):
+            os.remove(os.path.join(queue_dir, filename))
+        os.rmdir(queue_dir)
+
+    reports.sort(key=lambda report: report['worker'])
+    assets_outcome = {}
+    for report in reports:
+        assets_outcome.update(report['assets'])
+    return {
+        'workers': len(processes),
+        'failed_workers': len(processes) - len(reports),
+        'stats': merge_stats(report['stats'] for report in reports),
+        'worker_stats': [report['stats'] for report in reports],
+        'assets': dict(sorted(assets_outcome.items())),
+    }
+
+
+def _parse_pairs(pairs, option):
+    result = {}
+    for pair in pairs:
+        if '=' not in pair:
+            raise argparse.ArgumentTypeError(f'Invalid {option} {pair}')
+        key, value = pair.split('=', 1)
+        result[key] = value
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-n', '--workers', type=int, default=os.cpu_count(),
+        help='Number of processes, default to the number of CPUs.'
+    )
+    parser.add_argument(
+        '-a', dest='spider_args', action='append', default=[],
+        metavar='NAME=VALUE', help='Spider argument, may be repeated.'
+    )
+    parser.add_argument(
+        '-s', dest='settings', action='append', default=[],
+        metavar='NAME=VALUE', help='Setting override, may be repeated.'
+    )
+    parser.add_argument(
+        '--report', help='Write the report to this JSON file.'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    report = launch(
+        args.workers,
+        spider_kwargs=_parse_pairs(args.spider_args, '-a'),
+        settings_overrides=_parse_pairs(args.settings, '-s'),
+    )
+    outcomes = report['assets'].values()
+    failed = sum(1 for outcome in outcomes if 'failed' in outcome)
+    empty = sum(
+        1 for outcome in outcomes
+        if 'failed' not in outcome and not (
+            outcome['prices'] or outcome['earnings']
+        )
+    )
+    stats = report['stats']
+    logger.info(
+        'Workers: %s (%s failed). Assets: %s, %s failed, %s without data. '
+        'Items: %s. Requests: %s.', report['workers'],
+        report['failed_workers'], len(report['assets']), failed, empty,
+        stats.get('item_scraped_count', 0),
+        stats.get('downloader/request_count', 0)
+    )
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=1, default=str)
+        logger.info('Report written to %s', args.report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Histograms, counters and gauges recorded by the Metrics extension, exported
+in the Prometheus text format and as JSON.
+"""
+import bisect
+import math
+
+from twisted.web import resource
+
+# Upper bounds (seconds) of the latency buckets.
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+    5, 10, 30, 60,
+)
+
+
+class Histogram:
+    """Number of observations in each bucket, with their sum and max."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last one counts the values above the biggest bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Estimate of the quantile, interpolated inside its bucket.
+        :param q: Quantile, between 0 and 1.
+        :type q: float
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = min(self.buckets[i], self.max) \
+                    if i < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count else None,
+            'p50': _round(self.quantile(0.5)),
+            'p95': _round(self.quantile(0.95)),
+            'p99': _round(self.quantile(0.99)),
+            'max': round(self.max, 6),
+        }
+
+
+class MetricsRegistry:
+    """Metrics by name, each one with a single label (e.g. the host of the
+    download latency).
+    """
+
+    def __init__(self, prefix='infomoney'):
+        self.prefix = prefix
+        # Name: (help, label name, {label value: Histogram})
+        self.histograms = {}
+        # Name: (help, label name, {label value: number})
+        self.counters = {}
+        self.gauges = {}
+
+    def histogram(self, name, help_text, label):
+        self.histograms[name] = (help_text, label, {})
+
+    def counter(self, name, help_text, label):
+        self.counters[name] = (help_text, label, {})
+
+    def gauge(self, name, help_text, label):
+        self.gauges[name] = (help_text, label, {})
+
+    def observe(self, name, label_value, value):
+        values = self.histograms[name][2]
+        histogram = values.get(label_value)
+        if histogram is None:
+            histogram = values[label_value] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name, label_value, count=1):
+        values = self.counters[name][2]
+        values[label_value] = values.get(label_value, 0) + count
+
+    def set(self, name, label_value, value):
+        self.gauges[name][2][label_value] = value
+
+    def clear_gauge(self, name):
+        self.gauges[name][2].clear()
+
+    def render(self):
+        """Metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, (help_text, label, values) in self.counters.items():
+            lines.extend(self._header(name, help_text, 'counter'))
+            for label_value, value in _sorted(values):
+                lines.append(self._sample(name, label, label_value, value))
+        for name, (help_text, label, values) in self.gauges.items():
+            lines.extend(self._header(name, help_text, 'gauge'))
+            for label_value, value in _sorted(values):
+                lines.append(self._sample(name, label, label_value, value))
+        for name, (help_text, label, values) in self.histograms.items():
+            lines.extend(self._header(name, help_text, 'histogram'))
+            for label_value, histogram in _sorted(values):
+                cumulative = 0
+                for bound, count in zip(
+                        histogram.buckets + (math.inf,), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else repr(bound)
+                    lines.append(self._sample(
+                        f'{name}_bucket', label, label_value, cumulative,
+                        f',le="{le}"'
+                    ))
+                lines.append(self._sample(
+                    f'{name}_sum', label, label_value, histogram.sum
+                ))
+                lines.append(self._sample(
+                    f'{name}_count', label, label_value, histogram.count
+                ))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Current values, histograms summarized by their quantiles."""
+        return {
+            'counters': {
+                name: dict(values)
+                for name, (_, _, values) in self.counters.items()
+            },
+            'gauges': {
+                name: dict(values)
+                for name, (_, _, values) in self.gauges.items()
+            },
+            'histograms': {
+                name: {
+                    label_value: histogram.summary()
+                    for label_value, histogram in values.items()
+                }
+                for name, (_, _, values) in self.histograms.items()
+            },
+        }
+
+    def _header(self, name, help_text, _type):
+        return [
+            f'# HELP {self.prefix}_{name} {help_text}',
+            f'# TYPE {self.prefix}_{name} {_type}',
+        ]
+
+    def _sample(self, name, label, label_value, value, extra_labels=''):
+        label_value = str(label_value).replace('\\', '\\\\').replace('"', '\\"')
+        return (
+            f'{self.prefix}_{name}{{{label}="{label_value}"{extra_labels}}} '
+            f'{value}'
+        )
+
+
+class MetricsResource(resource.Resource):
+    """Serves the metrics in the Prometheus text format, in any path."""
+    isLeaf = True
+
+    def __init__(self, render_metrics):
+        super().__init__()
+        self.render_metrics = render_metrics
+
+    def render_GET(self, request):
+        request.setHeader(
+            'Content-Type', 'text/plain; version=0.0.4; charset=utf-8'
+        )
+        return self.render_metrics().encode()
+
+
+def _sorted(values):
+    return sorted(values.items(), key=lambda item: str(item[0]))
+
+
+def _round(value):
+    return None if value is None else round(value, 6)
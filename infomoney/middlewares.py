@@ -3,7 +3,19 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import logging
+import os
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
 from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+
+from infomoney.profiling import ComponentProfiler
+from infomoney.signals import callback_processed
+from infomoney.utils import wrap_process_item
 
 
 class InfomoneySpiderMiddleware:
@@ -98,3 +110,168 @@ class InfomoneyDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class HostOverrideMiddleware:
+    """Sends the requests to the servers in `INFOMONEY_HOST_OVERRIDES` using
+    the download slot of the original host, so the slots and their settings
+    are the same as when crawling Infomoney.
+    """
+
+    def __init__(self, overrides):
+        # Overridden network location: original host, None when shared by
+        # more than one host.
+        self.slots = {}
+        for host, base in overrides.items():
+            netloc = urlsplit(base).netloc
+            self.slots[netloc] = None if netloc in self.slots else host
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        overrides = crawler.settings.getdict('INFOMONEY_HOST_OVERRIDES')
+        if not overrides:
+            raise NotConfigured
+        return cls(overrides)
+
+    def process_request(self, request, spider):
+        slot = self.slots.get(urlparse_cached(request).netloc)
+        if slot and 'download_slot' not in request.meta:
+            request.meta['download_slot'] = slot
+
+
+class CallbackTimingMiddleware:
+    """Measures the time spent in the spider callbacks, sent with the
+    `callback_processed` signal. Must be the spider middleware closest to the
+    spider, so only the callback runs while its output is consumed.
+    """
+
+    def __init__(self, crawler):
+        self.signals = crawler.signals
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider):
+        callback = response.request.callback or spider.parse
+        elapsed = 0.0
+        outputs = 0
+        iterator = iter(result)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    output = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - started
+                outputs += 1
+                yield output
+        finally:
+            self.signals.send_catch_log(
+                signal=callback_processed, response=response, spider=spider,
+                callback=getattr(callback, '__name__', str(callback)),
+                elapsed=elapsed, outputs=outputs,
+            )
+
+
+class ProfilingMiddleware:
+    """Profiles the spider callbacks, the process_item of each pipeline and
+    the work of the pipelines' writer threads with cProfile when the spider
+    runs with `-a profile=True`. Not loaded without the argument, so it adds
+    no overhead. The reports are written to a new folder in
+    `PROFILE_OUTPUT_DIR` when the spider closes.
+    """
+
+    def __init__(self, crawler, output_dir, limit=50):
+        self.logger = logging.getLogger(__name__)
+        self.crawler = crawler
+        self.output_dir = output_dir
+        self.limit = limit
+        self.profiler = ComponentProfiler()
+        # Codes of the assets whose responses were profiled.
+        self.assets = set()
+        self.started = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not getattr(crawler.spider, 'profile', None) == 'True':
+            raise NotConfigured
+        mw = cls(
+            crawler,
+            output_dir=crawler.settings.get('PROFILE_OUTPUT_DIR', 'profiles'),
+            limit=crawler.settings.getint('PROFILE_REPORT_LIMIT', 50),
+        )
+        crawler.signals.connect(mw.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
+        return mw
+
+    def process_spider_output(self, response, result, spider):
+        callback = response.request.callback or spider.parse
+        name = f'callback.{getattr(callback, "__name__", callback)}'
+        code = response.request.cb_kwargs.get('code')
+        if code:
+            self.assets.add(code)
+        iterator = iter(result)
+        while True:
+            profile = self.profiler.enable(name)
+            try:
+                output = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                self.profiler.disable(profile)
+            yield output
+
+    def spider_opened(self, spider):
+        self.started = datetime.now()
+        itemproc = self.crawler.engine.scraper.itemproc
+        wrap_process_item(itemproc, lambda pipeline, method: self.profiler.wrap(
+            f'pipeline.{type(pipeline).__name__}', method
+        ))
+        for pipeline in itemproc.middlewares:
+            # Writes of the pipelines running in their own thread pool.
+            pool = getattr(pipeline, 'writer_pool', None)
+            if pool is not None:
+                pool.callInThreadWithCallback = self._profiled_pool_call(
+                    f'writer.{type(pipeline).__name__}',
+                    pool.callInThreadWithCallback
+                )
+        self.logger.info(
+            'Profiling the callbacks and pipelines, the reports will be '
+            'written to %s.', self.output_dir
+        )
+
+    def spider_closed(self, spider, reason):
+        started = self.started or datetime.now()
+        directory = os.path.join(
+            self.output_dir,
+            f'{spider.name}-{started:%Y%m%d-%H%M%S}-{os.getpid()}'
+        )
+        tags = {
+            'spider': spider.name,
+            'arguments': getattr(spider, 'arguments', {}),
+            'assets': len(self.assets),
+            'started': started.isoformat(),
+            'reason': reason,
+        }
+        self.profiler.write_reports(directory, tags, self.limit)
+        if self.profiler.skipped:
+            self.logger.warning(
+                'Another profiler was active, %s runs were not profiled.',
+                self.profiler.skipped
+            )
+        self.logger.info(
+            'Profiles of %s components written to %s.',
+            len(self.profiler.profiles), directory
+        )
+
+    def _profiled_pool_call(self, name, call_in_thread):
+        def call(on_result, func, *args, **kwargs):
+            return call_in_thread(
+                on_result, self.profiler.wrap(name, func), *args, **kwargs
+            )
+        return call
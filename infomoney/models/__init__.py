@@ -7,7 +7,12 @@ from .earnings import AssetEarningsModel
 from .price import AssetPriceModel
 
 
-engine = create_engine(DATABASE_URI, echo=SHOW_SQL_STATEMENTS)
+# Without a database configured StoreInDatabasePipeline disables itself, the
+# engine is only created when there is an URI.
+engine = (
+    create_engine(DATABASE_URI, echo=SHOW_SQL_STATEMENTS)
+    if DATABASE_URI else None
+)
 session_factory = sessionmaker(bind=engine)
 Session = scoped_session(session_factory)
 
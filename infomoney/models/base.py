@@ -1,7 +1,14 @@
-from sqlalchemy import Column, DateTime, Integer
+from sqlalchemy import Column, DateTime, Integer, LargeBinary
+from sqlalchemy.dialects.mysql import BINARY
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 
+# MD5 digest used as unique identifier. MySQL/MariaDB can't have unique BLOB
+# columns, a fixed size BINARY is used instead.
+Digest = LargeBinary(16) \
+    .with_variant(BINARY(16), 'mysql') \
+    .with_variant(BINARY(16), 'mariadb')
+
 
 class Base(object):
     id = Column(Integer, primary_key=True)
@@ -1,12 +1,21 @@
-from sqlalchemy import Column, DateTime, Numeric, String
+from sqlalchemy import (
+    Column, DateTime, Index, Numeric, String, UniqueConstraint
+)
 
-from .base import Base
+from .base import Base, Digest
 
 
 class AssetEarningsModel(Base):
     __tablename__ = 'assets_earnings'
+    __table_args__ = (
+        UniqueConstraint('_id', name='uq_assets_earnings__id'),
+        Index(
+            'ix_assets_earnings_asset_code_date_of_payment',
+            'asset_code', 'date_of_payment'
+        ),
+    )
 
-    _id = Column(String(32), nullable=False, unique=True)  # Prevent duplicates
+    _id = Column(Digest, nullable=False)  # Prevent duplicates
     asset_code = Column(String(10), nullable=False)
     type = Column(String, nullable=False)
     value = Column(Numeric(scale=3))
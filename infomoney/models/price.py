@@ -1,12 +1,19 @@
-from sqlalchemy import Column, DateTime, Numeric, String, TIMESTAMP
+from sqlalchemy import (
+    Column, DateTime, Index, Numeric, String, TIMESTAMP, UniqueConstraint
+)
 
-from .base import Base
+from .base import Base, Digest
 
 
 class AssetPriceModel(Base):
     __tablename__ = 'assets_prices'
+    __table_args__ = (
+        UniqueConstraint('_id', name='uq_assets_prices__id'),
+        # History of an asset and last date stored of each asset
+        Index('ix_assets_prices_asset_code_date', 'asset_code', 'date'),
+    )
 
-    _id = Column(String(32), nullable=False, unique=True)  # Prevent duplicates
+    _id = Column(Digest, nullable=False)  # Prevent duplicates
     asset_code = Column(String(10), nullable=False)
     date = Column(DateTime, nullable=False)
     timestamp = Column(TIMESTAMP)
@@ -1,10 +1,12 @@
 from .datetime_enforcing_pipeline import DatetimeEnforcementPipeline
 from .csv_pipeline import SplitInCSVsPipeline
+from .parquet_pipeline import PartitionedParquetPipeline
 from .sql_pipeline import StoreInDatabasePipeline
 
 
 __all__ = [
     'DatetimeEnforcementPipeline',
+    'PartitionedParquetPipeline',
     'SplitInCSVsPipeline',
     'StoreInDatabasePipeline'
 ]
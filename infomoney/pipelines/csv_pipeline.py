@@ -1,34 +1,70 @@
+import csv
 import logging
 import os
+from collections import OrderedDict
+from datetime import datetime
 
 from scrapy.exceptions import NotConfigured
 from scrapy.exporters import CsvItemExporter
 
 from infomoney.items import AssetEarningsItem, AssetPriceItem
+from infomoney.utils import read_csv_edges
 
 
 class SplitInCSVsPipeline:
-    def __init__(self, file_directory):
+    def __init__(self, file_directory, append_mode=False, max_open_files=0):
         self.logger = logging.getLogger(__name__)
         self.file_directory = file_directory
+        self.append_mode = append_mode
+        self.max_open_files = max_open_files
         self.asset_exporters = {
             'earnings': {},
             'price': {},
         }
+        self.last_exported_dates = {}
+        # Keys of the earnings already in the files, only in append mode.
+        self.exported_earnings = {}
+        # Open files in least recently used order, mapped by (type, code).
+        self.open_files = OrderedDict()
+        # Columns of the files closed before the end of the spider.
+        self.closed_exporters = {}
 
     @classmethod
     def from_crawler(cls, crawler):
         settings = crawler.settings
         if not settings.get('FILES_STORAGE_PATH'):
             raise NotConfigured('CSV storage directory is not configured.')
-        return cls(settings.get('FILES_STORAGE_PATH'))
+        return cls(
+            settings.get('FILES_STORAGE_PATH'),
+            append_mode=settings.getbool('FILES_APPEND_MODE'),
+            max_open_files=settings.getint('FILES_MAX_OPEN'),
+        )
+
+    def open_spider(self, spider):
+        # Incremental runs only request the latest prices, overwriting the
+        # files would discard the history.
+        if getattr(spider, 'incremental', None) == 'True':
+            self.append_mode = True
 
     def process_item(self, item, spider):
         filename = self._get_filename(spider, item)
         if isinstance(item, AssetPriceItem):
-            exporter = self._process_price_item(item, filename)
+            exporter = self._process_price_item(item, filename, spider)
+            last_date = self.last_exported_dates.get(item['asset_code'])
+            if last_date and item['date'] <= last_date:
+                spider.crawler.stats.inc_value('dropped/csv/price/duplicated')
+                return item
         elif isinstance(item, AssetEarningsItem):
-            exporter = self._process_earnings_item(item, filename)
+            exporter = self._process_earnings_item(item, filename, spider)
+            exported = self.exported_earnings.get(item['asset_code'])
+            if exported is not None:
+                key = self._get_earnings_key(item)
+                if key in exported:
+                    spider.crawler.stats.inc_value(
+                        'dropped/csv/earnings/duplicated'
+                    )
+                    return item
+                exported.add(key)
         else:
             return item
         exporter.export_item(item)
@@ -36,30 +72,132 @@ class SplitInCSVsPipeline:
 
     def close_spider(self, spider):
         """Signal end of exporting process for all exporters."""
-        for price_exporter in self.asset_exporters['price'].values():
-            price_exporter.finish_exporting()
-        for earnings_exporter in self.asset_exporters['earnings'].values():
-            earnings_exporter.finish_exporting()
+        for _type, code in list(self.open_files):
+            self._close_exporter(_type, code)
 
-    def _process_price_item(self, item, filename):
+    def _process_price_item(self, item, filename, spider):
         """Instantiate and store the price exporters for each asset code."""
         code = item['asset_code']
         if code not in self.asset_exporters['price']:
-            file = open(filename, 'wb')
-            exporter = CsvItemExporter(file)
-            exporter.start_exporting()
-            self.asset_exporters['price'][code] = exporter
-        return self.asset_exporters['price'][code]
+            if ('price', code) in self.closed_exporters:
+                exporter = self._reopen_file('price', code, filename, spider)
+            elif self.append_mode:
+                exporter = self._append_to_file(code, filename)
+            else:
+                file = open(filename, 'wb')
+                exporter = CsvItemExporter(file)
+            self._add_exporter('price', code, exporter, spider)
+        return self._get_exporter('price', code)
+
+    def _append_to_file(self, code, filename):
+        """Instantiate an exporter that appends to the existing file, keeping
+        its columns and without repeating the header. Only the tail of the file
+        is read to find the last exported date.
+        """
+        header, last_row = read_csv_edges(filename)
+        if not header:
+            return CsvItemExporter(open(filename, 'wb'))
 
-    def _process_earnings_item(self, item, filename):
+        if last_row and 'date' in header:
+            self.last_exported_dates[code] = datetime.fromisoformat(
+                last_row[header.index('date')]
+            )
+        self.logger.debug(
+            'Appending to %s, last exported date: %s',
+            filename, self.last_exported_dates.get(code)
+        )
+        return CsvItemExporter(
+            open(filename, 'ab'),
+            include_headers_line=False,
+            fields_to_export=header,
+        )
+
+    def _process_earnings_item(self, item, filename, spider):
         """Instantiate and store the earnings exporters for each asset code."""
         code = item['asset_code']
         if code not in self.asset_exporters['earnings']:
-            file = open(filename, 'wb')
-            exporter = CsvItemExporter(file)
-            exporter.start_exporting()
-            self.asset_exporters['earnings'][code] = exporter
-        return self.asset_exporters['earnings'][code]
+            if ('earnings', code) in self.closed_exporters:
+                exporter = self._reopen_file(
+                    'earnings', code, filename, spider
+                )
+            elif self.append_mode:
+                exporter = self._append_earnings_to_file(code, filename)
+            else:
+                file = open(filename, 'wb')
+                exporter = CsvItemExporter(file)
+            self._add_exporter('earnings', code, exporter, spider)
+        return self._get_exporter('earnings', code)
+
+    def _append_earnings_to_file(self, code, filename):
+        """Instantiate an exporter that appends to the existing earnings file.
+        The earnings aren't ordered by a single date, so the whole file (a
+        few rows by year) is read to know which records it already has.
+        """
+        exported = self.exported_earnings[code] = set()
+        if not os.path.exists(filename):
+            return CsvItemExporter(open(filename, 'wb'))
+
+        with open(filename, newline='', encoding='utf-8') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                exported.add(self._get_earnings_key(row))
+        if not reader.fieldnames:
+            return CsvItemExporter(open(filename, 'wb'))
+
+        self.logger.debug(
+            'Appending to %s, %s earnings already exported.',
+            filename, len(exported)
+        )
+        return CsvItemExporter(
+            open(filename, 'ab'),
+            include_headers_line=False,
+            fields_to_export=reader.fieldnames,
+        )
+
+    def _get_earnings_key(self, values):
+        """Identify an earnings record, same fields of its database `_id`."""
+        date = values.get('date_of_approval') or values.get('date_of_payment')
+        return values.get('type'), str(date) if date else None
+
+    def _get_exporter(self, _type, code):
+        """Return an open exporter, marking it as the most recently used."""
+        self.open_files.move_to_end((_type, code))
+        return self.asset_exporters[_type][code]
+
+    def _add_exporter(self, _type, code, exporter, spider):
+        """Start the exporter and close the least recently used ones if the
+        number of open files is above the limit.
+        """
+        exporter.start_exporting()
+        self.asset_exporters[_type][code] = exporter
+        self.open_files[(_type, code)] = exporter.stream.buffer
+        spider.crawler.stats.inc_value('csv/files/opened')
+
+        while self.max_open_files and len(self.open_files) > self.max_open_files:
+            lru_type, lru_code = next(iter(self.open_files))
+            self._close_exporter(lru_type, lru_code)
+            spider.crawler.stats.inc_value('csv/files/evicted')
+
+    def _close_exporter(self, _type, code):
+        """Finish the exporter and close its file, keeping the columns in case
+        the file is reopened.
+        """
+        exporter = self.asset_exporters[_type].pop(code)
+        exporter.finish_exporting()
+        self.open_files.pop((_type, code)).close()
+        self.closed_exporters[(_type, code)] = exporter.fields_to_export
+
+    def _reopen_file(self, _type, code, filename, spider):
+        """Instantiate an exporter to continue writing a file closed during
+        this execution, the header was already written.
+        """
+        fields = self.closed_exporters.pop((_type, code))
+        spider.crawler.stats.inc_value('csv/files/reopened')
+        return CsvItemExporter(
+            open(filename, 'ab'),
+            include_headers_line=fields is None,
+            fields_to_export=fields,
+        )
 
     def _get_filename(self, spider, item):
         """Determine the name of the CSV file depending on the data being
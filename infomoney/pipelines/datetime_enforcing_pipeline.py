@@ -1,5 +1,6 @@
 import re
 from datetime import datetime
+from functools import lru_cache
 
 from infomoney.items import AssetEarningsItem, AssetPriceItem
 
@@ -10,6 +11,16 @@ class DatetimeEnforcementPipeline:
     returns earnings with %d/%m/%y and price with %d/%m/%Y.
     """
 
+    def __init__(self, cache_size=8192):
+        # The same dates repeat across all the assets, parsed values are cached
+        self.cached_parse_date = lru_cache(maxsize=cache_size)(
+            self._parse_date
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.getint('DATE_PARSE_CACHE_SIZE', 8192))
+
     def process_item(self, item, spider):
         if isinstance(item, AssetPriceItem):
             date = self.parse_date(item['date'])
@@ -28,10 +39,41 @@ class DatetimeEnforcementPipeline:
                 )
         return item
 
+    def close_spider(self, spider):
+        cache_info = self.cached_parse_date.cache_info()
+        spider.crawler.stats.set_value('datetime/cache/hits', cache_info.hits)
+        spider.crawler.stats.set_value(
+            'datetime/cache/misses', cache_info.misses
+        )
+
     def parse_date(self, date):
+        return self.cached_parse_date(date)
+
+    def _parse_date(self, date):
+        """Parse the date by its shape, each format returned by the source has
+        a fixed length and separators. Unexpected shapes are parsed by
+        `_parse_date_fallback`.
+        """
         if date == 'n/d':
             return
 
+        day, month, year = date[:2], date[3:5], None
+        if date[2:3] == '/' and date[5:6] == '/':
+            if len(date) == 10:  # Prices, %d/%m/%Y
+                year = date[6:]
+            elif len(date) == 8 and date[6:].isdigit():  # Earnings, %d/%m/%y
+                # Same pivot year used by strptime's %y
+                year = int(date[6:])
+                year = str(year + (2000 if year < 69 else 1900))
+        elif date[2:3] == '-' and date[5:6] == '-' and date[10:11] == 'T':
+            if date[6:8] == '20':  # FIIs, %d-%m-%YT%H:%M:%S
+                year = date[6:10]
+
+        if year and day.isdigit() and month.isdigit() and year.isdigit():
+            return datetime(int(year), int(month), int(day))
+        return self._parse_date_fallback(date)
+
+    def _parse_date_fallback(self, date):
         t_format = re.search(r'(\d{2})-(\d{2})-(20\d{2})T', date)
         if t_format:
             day, month, year = t_format.groups()
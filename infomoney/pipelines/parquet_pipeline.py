@@ -0,0 +1,229 @@
+import glob
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+
+from scrapy.exceptions import NotConfigured
+
+from infomoney.items import AssetEarningsItem, AssetPriceItem
+from infomoney.utils import parse_volume
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+class PartitionedParquetPipeline:
+    """Stores price and earnings data in typed Parquet files, partitioned by
+    asset code and year (hive style):
+    `{PARQUET_STORAGE_PATH}/prices/asset_code=PETR4/year=2022/data.parquet`
+
+    Rows are buffered in memory, each flush writes them to a new fragment
+    file of the partition. When the spider closes, the fragments of each
+    partition are merged with its existing rows into the data file, written
+    in row groups, records with the same key are replaced by the most recent
+    data. A partition is rewritten once by execution, not once by flush.
+    """
+    data_file = 'data.parquet'
+    # Readers (pyarrow.dataset, etc.) ignore files starting with "_", the
+    # fragments are only visible once merged into the data file.
+    fragment_prefix = '_fragment-'
+
+    def __init__(self, directory, row_group_size, max_buffered_rows):
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.max_buffered_rows = max_buffered_rows
+        self.buffered_rows = 0
+        # Buffered rows mapped by (type, asset code, year)
+        self.partitions = defaultdict(list)
+        # Partitions with fragments written in this execution
+        self.fragmented = set()
+        self.schemas = {
+            'prices': pa.schema([
+                ('date', pa.timestamp('s')),
+                ('timestamp', pa.timestamp('s')),
+                ('open', pa.decimal128(18, 2)),
+                ('high', pa.decimal128(18, 2)),
+                ('low', pa.decimal128(18, 2)),
+                ('close', pa.decimal128(18, 2)),
+                ('volume', pa.int64()),
+                ('variation', pa.decimal128(18, 2)),
+            ]),
+            'earnings': pa.schema([
+                ('type', pa.string()),
+                ('value', pa.decimal128(18, 3)),
+                ('pct_factor', pa.decimal128(18, 3)),
+                ('emission_value', pa.decimal128(18, 3)),
+                ('date_of_approval', pa.timestamp('s')),
+                ('date_of_record', pa.timestamp('s')),
+                ('date_of_payment', pa.timestamp('s')),
+            ]),
+        }
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if pa is None:
+            raise NotConfigured('pyarrow is required to export Parquet files.')
+        if not settings.get('PARQUET_STORAGE_PATH'):
+            raise NotConfigured('Parquet storage directory is not configured.')
+        return cls(
+            settings.get('PARQUET_STORAGE_PATH'),
+            row_group_size=settings.getint('PARQUET_ROW_GROUP_SIZE'),
+            max_buffered_rows=settings.getint('PARQUET_MAX_BUFFERED_ROWS'),
+        )
+
+    def process_item(self, item, spider):
+        if isinstance(item, AssetPriceItem):
+            _type, row = 'prices', self._build_price_row(item)
+            year = item['date'].year
+        elif isinstance(item, AssetEarningsItem):
+            _type, row = 'earnings', self._build_earnings_row(item)
+            date = (
+                item.get('date_of_payment') or item.get('date_of_approval') or
+                item.get('date_of_record')
+            )
+            year = date.year if date else None
+        else:
+            return item
+
+        self.partitions[(_type, item['asset_code'], year)].append(row)
+        self.buffered_rows += 1
+        if self.buffered_rows >= self.max_buffered_rows:
+            self.flush(spider)
+        return item
+
+    def close_spider(self, spider):
+        self.flush(spider)
+        for _type, code, year in sorted(
+            self.fragmented, key=lambda partition: str(partition)
+        ):
+            self._compact_partition(_type, code, year)
+            spider.crawler.stats.inc_value(f'parquet/{_type}/partitions')
+        self.fragmented.clear()
+
+    def flush(self, spider):
+        """Write all the buffered partitions to new fragment files."""
+        partitions, self.partitions = self.partitions, defaultdict(list)
+        self.buffered_rows = 0
+        for (_type, code, year), rows in partitions.items():
+            self._write_fragment(_type, code, year, rows)
+            self.fragmented.add((_type, code, year))
+            spider.crawler.stats.inc_value(f'parquet/{_type}/rows', len(rows))
+            spider.crawler.stats.inc_value(f'parquet/{_type}/fragments')
+
+    def _write_fragment(self, _type, code, year, rows):
+        """Write the rows to a new file of the partition, only the rows of
+        this flush are written.
+        """
+        directory = self._get_partition_dir(_type, code, year)
+        os.makedirs(directory, exist_ok=True)
+        # Nanoseconds, the fragments are merged in the order they're written,
+        # also the ones left by an interrupted execution.
+        filename = os.path.join(
+            directory, f'{self.fragment_prefix}{time.time_ns():020d}.parquet'
+        )
+        self._write_table(_type, self._merge_rows(_type, [rows]), filename)
+        self.logger.debug('Wrote %s rows to %s.', len(rows), filename)
+
+    def _compact_partition(self, _type, code, year):
+        """Merge the fragments with the rows already stored in the partition
+        and rewrite its data file. Partitions hold a single asset/year, so
+        they're small enough to be rewritten once by execution.
+        """
+        directory = self._get_partition_dir(_type, code, year)
+        filename = os.path.join(directory, self.data_file)
+        fragments = sorted(glob.glob(
+            os.path.join(directory, f'{self.fragment_prefix}*.parquet')
+        ))
+        schema = self.schemas[_type]
+        files = [filename] if os.path.exists(filename) else []
+        rows = self._merge_rows(_type, (
+            pq.read_table(file, schema=schema).to_pylist()
+            for file in files + fragments
+        ))
+        self._write_table(_type, rows, filename)
+        for fragment in fragments:
+            os.remove(fragment)
+        self.logger.debug(
+            'Wrote %s rows to %s (%s fragments merged).',
+            len(rows), filename, len(fragments)
+        )
+
+    def _merge_rows(self, _type, groups):
+        """Merge the groups of rows, the last row of each key is kept, sorted
+        by date.
+        """
+        get_key = self._get_price_key if _type == 'prices' \
+            else self._get_earnings_key
+        merged = {}
+        for rows in groups:
+            for row in rows:
+                merged[get_key(row)] = row
+
+        sort_field = 'date' if _type == 'prices' else 'date_of_payment'
+        return sorted(
+            merged.values(), key=lambda r: r[sort_field] or datetime.min
+        )
+
+    def _write_table(self, _type, rows, filename):
+        table = pa.Table.from_pylist(rows, schema=self.schemas[_type])
+        # Write to a temporary file, a failure won't corrupt the partition.
+        temp_filename = filename + '.tmp'
+        pq.write_table(table, temp_filename, row_group_size=self.row_group_size)
+        os.replace(temp_filename, filename)
+
+    def _get_partition_dir(self, _type, code, year):
+        return os.path.join(
+            self.directory, _type, f'asset_code={code}',
+            f'year={year if year is not None else "__HIVE_DEFAULT_PARTITION__"}'
+        )
+
+    def _build_price_row(self, item):
+        timestamp = item.get('timestamp')
+        return {
+            'date': item['date'],
+            'timestamp': (
+                datetime.fromtimestamp(int(timestamp), timezone.utc)
+                .replace(tzinfo=None) if timestamp else None
+            ),
+            'open': self._to_decimal(item.get('open'), 2),
+            'high': self._to_decimal(item.get('high'), 2),
+            'low': self._to_decimal(item.get('low'), 2),
+            'close': self._to_decimal(item.get('close'), 2),
+            'volume': parse_volume(item.get('volume')),
+            'variation': self._to_decimal(item.get('variation'), 2),
+        }
+
+    def _build_earnings_row(self, item):
+        return {
+            'type': item['type'],
+            'value': self._to_decimal(item.get('value'), 3),
+            'pct_factor': self._to_decimal(item.get('pct_factor'), 3),
+            'emission_value': self._to_decimal(item.get('emission_value'), 3),
+            'date_of_approval': item.get('date_of_approval'),
+            'date_of_record': item.get('date_of_record'),
+            'date_of_payment': item.get('date_of_payment'),
+        }
+
+    def _get_price_key(self, row):
+        return row['date']
+
+    def _get_earnings_key(self, row):
+        # Same fields used to identify the earnings in StoreInDatabasePipeline
+        return row['type'], row['date_of_approval'] or row['date_of_payment']
+
+    def _to_decimal(self, value, scale):
+        """Convert the value to a Decimal with a fixed number of places."""
+        if value is None or value == '':
+            return
+        try:
+            return Decimal(str(value)).quantize(Decimal(1).scaleb(-scale))
+        except InvalidOperation:
+            return
@@ -0,0 +1,90 @@
+import sys
+
+
+class ExistingRecordsIndex:
+    """In-memory index of the `_id`s already stored in a table, used to reject
+    duplicated records without querying the database.
+
+    The index may be limited to a group of assets and/or a date window, records
+    outside of it can't be resolved in memory and must be checked in the DB.
+    """
+
+    def __init__(self, model, date_field=None):
+        """
+        :param model: Model class mapped to the indexed table.
+        :type model: AssetEarningsModel or AssetPriceModel
+        :param date_field: Field used to limit the index to a date window.
+        :type date_field: str
+        """
+        self.model = model
+        self.date_field = date_field
+        self.ids = set()
+        self.assets = None
+        self.start_date = None
+        self.end_date = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self, session, assets=None, start_date=None, end_date=None):
+        """Load the `_id`s stored in the database into memory.
+        :param session: Database session.
+        :type session: SQLAlchemy Session object.
+        :param assets: Limits the index to these asset codes.
+        :type assets: List[str]
+        :param start_date: Limits the index to records after this date.
+        :type start_date: datetime
+        :param end_date: Limits the index to records before this date.
+        :type end_date: datetime
+        """
+        query = session.query(self.model._id)
+        if assets:
+            self.assets = frozenset(assets)
+            query = query.filter(self.model.asset_code.in_(self.assets))
+        if self.date_field:
+            date_column = getattr(self.model, self.date_field)
+            if start_date:
+                self.start_date = start_date
+                query = query.filter(date_column >= start_date)
+            if end_date:
+                self.end_date = end_date
+                query = query.filter(date_column <= end_date)
+
+        self.ids = {self._key(_id) for _id, in query.yield_per(10000)}
+
+    def covers(self, record):
+        """Check if the record is within the assets and dates loaded, so its
+        absence from the index means it isn't stored in the database.
+        """
+        if self.assets is not None and record['asset_code'] not in self.assets:
+            return False
+        if self.date_field and (self.start_date or self.end_date):
+            date = record.get(self.date_field)
+            if not date:
+                return False
+            if self.start_date and date < self.start_date:
+                return False
+            if self.end_date and date > self.end_date:
+                return False
+        return True
+
+    def lookup(self, _id, record):
+        """Returns True if the record is stored, False if it isn't and None if
+        the index can't tell.
+        """
+        if self._key(_id) in self.ids:
+            return True
+        if self.covers(record):
+            return False
+        return None
+
+    def add(self, _id):
+        self.ids.add(self._key(_id))
+
+    def memory_usage(self):
+        """Approximate number of bytes used by the index."""
+        return sys.getsizeof(self.ids) + sum(map(sys.getsizeof, self.ids))
+
+    def _key(self, _id):
+        # Some drivers return binary columns as memoryview/bytearray.
+        return bytes(_id)
@@ -2,42 +2,179 @@ from datetime import datetime
 from decimal import Decimal
 import hashlib
 import logging
+import time
 
 from scrapy.exceptions import NotConfigured
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from sqlalchemy.exc import SQLAlchemyError, StatementError
 from sqlalchemy.orm import scoped_session
+from sqlalchemy.sql import func
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.threadpool import ThreadPool
 
 from infomoney.models import (
     session_factory, AssetEarningsModel, AssetPriceModel
 )
 from infomoney.items import AssetEarningsItem, AssetPriceItem
+from infomoney.signals import database_written
+from .record_index import ExistingRecordsIndex
 
 
 class StoreInDatabasePipeline:
-    def __init__(self):
+    """Stores the items in the database. Queries and commits run in a
+    dedicated writer thread, the items wait in a bounded queue, so a slow
+    database doesn't block the downloads.
+    """
+    # Max number of bound parameters used in a single "IN" clause, keeps the
+    # queries under the variables limit of older SQLite versions.
+    in_clause_chunk_size = 500
+    # Columns that are never overwritten when a record is updated.
+    immutable_columns = ('id', '_id', 'created_at')
+
+    def __init__(self, batch_size=1, flush_interval=0, preload_ids=False,
+                 queue_size=1000):
         self.logger = logging.getLogger(__name__)
+        # Only used from the writer thread, the session is thread local.
         self.session = scoped_session(session_factory)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_task = None
+        self.pending = {
+            'earnings': {},
+            'price': {},
+        }
+        self.preload_ids = preload_ids
+        self.indexes = {}
+        # Single thread, the records are written in the order they arrive.
+        self.writer_pool = ThreadPool(1, 1, name='database-writer')
+        # Items waiting for the writer, process_item waits when it's full.
+        self.queue_size = queue_size
+        self.queue_slots = defer.DeferredSemaphore(queue_size)
 
     @classmethod
     def from_crawler(cls, crawler):
         settings = crawler.settings
         if not settings.get('DATABASE_URI'):
             raise NotConfigured('Database settings are not configured.')
-        return cls()
+        return cls(
+            batch_size=settings.getint('DATABASE_BATCH_SIZE', 1),
+            flush_interval=settings.getfloat('DATABASE_FLUSH_INTERVAL', 0),
+            preload_ids=settings.getbool('DATABASE_PRELOAD_IDS'),
+            queue_size=settings.getint('DATABASE_WRITER_QUEUE_SIZE', 1000),
+        )
+
+    @property
+    def batch_mode(self):
+        return self.batch_size > 1
+
+    @property
+    def queue_depth(self):
+        """Number of items queued and not written yet."""
+        return self.queue_size - self.queue_slots.tokens
+
+    def open_spider(self, spider):
+        self.writer_pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self._stop_writer)
+        if self.batch_mode and self.flush_interval > 0:
+            self.flush_task = task.LoopingCall(self._periodic_flush, spider)
+            self.flush_task.start(self.flush_interval, now=False)
+        if self.preload_ids:
+            return self._run_in_writer(self._load_indexes, spider)
 
     def process_item(self, item, spider):
-        force = getattr(spider, 'force', None) == 'True'
-        if isinstance(item, AssetPriceItem):
-            return self._process_price_item(item, force, spider)
-        elif isinstance(item, AssetEarningsItem):
-            return self._process_earnings_item(item, force, spider)
-        else:
+        """Queue the item to be written, the returned Deferred only fires
+        once there's room in the queue.
+        """
+        if not isinstance(item, (AssetPriceItem, AssetEarningsItem)):
             return item
+        d = self.queue_slots.acquire()
+        d.addCallback(self._queue_item, item, spider)
+        return d
 
     def close_spider(self, spider):
+        if self.flush_task and self.flush_task.running:
+            self.flush_task.stop()
+        # Runs after all the queued items are written.
+        d = self._run_in_writer(self._close, spider)
+        d.addBoth(lambda _: self._stop_writer())
+        return d
+
+    def _close(self, spider):
+        self.flush(spider)
+        for _type, index in self.indexes.items():
+            self._set_stat(
+                spider, f'sql/index/{_type}/memory_bytes', index.memory_usage()
+            )
         self.session.close()
+        self.session.remove()
         self.logger.debug('Closed database session.')
 
+    def _queue_item(self, _, item, spider):
+        force = getattr(spider, 'force', None) == 'True'
+        d = self._run_in_writer(self._write_item, item, force, spider)
+        d.addErrback(self._write_failed, item, spider)
+        d.addBoth(lambda _: self.queue_slots.release())
+        return item
+
+    def _write_item(self, item, force, spider):
+        """Runs in the writer thread."""
+        if isinstance(item, AssetPriceItem):
+            self._process_price_item(item, force, spider)
+        else:
+            self._process_earnings_item(item, force, spider)
+
+    def _write_failed(self, failure, item, spider):
+        self.logger.error(
+            'Failed to store the item of %s in the database: %s',
+            item.get('asset_code'), failure.getErrorMessage(),
+            exc_info=(failure.type, failure.value, failure.getTracebackObject())
+        )
+        spider.crawler.stats.inc_value('sql/writer/errors')
+
+    def _periodic_flush(self, spider):
+        """Flush from the LoopingCall, a failure would stop the loop."""
+        d = self._run_in_writer(self.flush, spider)
+        d.addErrback(self._flush_failed, spider)
+        return d
+
+    def _flush_failed(self, failure, spider):
+        self.logger.error(
+            'Failed to flush the buffered records: %s',
+            failure.getErrorMessage(),
+            exc_info=(failure.type, failure.value, failure.getTracebackObject())
+        )
+        spider.crawler.stats.inc_value('sql/writer/errors')
+
+    def _run_in_writer(self, func, *args):
+        return threads.deferToThreadPool(
+            reactor, self.writer_pool, func, *args
+        )
+
+    def _stop_writer(self):
+        if self.writer_pool.started and not self.writer_pool.joined:
+            self.writer_pool.stop()
+
+    def _inc_stat(self, spider, key, count=1):
+        """Stats are updated in the reactor thread."""
+        reactor.callFromThread(spider.crawler.stats.inc_value, key, count)
+
+    def _set_stat(self, spider, key, value):
+        reactor.callFromThread(spider.crawler.stats.set_value, key, value)
+
+    def flush(self, spider):
+        """Write all the buffered records to the database in a single
+        transaction, only used in batch mode.
+        """
+        force_update = getattr(spider, 'force', None) == 'True'
+        for _type, model in (
+            ('price', AssetPriceModel), ('earnings', AssetEarningsModel)
+        ):
+            records, self.pending[_type] = self.pending[_type], {}
+            if records:
+                self._flush_records(
+                    model, _type, records, force_update, spider
+                )
+
     def _process_earnings_item(self, item, force_update, spider):
         """Process an instance of the AssetEarningsItem into the data types the
         model expects and inserts into the DB.
@@ -52,9 +189,6 @@ class StoreInDatabasePipeline:
         )
         _id = self._build_hash_id(base_string)
 
-        query = self.session.query(AssetEarningsModel) \
-                    .filter(AssetEarningsModel._id == _id)
-        record_exist = query.first()
         record = item.copy()  # Keeping the original item through the pipelines
         record.update({
             'value': self._convert_to_decimal(record.get('value')),
@@ -67,26 +201,13 @@ class StoreInDatabasePipeline:
             'date_of_payment': record.get('date_of_payment'),
         })
 
-        if not record_exist:
-            row = AssetEarningsModel(**record)
-            row._id = _id
-            self.session.add(row)
-        elif force_update:
-            self.logger.debug('Updating record "%s".', _id)
-            query.update(record, synchronize_session=False)
+        if self.batch_mode:
+            self._buffer_record('earnings', _id, record, force_update, spider)
         else:
-            self.logger.debug(
-                'Record "%s" already exists in the database, dropping...', _id
+            self._store_record(
+                AssetEarningsModel, 'earnings', _id, record, force_update,
+                spider
             )
-            spider.crawler.stats.inc_value('dropped/sql/earnings/duplicated')
-            return item
-
-        try:
-            self.session.commit()
-        except (SQLAlchemyError, StatementError):
-            self.session.rollback()
-            self.logger.exception('Failed to commit the database transaction.')
-
         return item
 
     def _process_price_item(self, item, force_update, spider):
@@ -102,9 +223,6 @@ class StoreInDatabasePipeline:
         )
         _id = self._build_hash_id(base_string)
 
-        query = self.session.query(AssetPriceModel) \
-                    .filter(AssetPriceModel._id == _id)
-        record_exist = query.first()
         record = item.copy()  # Keeping the original item through the pipelines
         record.update({
             'date': record['date'],
@@ -116,36 +234,339 @@ class StoreInDatabasePipeline:
             'variation': self._convert_to_decimal(record.get('variation')),
         })
 
+        if self.batch_mode:
+            self._buffer_record('price', _id, record, force_update, spider)
+        else:
+            self._store_record(
+                AssetPriceModel, 'price', _id, record, force_update, spider
+            )
+        return item
+
+    def _store_record(self, model, _type, _id, record, force_update, spider):
+        """Insert (or update) a single record and commit the transaction.
+        :param model: Model class mapped to the record table.
+        :type model: AssetEarningsModel or AssetPriceModel
+        :param _type: Type of the record, used for stats and logging.
+        :type _type: str
+        """
+        if force_update and self._get_upsert_insert():
+            self._upsert_records(model, _type, {_id: record}, spider)
+            return
+
+        query = self.session.query(model).filter(model._id == _id)
+        record_exist = self._lookup_index(_type, _id, record, spider)
+        if record_exist is None:
+            record_exist = query.first()
+
+        started = time.perf_counter()
         if not record_exist:
-            row = AssetPriceModel(**record)
+            row = model(**record)
             row._id = _id
             self.session.add(row)
         elif force_update:
-            self.logger.debug('Updating record "%s".', _id)
+            self.logger.debug('Updating record "%s".', _id.hex())
             query.update(record, synchronize_session=False)
         else:
             self.logger.debug(
-                'Record "%s" already exists in the database, dropping...', _id
+                'Record "%s" already exists in the database, dropping...',
+                _id.hex()
             )
-            spider.crawler.stats.inc_value('dropped/sql/price/duplicated')
-            return item
+            self._inc_stat(spider, f'dropped/sql/{_type}/duplicated')
+            return
 
         try:
-            self.session.commit()
+            self._commit(spider, _type, 1, started)
         except (SQLAlchemyError, StatementError):
             self.session.rollback()
-            self.logger.exception('Failed to commit the database transaction.')
+            self.logger.exception(
+                'Failed to commit the %s record "%s" of %s.',
+                _type, _id.hex(), record.get('asset_code')
+            )
+            self._inc_stat(spider, f'sql/{_type}/errors')
+            return
 
-        return item
+        if _type in self.indexes:
+            self.indexes[_type].add(_id)
+
+    def _buffer_record(self, _type, _id, record, force_update, spider):
+        """Keep the record in memory until the batch is full."""
+        pending = self.pending[_type]
+        if _id in pending and not force_update:
+            self.logger.debug(
+                'Record "%s" already in the current batch, dropping...',
+                _id.hex()
+            )
+            self._inc_stat(spider, f'dropped/sql/{_type}/duplicated')
+            return
+
+        record_exist = self._lookup_index(_type, _id, record, spider)
+        if record_exist and not force_update:
+            self.logger.debug(
+                'Record "%s" already exists in the database, dropping...',
+                _id.hex()
+            )
+            self._inc_stat(spider, f'dropped/sql/{_type}/duplicated')
+            return
+
+        pending[_id] = record
+        if len(pending) >= self.batch_size:
+            self.flush(spider)
+
+    def _flush_records(self, model, _type, records, force_update, spider):
+        """Write a batch of records: one query to find which ones already
+        exist, one bulk statement for the inserts and a single commit.
+        :param records: Records to be written, mapped by their `_id`.
+        :type records: Dict[bytes, Scrapy Item object]
+        """
+        if force_update and self._get_upsert_insert():
+            self._upsert_records(model, _type, records, spider)
+            return
+
+        index = self.indexes.get(_type)
+        if index is None or force_update:
+            unknown_ids = list(records)
+        else:  # Records missing from the index don't need to be checked
+            unknown_ids = [
+                _id for _id, record in records.items()
+                if index.lookup(_id, record) is not False
+            ]
+
+        try:
+            existing = self._get_existing_ids(model, unknown_ids)
+        except (SQLAlchemyError, StatementError):
+            self.session.rollback()
+            self.logger.exception(
+                'Failed to query the batch of %s %s records.',
+                len(records), _type
+            )
+            self._inc_stat(spider, f'sql/{_type}/errors', len(records))
+            return
+
+        new_rows, updated_rows = [], []
+        for _id, record in records.items():
+            if _id not in existing:
+                new_rows.append(dict(record, _id=_id))
+            elif force_update:
+                updated_rows.append(dict(record, id=existing[_id]))
+        duplicated = len(existing) - len(updated_rows)
+
+        def insert(rows):
+            self.session.bulk_insert_mappings(model, rows)
+
+        def update(rows):
+            self.session.bulk_update_mappings(model, rows)
+
+        try:
+            started = time.perf_counter()
+            if new_rows:
+                insert(new_rows)
+            if updated_rows:
+                update(updated_rows)
+            self._commit(
+                spider, _type, len(new_rows) + len(updated_rows), started
+            )
+            failed = False
+        except (SQLAlchemyError, StatementError) as e:
+            self._batch_failed(spider, _type, len(records), e)
+            failed = True
+        if failed:  # Out of the except, errors of the rows aren't chained
+            new_rows = self._write_rows(spider, _type, new_rows, insert)
+            updated_rows = self._write_rows(
+                spider, _type, updated_rows, update
+            )
+
+        if index is not None:
+            for row in new_rows:
+                index.add(row['_id'])
+        if duplicated:
+            self._inc_stat(spider, f'dropped/sql/{_type}/duplicated', duplicated)
+        self.logger.debug(
+            'Flushed %s %s records: %s inserted, %s updated, %s dropped.',
+            len(records), _type, len(new_rows), len(updated_rows), duplicated
+        )
+
+    def _upsert_records(self, model, _type, records, spider):
+        """Insert or update the records with a single dialect native
+        statement (INSERT ... ON CONFLICT / ON DUPLICATE KEY UPDATE).
+        :param records: Records to be written, mapped by their `_id`.
+        :type records: Dict[bytes, Scrapy Item object]
+        """
+        table = model.__table__
+        columns = [
+            column.name for column in table.columns
+            if column.name not in self.immutable_columns
+        ]
+        # Every row must have the same keys to be sent as a single statement.
+        rows = [
+            dict({column: record.get(column) for column in columns}, _id=_id)
+            for _id, record in records.items()
+        ]
+
+        insert = self._get_upsert_insert()
+        stmt = insert(table)
+        if insert is mysql.insert:
+            values = {column: stmt.inserted[column] for column in columns}
+            values['last_updated'] = func.now()
+            stmt = stmt.on_duplicate_key_update(values)
+        else:
+            values = {column: stmt.excluded[column] for column in columns}
+            values['last_updated'] = func.now()
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c._id], set_=values
+            )
+
+        def upsert(rows):
+            self.session.execute(stmt, rows)
+
+        try:
+            started = time.perf_counter()
+            upsert(rows)
+            self._commit(spider, _type, len(rows), started)
+            failed = False
+        except (SQLAlchemyError, StatementError) as e:
+            self._batch_failed(spider, _type, len(rows), e)
+            failed = True
+        if failed:
+            rows = self._write_rows(spider, _type, rows, upsert)
+
+        index = self.indexes.get(_type)
+        if index is not None:
+            for row in rows:
+                index.add(row['_id'])
+        self.logger.debug('Upserted %s %s records.', len(rows), _type)
+
+    def _batch_failed(self, spider, _type, size, error):
+        self.session.rollback()
+        self.logger.warning(
+            'Failed to commit the batch of %s %s records, writing them one '
+            'at a time: %s', size, _type, error
+        )
+        self._inc_stat(spider, f'sql/{_type}/batch_retries')
+
+    def _write_rows(self, spider, _type, rows, write):
+        """Write the rows of a failed batch one at a time, each in its own
+        transaction, so only the rows that fail are lost.
+        :param write: Function adding the statements of a list of rows to
+        the session.
+        :type write: Callable
+        :returns: The rows written.
+        """
+        written = []
+        for row in rows:
+            try:
+                started = time.perf_counter()
+                write([row])
+                self._commit(spider, _type, 1, started)
+            except (SQLAlchemyError, StatementError):
+                self.session.rollback()
+                self.logger.exception(
+                    'Failed to commit the %s record of %s on %s.', _type,
+                    row.get('asset_code'),
+                    row.get('date') or row.get('date_of_approval')
+                    or row.get('date_of_payment')
+                )
+                self._inc_stat(spider, f'sql/{_type}/errors')
+            else:
+                written.append(row)
+        return written
+
+    def _commit(self, spider, _type, records, started):
+        """Flush the pending statements and commit the transaction. The time
+        of the statements (since `started`) and of the commit are sent with
+        the `database_written` signal.
+        """
+        self.session.flush()
+        flushed = time.perf_counter()
+        self.session.commit()
+        reactor.callFromThread(
+            spider.crawler.signals.send_catch_log, signal=database_written,
+            spider=spider, record_type=_type, records=records,
+            flush_time=flushed - started,
+            commit_time=time.perf_counter() - flushed,
+        )
+
+    def _get_upsert_insert(self):
+        """Returns the dialect specific `insert` construct supporting upserts,
+        or None if the database dialect doesn't support it.
+        """
+        dialect = self.session.get_bind().dialect.name
+        return {
+            'mariadb': mysql.insert,
+            'mysql': mysql.insert,
+            'postgresql': postgresql.insert,
+            'sqlite': sqlite.insert,
+        }.get(dialect)
+
+    def _load_indexes(self, spider):
+        """Load the `_id`s already stored into memory, limited to the assets
+        and date window requested by the spider if any.
+        """
+        assets = getattr(spider, 'assets', None)
+        assets = assets.split(',') if assets else None
+        start_date = getattr(spider, 'start_date', None)
+        end_date = getattr(spider, 'end_date', None)
+
+        self.indexes = {
+            'price': ExistingRecordsIndex(AssetPriceModel, date_field='date'),
+            'earnings': ExistingRecordsIndex(AssetEarningsModel),
+        }
+        for _type, index in self.indexes.items():
+            index.load(
+                self.session,
+                assets=assets,
+                start_date=self._parse_date_arg(start_date),
+                end_date=self._parse_date_arg(end_date),
+            )
+            self._set_stat(spider, f'sql/index/{_type}/size', len(index))
+            self._set_stat(
+                spider, f'sql/index/{_type}/memory_bytes', index.memory_usage()
+            )
+            self.logger.info(
+                'Loaded %s existing %s records into memory.',
+                len(index), _type
+            )
+        self.session.commit()  # Ends the read transaction
+
+    def _lookup_index(self, _type, _id, record, spider):
+        """Check the existence of the record in memory.
+        :returns: True or False when the index can tell, None otherwise.
+        """
+        index = self.indexes.get(_type)
+        if index is None:
+            return None
+
+        record_exist = index.lookup(_id, record)
+        if record_exist is None:
+            self._inc_stat(spider, f'sql/index/{_type}/fallback')
+        elif record_exist:
+            self._inc_stat(spider, f'sql/index/{_type}/hit')
+        else:
+            self._inc_stat(spider, f'sql/index/{_type}/miss')
+        return record_exist
+
+    def _get_existing_ids(self, model, ids):
+        """Map each `_id` already stored in the database to its primary key."""
+        existing = {}
+        for i in range(0, len(ids), self.in_clause_chunk_size):
+            chunk = ids[i:i + self.in_clause_chunk_size]
+            query = self.session.query(model._id, model.id) \
+                        .filter(model._id.in_(chunk))
+            existing.update(query.all())
+        return existing
 
     def _build_hash_id(self, base_string):
-        """Build unique identifier used to prevent duplicated data."""
+        """Build unique identifier used to prevent duplicated data, the 16
+        bytes MD5 digest of the string.
+        """
         base_string = bytes(base_string, encoding='utf-8')
-        return hashlib.md5(base_string).hexdigest()
+        return hashlib.md5(base_string).digest()
 
     def _convert_to_decimal(self, value):
         return Decimal(value) if value else None
 
+    def _parse_date_arg(self, date):
+        return datetime.strptime(date, '%d/%m/%Y') if date else None
+
     def _parse_timestamp(self, timestamp):
         # Timestamp includes timing, but unrelated to market close.
         return datetime.fromtimestamp(int(timestamp)) if timestamp else None
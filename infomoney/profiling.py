@@ -0,0 +1,158 @@
+"""Deterministic profiles (cProfile) of each component of the crawl, written as
+pstats reports and as folded stacks for flame graphs.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+from collections import Counter
+
+# Calls of the profiler itself, recorded when it's disabled.
+IGNORED_FUNCTIONS = ("<method 'disable' of '_lsprof.Profiler' objects>",)
+
+
+class ComponentProfiler:
+    """One profile by component (callback, pipeline, etc.), enabled only while
+    the component runs.
+    """
+
+    def __init__(self):
+        self.profiles = {}
+        # Component: number of times it was profiled
+        self.calls = Counter()
+        # Times another profiler was already active and the run was skipped.
+        self.skipped = 0
+
+    def enable(self, name):
+        """Start profiling the component in the current thread.
+        :returns: The profile to be disabled, None if it couldn't be enabled.
+        """
+        profile = self.profiles.get(name)
+        if profile is None:
+            profile = self.profiles[name] = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active, e.g. the whole run under cProfile.
+            self.skipped += 1
+            return None
+        self.calls[name] += 1
+        return profile
+
+    def disable(self, profile):
+        if profile is not None:
+            profile.disable()
+
+    def wrap(self, name, func):
+        """Function calling `func` with the profile of the component enabled.
+        """
+        def profiled(*args, **kwargs):
+            profile = self.enable(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.disable(profile)
+        return profiled
+
+    def write_reports(self, directory, tags, limit=50):
+        """Write the reports of each component to the directory: the pstats
+        dump (`.prof`), the functions with the highest cumulative time
+        (`.txt`) and the folded stacks (`.folded`), plus `run.json` with the
+        tags and the profiled time of each component.
+        :param tags: Information of the run (spider arguments, etc.).
+        :type tags: dict
+        :param limit: Number of functions in the text reports.
+        :type limit: int
+        :returns: Paths of the files written.
+        """
+        os.makedirs(directory, exist_ok=True)
+        header = ', '.join(f'{key}={value}' for key, value in tags.items())
+        files = []
+        components = {}
+        for name, profile in sorted(self.profiles.items()):
+            stats = pstats.Stats(profile)
+            if not stats.stats:
+                continue
+            components[name] = {
+                'calls': self.calls[name],
+                'seconds': round(stats.total_tt, 6),
+            }
+            base = os.path.join(directory, _filename(name))
+            stats.dump_stats(f'{base}.prof')
+
+            text = io.StringIO()
+            text.write(f'{name} ({header})\n\n')
+            stats.stream = text
+            stats.sort_stats('cumulative').print_stats(limit)
+            with open(f'{base}.txt', 'w') as file:
+                file.write(text.getvalue())
+
+            with open(f'{base}.folded', 'w') as file:
+                for stack, microseconds in folded_stacks(stats):
+                    file.write(f'{stack} {microseconds}\n')
+            files.extend(f'{base}{ext}' for ext in ('.prof', '.txt', '.folded'))
+
+        run_file = os.path.join(directory, 'run.json')
+        with open(run_file, 'w') as file:
+            json.dump(dict(tags, components=components), file, indent=2)
+        files.append(run_file)
+        return files
+
+
+def folded_stacks(stats, max_depth=64, min_microseconds=1):
+    """Stacks in the folded format (`caller;callee`) read by flamegraph.pl,
+    speedscope and similar tools. cProfile only records the caller of each
+    function, so the self time of a function is split among the stacks that
+    reach it in proportion to the time of the calls from each caller.
+    :param stats: Stats of the profile.
+    :type stats: pstats.Stats
+    :returns: List of (stack, microseconds), sorted by stack.
+    """
+    entries = {
+        func: value for func, value in stats.stats.items()
+        if _label(func) not in IGNORED_FUNCTIONS
+    }
+    callees = {}
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, (_, _, _, cumulative) in callers.items():
+            callees.setdefault(caller, []).append((func, cumulative))
+
+    folded = Counter()
+
+    def walk(func, stack, path, fraction):
+        _, _, own_time, _, _ = entries[func]
+        stack = stack + (_label(func).replace(';', ':'),)
+        folded[';'.join(stack)] += own_time * fraction * 1e6
+        if len(stack) >= max_depth:
+            return
+        for callee, cumulative in callees.get(func, ()):
+            total = entries.get(callee, (0, 0, 0, 0))[3]
+            # Recursive calls are already in the time of the first frame.
+            if callee in path or not total or \
+                    cumulative * fraction * 1e6 < min_microseconds:
+                continue
+            walk(callee, stack, path | {callee},
+                 fraction * min(1, cumulative / total))
+
+    for func, (_, _, _, _, callers) in entries.items():
+        if not any(caller in entries for caller in callers):
+            walk(func, (), {func}, 1)
+    return sorted(
+        (stack, round(microseconds))
+        for stack, microseconds in folded.items()
+        if round(microseconds) > 0
+    )
+
+
+def _label(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return f'{name} ({os.path.basename(filename)}:{line})'
+
+
+def _filename(name):
+    return ''.join(
+        char if char.isalnum() or char in '._-' else '_' for char in name
+    )
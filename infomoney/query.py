@@ -0,0 +1,471 @@
+"""Loads the stored prices and earnings of one or many assets into NumPy
+arrays or a pandas DataFrame, from the database or the CSV files.
+
+Rows are read with a single query (or a single read of each file) and
+converted column by column, without ORM objects. The data of each asset is
+kept in an in-process LRU cache, by asset and date range.
+
+Usage:
+    from infomoney.query import load_prices
+    prices = load_prices(['PETR4', 'VALE3'], start='2020-01-01')
+    frame = load_prices('PETR4', as_frame=True)
+"""
+import csv
+import logging
+import os
+from collections import OrderedDict
+from datetime import date, datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+PRICE_COLUMNS = (
+    'date', 'timestamp', 'open', 'high', 'low', 'close', 'volume', 'variation'
+)
+EARNINGS_COLUMNS = (
+    'type', 'value', 'pct_factor', 'emission_value', 'date_of_approval',
+    'date_of_record', 'date_of_payment'
+)
+DATE_COLUMNS = (
+    'date', 'timestamp', 'date_of_approval', 'date_of_record',
+    'date_of_payment'
+)
+# Column used to filter and sort the rows by date.
+DATE_COLUMN = {'prices': 'date', 'earnings': 'date_of_payment'}
+# Columns identifying a record, the same used to build the `_id` of the
+# database records, the first not empty of each tuple.
+KEY_COLUMNS = {
+    'prices': (('date',),),
+    'earnings': (('type',), ('date_of_approval', 'date_of_payment')),
+}
+# SQLite limits the number of variables of a query.
+MAX_ASSETS_PER_QUERY = 500
+
+logger = logging.getLogger(__name__)
+_loaders = {}
+
+
+def load_prices(assets, start=None, end=None, as_frame=False, source=None):
+    """Load the prices of the assets with the loader shared by the process.
+    See `AssetDataLoader.prices`.
+    """
+    return get_loader(source).prices(assets, start, end, as_frame=as_frame)
+
+
+def load_earnings(assets, start=None, end=None, as_frame=False, source=None):
+    """Load the earnings of the assets with the loader shared by the process.
+    See `AssetDataLoader.earnings`.
+    """
+    return get_loader(source).earnings(assets, start, end, as_frame=as_frame)
+
+
+def get_loader(source=None):
+    """Return the loader of the source shared by the process, configured by
+    the project settings.
+    """
+    if source not in _loaders:
+        from scrapy.utils.project import get_project_settings
+
+        # Works outside the project directory too.
+        os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'infomoney.settings')
+        loader = AssetDataLoader.from_settings(
+            get_project_settings(), source=source
+        )
+        _loaders[source] = _loaders[loader.source] = loader
+    return _loaders[source]
+
+
+class AssetDataLoader:
+    """Reads prices and earnings stored by `StoreInDatabasePipeline`
+    (`database`) or `SplitInCSVsPipeline` (`csv`).
+
+    Results are a dict of NumPy arrays, one per column plus `asset_code`,
+    sorted by asset and date. Dates are `datetime64[s]`, numbers `float64`
+    with NaN for missing values and the earnings type an object array. The
+    arrays are shared with the cache and read-only, copy them before changing
+    the values.
+    """
+
+    def __init__(self, source='database', database_uri=None,
+                 files_directory=None, cache_size=1024):
+        """
+        :param source: `database` or `csv`.
+        :type source: str
+        :param database_uri: SQLAlchemy URI, used by the database source.
+        :type database_uri: str
+        :param files_directory: Directory of the CSV files, used by the csv
+        source.
+        :type files_directory: str
+        :param cache_size: Max number of (asset, date range) results kept in
+        the cache, 0 disables it.
+        :type cache_size: int
+        """
+        if np is None:
+            raise ImportError('numpy is required to load the stored data.')
+        if source == 'database' and not database_uri:
+            raise ValueError('Database connection is not configured.')
+        if source == 'csv' and not files_directory:
+            raise ValueError('CSV storage directory is not configured.')
+        if source not in ('database', 'csv'):
+            raise ValueError(f'Unknown source {source}.')
+
+        self.source = source
+        self.database_uri = database_uri
+        self.files_directory = files_directory
+        self.cache = _LRUCache(cache_size)
+        self._engine = None
+
+    @classmethod
+    def from_settings(cls, settings, source=None):
+        """Use the `QUERY_SOURCE` setting when no source is given, the
+        database if it's configured by default.
+        """
+        database_uri = settings.get('DATABASE_URI')
+        source = source or settings.get('QUERY_SOURCE') or (
+            'database' if database_uri else 'csv'
+        )
+        return cls(
+            source,
+            database_uri=database_uri,
+            files_directory=settings.get('FILES_STORAGE_PATH'),
+            cache_size=settings.getint('QUERY_CACHE_SIZE', 1024),
+        )
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            from sqlalchemy import create_engine
+            self._engine = create_engine(self.database_uri)
+        return self._engine
+
+    def prices(self, assets, start=None, end=None, as_frame=False):
+        """Load the prices of the assets between the dates (inclusive).
+        :param assets: Asset code or list of codes.
+        :type assets: str or list
+        :param start: First date, `YYYY-MM-DD` string, date or None.
+        :param end: Last date, `YYYY-MM-DD` string, date or None.
+        :param as_frame: Return a pandas DataFrame instead of the arrays.
+        :type as_frame: bool
+        """
+        return self._load('prices', assets, start, end, as_frame)
+
+    def earnings(self, assets, start=None, end=None, as_frame=False):
+        """Load the earnings of the assets paid between the dates (inclusive).
+        Same arguments of `prices`.
+        """
+        return self._load('earnings', assets, start, end, as_frame)
+
+    def clear_cache(self):
+        self.cache.clear()
+
+    def _load(self, _type, assets, start, end, as_frame):
+        codes = [assets] if isinstance(assets, str) else list(assets)
+        start, end = _to_datetime(start), _to_datetime(end)
+
+        results = {}
+        missing = []
+        for code in codes:
+            result = self.cache.get((_type, code, start, end))
+            if result is None:
+                missing.append(code)
+            else:
+                results[code] = result
+
+        if missing:
+            read = self._read_database if self.source == 'database' \
+                else self._read_csv
+            loaded = read(_type, missing, start, end)
+            for code in missing:
+                result = loaded.get(code) or _empty(_type)
+                for array in result.values():
+                    array.flags.writeable = False
+                self.cache.put((_type, code, start, end), result)
+                results[code] = result
+            logger.debug(
+                'Loaded %s of %s assets from the %s, %s in the cache.',
+                _type, len(missing), self.source, len(codes) - len(missing)
+            )
+
+        columns = _concatenate(_type, [(code, results[code]) for code in codes])
+        return _to_frame(columns) if as_frame else columns
+
+    def _read_database(self, _type, codes, start, end):
+        """Query the rows of all the assets at once, the numeric columns are
+        cast to float and the dates to text by the database.
+        :returns: Dict of columns by asset code.
+        """
+        from sqlalchemy import Float, String, cast, select
+        from infomoney.models import AssetEarningsModel, AssetPriceModel
+
+        model = AssetPriceModel if _type == 'prices' else AssetEarningsModel
+        table = model.__table__
+        names = PRICE_COLUMNS if _type == 'prices' else EARNINGS_COLUMNS
+        date_column = table.c[DATE_COLUMN[_type]]
+        # Dates as ISO strings, parsed by NumPy much faster than converting
+        # datetime objects.
+        selected = [
+            cast(table.c[name], String).label(name) if name in DATE_COLUMNS
+            else table.c[name] if name in ('type', 'volume')
+            else cast(table.c[name], Float).label(name)
+            for name in names
+        ]
+
+        rows = []
+        with self.engine.connect() as connection:
+            for i in range(0, len(codes), MAX_ASSETS_PER_QUERY):
+                query = select(table.c.asset_code, *selected).where(
+                    table.c.asset_code.in_(codes[i:i + MAX_ASSETS_PER_QUERY])
+                ).order_by(table.c.asset_code, date_column)
+                if start:
+                    query = query.where(date_column >= start)
+                if end:
+                    query = query.where(date_column <= end)
+                rows.extend(connection.execute(query).fetchall())
+
+        if not rows:
+            return {}
+        values = list(zip(*rows))
+        columns = {
+            name: _convert(name, column)
+            for name, column in zip(names, values[1:])
+        }
+        if 'timestamp' in columns:
+            # Stored in the local time of the spider, UTC like the CSV files.
+            columns['timestamp'] = _local_to_utc(columns['timestamp'])
+        return {
+            code: _sort_by_date(_type, asset_columns)
+            for code, asset_columns in _split_by_asset(
+                np.array(values[0], dtype=object), columns
+            ).items()
+        }
+
+    def _read_csv(self, _type, codes, start, end):
+        """Read the files of the assets, each one converted column by column.
+        Custom date files (`custom_date_*.csv`) aren't read.
+        :returns: Dict of columns by asset code.
+        """
+        names = PRICE_COLUMNS if _type == 'prices' else EARNINGS_COLUMNS
+        template = '{}.csv' if _type == 'prices' else 'earnings_{}.csv'
+        loaded = {}
+        for code in codes:
+            filename = os.path.join(self.files_directory, template.format(code))
+            if not os.path.exists(filename):
+                continue
+            with open(filename, newline='', encoding='utf-8') as file:
+                reader = csv.reader(file)
+                header = next(reader, None)
+                rows = list(reader)
+            if not header or not rows:
+                continue
+
+            values = dict(zip(header, zip(*rows)))
+            empty = ('',) * len(rows)
+            columns = {
+                name: _convert(name, values.get(name, empty)) for name in names
+                if name != 'timestamp'
+            }
+            if 'timestamp' in names:
+                # Exported as sent by the API, seconds since the epoch (UTC).
+                columns['timestamp'] = _to_integers(
+                    values.get('timestamp', empty)
+                ).astype('datetime64[s]')
+            # Appended files may have the same record more than once, the
+            # last one is kept like the updated record of the database.
+            columns = _drop_duplicates(_type, columns)
+            dates = columns[DATE_COLUMN[_type]]
+            mask = np.ones(len(dates), dtype=bool)
+            if start:
+                mask &= dates >= np.datetime64(start, 's')
+            if end:
+                mask &= dates <= np.datetime64(end, 's')
+            # Appended files may be out of order.
+            loaded[code] = _sort_by_date(_type, {
+                name: column[mask] for name, column in columns.items()
+            })
+        return loaded
+
+
+class _LRUCache:
+    """Results mapped by key, the least recently used are removed above
+    `max_entries`.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        if not self.max_entries:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+    def info(self):
+        return {
+            'hits': self.hits, 'misses': self.misses,
+            'entries': len(self.entries), 'max_entries': self.max_entries,
+        }
+
+
+def _convert(name, values):
+    """Convert a column of values, as returned by the database or read from
+    the CSV files, to a typed array.
+    """
+    if name in DATE_COLUMNS:
+        # ISO strings, empty strings and None are NaT.
+        return np.array(values, dtype='datetime64[s]')
+    if name == 'type':
+        return np.array(values, dtype=object)
+    if name == 'volume':
+        return _to_integers(values)
+    return _to_floats(values)
+
+
+def _to_floats(values):
+    values = np.array(values, dtype=object)
+    values[values == ''] = None
+    try:
+        return values.astype(np.float64)
+    except (TypeError, ValueError):
+        # Unexpected values, converted one by one.
+        return np.array([_to_float(value) for value in values])
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _to_integers(values):
+    """Vectorised `infomoney.utils.parse_volume`, integers stored as text
+    with "." as thousands and "," as decimal separator.
+    :returns: Float array, NaN for the invalid values.
+    """
+    text = np.array(values, dtype=str)
+    if not len(text):
+        return np.array([], dtype=np.float64)
+    text = np.char.partition(np.char.replace(text, '.', ''), ',')[:, 0]
+    valid = np.char.isdigit(text)
+    volumes = np.full(len(text), np.nan)
+    volumes[valid] = text[valid].astype(np.int64)
+    return volumes
+
+
+def _split_by_asset(codes, columns):
+    """Split the columns, sorted by asset, in one dict of columns per asset."""
+    if not len(codes):
+        return {}
+    boundaries = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(codes)]))
+    return {
+        codes[s]: {name: column[s:e] for name, column in columns.items()}
+        for s, e in zip(starts, ends)
+    }
+
+
+def _drop_duplicates(_type, columns):
+    """Keep the last row of each record, by the `KEY_COLUMNS`, in the
+    original order.
+    """
+    keys = np.full(len(columns[DATE_COLUMN[_type]]), '', dtype=object)
+    for names in KEY_COLUMNS[_type]:
+        part = columns[names[0]].astype(str)
+        for name in names[1:]:
+            part = np.where(
+                np.isnat(columns[names[0]]), columns[name].astype(str), part
+            )
+        keys = keys + part + '|'
+    _, last = np.unique(keys[::-1], return_index=True)
+    if len(last) == len(keys):
+        return columns
+    rows = np.sort(len(keys) - 1 - last)
+    return {name: column[rows] for name, column in columns.items()}
+
+
+def _local_to_utc(values):
+    """Convert naive local times to UTC, by the UTC offset of each distinct
+    value, with the time zone of this machine.
+    """
+    unique, inverse = np.unique(values, return_inverse=True)
+    converted = np.array([
+        np.datetime64(int(value.item().timestamp()), 's')
+        if not np.isnat(value) else value
+        for value in unique
+    ], dtype='datetime64[s]')
+    return converted[inverse].reshape(values.shape)
+
+
+def _sort_by_date(_type, columns):
+    """Sort the columns of an asset by date, rows without date (NaT) last
+    in both sources.
+    """
+    order = np.argsort(columns[DATE_COLUMN[_type]], kind='stable')
+    return {name: column[order] for name, column in columns.items()}
+
+
+def _empty(_type):
+    names = PRICE_COLUMNS if _type == 'prices' else EARNINGS_COLUMNS
+    return {name: _convert(name, ()) for name in names}
+
+
+def _concatenate(_type, results):
+    """Join the columns of the assets in a single dict of arrays, with the
+    `asset_code` column. A single asset returns the cached arrays.
+    """
+    sizes = [len(next(iter(columns.values()))) for _, columns in results]
+    codes = np.repeat(
+        np.array([code for code, _ in results], dtype=object), sizes
+    )
+    if len(results) == 1:
+        return {'asset_code': codes, **results[0][1]}
+    if not results:
+        return {'asset_code': codes, **_empty(_type)}
+    return {
+        'asset_code': codes,
+        **{
+            name: np.concatenate([columns[name] for _, columns in results])
+            for name in results[0][1]
+        },
+    }
+
+
+def _to_frame(columns):
+    if pd is None:
+        raise ImportError('pandas is required to load a DataFrame.')
+    frame = pd.DataFrame(columns)
+    if 'volume' in frame:
+        frame['volume'] = frame['volume'].astype('Int64')
+    return frame
+
+
+def _to_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return datetime.fromisoformat(value)
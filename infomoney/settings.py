@@ -10,6 +10,7 @@ ROBOTSTXT_OBEY = False
 ITEM_PIPELINES = {
     'infomoney.pipelines.DatetimeEnforcementPipeline': 50,
     'infomoney.pipelines.SplitInCSVsPipeline': 100,
+    # 'infomoney.pipelines.PartitionedParquetPipeline': 150,
     'infomoney.pipelines.StoreInDatabasePipeline': 200,
 }
 
@@ -22,21 +23,173 @@ USER_AGENT = (
 LOG_LEVEL = 'INFO'
 
 # Throttling and low number of concurrent request prevents the server to return
-# empty data.
-CONCURRENT_REQUESTS = 2 
+# empty data. The limit applies to each host, see DOWNLOAD_HOST_SLOTS.
+CONCURRENT_REQUESTS = 6
+CONCURRENT_REQUESTS_PER_DOMAIN = 2
 AUTOTHROTTLE_ENABLED = True
 
+EXTENSIONS = {
+    'scrapy.extensions.throttle.AutoThrottle': None,
+    'infomoney.extensions.PerHostAutoThrottle': 0,
+    'infomoney.extensions.HostSlots': 400,
+    'infomoney.extensions.AdaptiveConcurrency': 500,
+    'infomoney.extensions.Metrics': 600,
+}
+
+# Settins used in HostSlots and PerHostAutoThrottle - Download slot of each host
+# the spider requests, each one with its own queue. Accepts `concurrency`,
+# `delay` (min delay between requests, in seconds) and `throttle_target` (the
+# AUTOTHROTTLE_TARGET_CONCURRENCY of the host).
+DOWNLOAD_HOST_SLOTS = {
+    'api.infomoney.com.br': {'concurrency': 2},  # Assets listing
+    'www.infomoney.com.br': {'concurrency': 2},  # Details pages, price/earnings
+    'fii-api.infomoney.com.br': {'concurrency': 2},  # FIIs price/earnings
+}
+
+# Settins used in AdaptiveConcurrency - Adjust the concurrency of each slot by
+# the number of empty, invalid and retried responses. Slots start with
+# ADAPTIVE_CONCURRENCY_START concurrent requests, one more is allowed after
+# ADAPTIVE_CONCURRENCY_WINDOW valid responses in a row (up to
+# ADAPTIVE_CONCURRENCY_MAX) and the concurrency is halved on bad responses, at
+# most once every ADAPTIVE_CONCURRENCY_COOLDOWN seconds. When AutoThrottle is
+# disabled the delay is also doubled on bad responses, up to
+# ADAPTIVE_CONCURRENCY_MAX_DELAY.
+ADAPTIVE_CONCURRENCY_ENABLED = False
+ADAPTIVE_CONCURRENCY_START = 2
+ADAPTIVE_CONCURRENCY_MAX = 16
+ADAPTIVE_CONCURRENCY_WINDOW = 20
+ADAPTIVE_CONCURRENCY_COOLDOWN = 5
+ADAPTIVE_CONCURRENCY_MAX_DELAY = 10
+
+# Settins used in Metrics and CallbackTimingMiddleware - Histograms of the
+# download latency of each host, of the time in each spider callback and in the
+# process_item of each pipeline, database flush and commit times, items per
+# second and queue depths. Served in the Prometheus text format at
+# http://METRICS_HOST:METRICS_PORT/metrics (0 doesn't serve them) and written as
+# JSON to METRICS_DUMP_PATH (None doesn't write) every METRICS_INTERVAL seconds.
+# The multi-process launcher adds the worker index to the port and the path.
+METRICS_ENABLED = False
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9410
+METRICS_DUMP_PATH = None
+METRICS_INTERVAL = 30
+
+# Settins used in ProfilingMiddleware - Only loaded when the spider runs with
+# `-a profile=True`. The pstats, text (PROFILE_REPORT_LIMIT functions) and
+# folded stacks reports of each callback and pipeline are written to a new
+# folder in PROFILE_OUTPUT_DIR for each run.
+PROFILE_OUTPUT_DIR = 'profiles'
+PROFILE_REPORT_LIMIT = 50
+
+SPIDER_MIDDLEWARES = {
+    'infomoney.middlewares.ProfilingMiddleware': 990,
+    # Closest to the spider, measures only the callbacks.
+    'infomoney.middlewares.CallbackTimingMiddleware': 1000,
+}
+
+DOWNLOADER_MIDDLEWARES = {
+    'infomoney.middlewares.HostOverrideMiddleware': 50,
+    'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': None,
+    'infomoney.httpcache.EndpointHttpCacheMiddleware': 900,
+}
+
+# Settins used in EndpointHttpCacheMiddleware - Cache of the responses that
+# rarely change, stored compressed in .scrapy/httpcache. Only the endpoints in
+# HTTPCACHE_ENDPOINT_TTL are cached, each one fresh for the given number of
+# seconds, then revalidated with the server.
+HTTPCACHE_ENABLED = False
+HTTPCACHE_POLICY = 'infomoney.httpcache.EndpointCachePolicy'
+HTTPCACHE_GZIP = True
+HTTPCACHE_ENDPOINT_TTL = {
+    'start_url': 24 * 60 * 60,
+    'earnings_api': 7 * 24 * 60 * 60,
+    'fii_earnings_api': 7 * 24 * 60 * 60,
+}
+
 # Errors that won't be filtered by spidermiddlewares.httperror
 HTTPERROR_ALLOWED_CODES = [404]  # 404 filtered in the spider
 
+# Settins used in the spider - Decoder of the API responses, `json`, `orjson`
+# or `auto` (orjson if installed). Responses with FII price history bigger than
+# JSON_STREAM_MIN_SIZE bytes are parsed as a stream (requires ijson), 0
+# disables it. Around 128 KiB (~10 years of history) the peak memory of the
+# stream (flat, ~0.6 MiB) gets below the one of decoding the whole body, at
+# ~10% more time, see benchmarks/bench_json.py.
+JSON_DECODER = 'auto'
+JSON_STREAM_MIN_SIZE = 128 * 1024
+
+# Settins used in DatetimeEnforcementPipeline - Max number of parsed dates kept
+# in memory, the same dates repeat across all the assets.
+DATE_PARSE_CACHE_SIZE = 8192
+
 # Settins used in SplitInCSVsPipeline - Directory for saving the CSV files.
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 FILES_STORAGE_FOLDER = 'csv_output'
 FILES_STORAGE_PATH = os.path.join(BASE_DIR, FILES_STORAGE_FOLDER)
+# Append the new records to the existing CSV files instead of overwriting them,
+# earnings already in the file (same type and date) are dropped. Always enabled
+# when the spider runs in incremental mode.
+FILES_APPEND_MODE = False
+# Max number of CSV files kept open at the same time, the least recently used
+# ones are closed and reopened when needed. 0 disables the limit.
+FILES_MAX_OPEN = 256
+
+# Settins used in PartitionedParquetPipeline - Directory for saving the Parquet
+# files (requires pyarrow), rows per row group and max rows kept in memory.
+PARQUET_STORAGE_FOLDER = 'parquet_output'
+PARQUET_STORAGE_PATH = os.path.join(BASE_DIR, PARQUET_STORAGE_FOLDER)
+PARQUET_ROW_GROUP_SIZE = 100000
+PARQUET_MAX_BUFFERED_ROWS = 200000
+
+# Settins used in the spider - File caching where each asset details page
+# redirects to, skipping that request in the next executions. Resolved assets
+# expire after ASSET_CACHE_TTL seconds and assets that returned 404 after
+# ASSET_CACHE_NOT_FOUND_TTL seconds. Disabled by default, set ASSET_CACHE_PATH
+# to a writable file (e.g. '.scrapy/asset_cache.json') to enable it.
+ASSET_CACHE_PATH = None
+ASSET_CACHE_TTL = 30 * 24 * 60 * 60
+ASSET_CACHE_NOT_FOUND_TTL = 7 * 24 * 60 * 60
+
+# Settins used in the spider and HostOverrideMiddleware - Base URL replacing
+# `https://<host>` in the requests to each Infomoney host, to crawl a local
+# server such as the API emulator (python -m benchmarks.emulator), e.g.
+# {'www.infomoney.com.br': 'http://127.0.0.1:8080'}. The download slots keep
+# the original host names, so DOWNLOAD_HOST_SLOTS still applies.
+INFOMONEY_HOST_OVERRIDES = {}
+
+# Settins used in the spider - Distributed mode (-a distributed=True), queue of
+# assets shared by the workers. Each worker claims WORK_QUEUE_BATCH_SIZE assets
+# at a time, claims not renewed in WORK_QUEUE_LEASE seconds (worker crashed)
+# return to the queue. Assets are retried up to WORK_QUEUE_MAX_ATTEMPTS times.
+# A finished queue (every asset done or failed) is reset by the next worker
+# that opens it. The SQLite file is relative to the working directory, next to
+# the HTTP cache.
+WORK_QUEUE_BACKEND = 'infomoney.work_queue.SQLiteWorkQueue'
+WORK_QUEUE_PATH = os.path.join('.scrapy', 'work_queue.sqlite3')
+WORK_QUEUE_BATCH_SIZE = 10
+WORK_QUEUE_LEASE = 300
+WORK_QUEUE_MAX_ATTEMPTS = 3
 
 # Settins used in StoreInDatabasePipeline - Database connection info
 DATABASE_URI = os.getenv('INFOMONEY_DB')
 SHOW_SQL_STATEMENTS = False
+# Number of records buffered before they are written in a single transaction,
+# 1 commits every item as soon as it's processed.
+DATABASE_BATCH_SIZE = 1
+# Max number of seconds a buffered record waits before being written.
+DATABASE_FLUSH_INTERVAL = 5
+# Load the identifiers of the records already stored when the spider opens, so
+# duplicates are dropped without querying the database.
+DATABASE_PRELOAD_IDS = False
+# Max number of items waiting to be written by the database writer thread, the
+# spider waits for the writer when it's full.
+DATABASE_WRITER_QUEUE_SIZE = 1000
+
+# Settins used in infomoney.query - Storage read by the query API, `database`
+# or `csv` (None uses the database when DATABASE_URI is set) and max number of
+# (asset, date range) results kept in memory.
+QUERY_SOURCE = None
+QUERY_CACHE_SIZE = 1024
 
 try:
     from .local_settings import *
@@ -0,0 +1,19 @@
+"""Custom signals sent by the spider, see
+https://docs.scrapy.org/en/latest/topics/signals.html
+"""
+
+# Sent after a data response is checked by the spider.
+# Args: response, spider, outcome (one of `valid`, `empty`, `unparseable`,
+# `malformed` or `missing_key`)
+response_validated = object()
+
+# Sent after the output of a spider callback is consumed, by
+# CallbackTimingMiddleware.
+# Args: response, spider, callback (name of the method), elapsed (seconds
+# spent in the callback), outputs (number of items and requests)
+callback_processed = object()
+
+# Sent after StoreInDatabasePipeline commits a transaction.
+# Args: spider, record_type (`price` or `earnings`), records (number of
+# records in the transaction), flush_time and commit_time (seconds)
+database_written = object()
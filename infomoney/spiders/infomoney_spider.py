@@ -1,12 +1,21 @@
-import json
+import os
+import socket
 from datetime import datetime, timedelta
 
-from scrapy import FormRequest, Request, Spider
+from scrapy import FormRequest, Request, Spider, signals
 from scrapy.downloadermiddlewares.retry import get_retry_request
+from scrapy.exceptions import DontCloseSpider
+from twisted.internet.task import LoopingCall
 from w3lib.url import add_or_replace_parameter
 
-from infomoney.items import AssetEarningsItem, AssetPriceItem
-from infomoney.loaders import AssetEarningsLoader, AssetPriceLoader
+from infomoney.asset_cache import AssetResolutionCache
+from infomoney.decoders import (
+    decode_earnings, decode_fii_earnings, decode_fii_prices, decode_prices
+)
+from infomoney.json_decoder import JsonDecoder
+from infomoney.signals import response_validated
+from infomoney.utils import override_host, read_csv_edges
+from infomoney.work_queue import IN_FLIGHT, get_work_queue
 
 
 class InfomoneySpider(Spider):
@@ -15,6 +24,8 @@ class InfomoneySpider(Spider):
     """
     name = 'infomoney'
     results_per_page = 500
+    # Listing pages are requested before the queued asset requests.
+    listing_priority = 10
 
     # API URLs
     base_details_url = 'https://www.infomoney.com.br/{asset_code}'
@@ -48,45 +59,238 @@ class InfomoneySpider(Spider):
         'USIM3': 'https://www.infomoney.com.br/cotacoes/b3/acao/usiminas-usim3/',  # noqa E501
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Arguments given with -a, reported in the profiles.
+        self.arguments = dict(kwargs)
+        self.last_stored_dates = {}
+        self.db_last_dates = None
+        self.asset_cache = None
+        self.json_decoder = None
+        # Asset code: reason, for the assets whose requests failed
+        self.failed_assets = {}
+        # Distributed mode
+        self.work_queue = None
+        self.is_seeder = False
+        self.claimed = set()
+        self.failed_claims = {}
+        self.heartbeat_task = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        settings = crawler.settings
+        if settings.get('ASSET_CACHE_PATH'):
+            spider.asset_cache = AssetResolutionCache(
+                settings.get('ASSET_CACHE_PATH'),
+                ttl=settings.getint('ASSET_CACHE_TTL'),
+                not_found_ttl=settings.getint('ASSET_CACHE_NOT_FOUND_TTL'),
+            )
+            # Forced refresh ignores the cached entries, but updates them.
+            if not getattr(spider, 'refresh_assets', None) == 'True':
+                spider.asset_cache.load()
+        spider.json_decoder = JsonDecoder.from_settings(settings)
+        if settings.getdict('INFOMONEY_HOST_OVERRIDES'):
+            spider._override_hosts(
+                settings.getdict('INFOMONEY_HOST_OVERRIDES')
+            )
+        if getattr(spider, 'distributed', None) == 'True':
+            spider.work_queue = get_work_queue(settings)
+            spider.worker_id = getattr(spider, 'worker_id', None) or \
+                f'{socket.gethostname()}-{os.getpid()}'
+            spider.claim_batch_size = settings.getint('WORK_QUEUE_BATCH_SIZE')
+            crawler.signals.connect(
+                spider.spider_idle, signal=signals.spider_idle
+            )
+        return spider
+
+    def _override_hosts(self, overrides):
+        """Point the requests to other servers, replacing the API URLs of the
+        instance.
+        :param overrides: Base URL by Infomoney host name.
+        :type overrides: dict
+        """
+        for attribute in ('base_details_url', 'start_url', 'fii_earnings_api',
+                          'fii_price_api', 'earnings_api', 'price_api'):
+            setattr(self, attribute, override_host(
+                getattr(self, attribute), overrides
+            ))
+        self.broken_asset_urls = {
+            code: override_host(url, overrides)
+            for code, url in self.broken_asset_urls.items()
+        }
+        self.logger.info('Requests to %s overridden.', overrides)
+
+    def closed(self, reason):
+        if self.asset_cache:
+            self.asset_cache.save()
+        if self.work_queue:
+            if self.heartbeat_task and self.heartbeat_task.running:
+                self.heartbeat_task.stop()
+            # Assets of an interrupted batch return to the queue when their
+            # lease expires.
+            self.work_queue.close()
+
     def start_requests(self):
         """Build initial request(s)"""
+        if getattr(self, 'incremental', None) == 'True':
+            self.logger.info(
+                'Incremental mode: requesting prices after the last stored '
+                'date of each asset.'
+            )
+            if not (self._is_pipeline_enabled('StoreInDatabasePipeline') or
+                    self._is_pipeline_enabled('SplitInCSVsPipeline')):
+                self.logger.warning(
+                    'Incremental mode requires a storage pipeline enabled, '
+                    'requesting the full period.'
+                )
+        if self.work_queue:
+            yield from self._start_distributed()
+            return
+
         assets = getattr(self, 'assets', None)
         if assets:
             self.logger.info('Requesting data for asset(s): %s', assets)
             for asset in assets.split(','):
-                yield Request(
-                    url=self.base_details_url.format(asset_code=asset),
-                    callback=self.parse_details_page,
-                    cb_kwargs={
-                        'code': asset,
-                    }
-                )
+                yield from self._request_asset(asset)
         else:
             self.logger.info('Requesting data for ALL available assets.')
             yield Request(
                 url=self.start_url.format(page=1, size=self.results_per_page),
-                callback=self.parse
+                callback=self.parse,
+                priority=self.listing_priority,
+                meta={'endpoint': 'start_url'},
             )
 
     def parse(self, response):
-        """Parse initial page"""
-        data = response.json()
-        for asset in data.get('Data'):
-            code = asset.get('StockCode')
+        """Parse the assets listing pages"""
+        data = self.json_decoder.decode(response.body)
+        if data.get('PageIndex') == 1:
+            # All the remaining pages are requested at once, ahead of the
+            # asset requests, so every asset is known early in the crawl.
+            for page in range(2, data.get('TotalPages') + 1):
+                yield Request(
+                    url=self.start_url.format(
+                        page=page, size=self.results_per_page
+                    ),
+                    callback=self.parse,
+                    priority=self.listing_priority,
+                    meta={'endpoint': 'start_url'},
+                )
+
+        codes = [asset.get('StockCode') for asset in data.get('Data')]
+        if self.work_queue:
+            self.work_queue.push(codes)
+            return
+        for code in codes:
+            yield from self._request_asset(code)
+
+    def errback(self, failure):
+        """Log the requests of an asset that failed to download."""
+        code = failure.request.cb_kwargs.get('code')
+        self.logger.error(
+            'Request for %s failed: %s', code, repr(failure.value)
+        )
+        self._asset_failed(code, repr(failure.value))
+
+    def spider_idle(self):
+        """In distributed mode, the batch of assets claimed by the worker is
+        finished when the spider is idle. The next batch is claimed and the
+        spider is kept open while there are assets in the queue.
+        """
+        if self.claimed:
+            completed = self.claimed.difference(self.failed_claims)
+            self.work_queue.complete(self.worker_id, completed)
+            for code, reason in self.failed_claims.items():
+                self.work_queue.fail(self.worker_id, code, reason)
+            self.crawler.stats.inc_value(
+                'work_queue/completed', len(completed)
+            )
+            self.crawler.stats.inc_value(
+                'work_queue/failed', len(self.failed_claims)
+            )
+            self.claimed, self.failed_claims = set(), {}
+
+        if self.is_seeder and not self.work_queue.is_seeded():
+            # Idle, so all the listing pages were parsed.
+            self.work_queue.set_seeded()
+            self.logger.info('All assets pushed to the work queue.')
+
+        codes = self.work_queue.claim(self.worker_id, self.claim_batch_size)
+        if codes:
+            self.logger.info('Claimed asset(s): %s', ', '.join(codes))
+            self.crawler.stats.inc_value('work_queue/claimed', len(codes))
+            self.claimed.update(codes)
+            for code in codes:
+                for request in self._request_asset(code):
+                    self.crawler.engine.crawl(request)
+            raise DontCloseSpider
+
+        # Waits for the listing, or for assets claimed by other workers, they
+        # return to the queue if their worker crashes.
+        if not self.work_queue.is_seeded() or \
+                self.work_queue.counts()[IN_FLIGHT]:
+            raise DontCloseSpider
+        self.logger.info(
+            'Work queue finished: %s', self.work_queue.counts()
+        )
+
+    def _start_distributed(self):
+        """Push the assets to the work queue, the first worker requests the
+        assets listing, the others wait for the queue to be filled.
+        """
+        self.work_queue.open()
+        if self.work_queue.reset_if_finished():
+            self.logger.info('Previous run of the work queue finished, reset.')
+        self.heartbeat_task = LoopingCall(
+            self.work_queue.heartbeat, self.worker_id
+        )
+        self.heartbeat_task.start(self.work_queue.lease / 3, now=False)
+        self.logger.info(
+            'Distributed mode, worker %s using %s.',
+            self.worker_id, type(self.work_queue).__name__
+        )
+        assets = getattr(self, 'assets', None)
+        if assets:
+            self.work_queue.push(assets.split(','))
+            self.work_queue.set_seeded()
+        elif self.work_queue.try_seed(self.worker_id):
+            self.is_seeder = True
+            yield Request(
+                url=self.start_url.format(page=1, size=self.results_per_page),
+                callback=self.parse,
+                priority=self.listing_priority,
+                meta={'endpoint': 'start_url'},
+            )
+
+    def _asset_failed(self, code, reason):
+        self.failed_assets[code] = reason
+        if self.work_queue and code in self.claimed:
+            self.failed_claims[code] = reason
+
+    def _request_asset(self, code):
+        """Yields the request for the details page of the asset, or straight
+        the data requests if the page was resolved in a previous execution.
+        """
+        cached = self.asset_cache.get(code) if self.asset_cache else None
+        if not cached:
             yield Request(
                 url=self.base_details_url.format(asset_code=code),
                 callback=self.parse_details_page,
                 cb_kwargs={'code': code},
+                errback=self.errback,
+                meta={'endpoint': 'base_details_url'},
             )
+            return
 
-        if data.get('PageIndex') < data.get('TotalPages'):
-            yield Request(
-                url=self.start_url.format(
-                    page=data.get('PageIndex') + 1,
-                    size=self.results_per_page
-                ),
-                callback=self.parse
+        self.crawler.stats.inc_value('asset_cache/hit')
+        if cached['status'] == 404:
+            self.logger.warning(
+                'Page for %s returned 404 in a previous execution, skipping. '
+                'Use -a refresh_assets=True to request it again.', code
             )
+            return
+        yield from self._make_data_requests(code, cached['fii'])
 
     def parse_details_page(self, response, code):
         """Yields requests for the historical price data and earnings pages"""
@@ -96,6 +300,8 @@ class InfomoneySpider(Spider):
                 'Page for %s didn\'t redirect, returned 404. Maybe the asset '
                 'is no longer tradable.', code
             )
+            if self.asset_cache:
+                self.asset_cache.set_not_found(code)
             return
         if response.url.endswith('.png') or response.url.endswith('.gif'):
             # A few assets links are redirecting to images (USIM3, HAGA4, etc)
@@ -103,7 +309,9 @@ class InfomoneySpider(Spider):
                 yield Request(
                     url=self.broken_asset_urls[code],
                     callback=self.parse_details_page,
-                    cb_kwargs={'code': code}
+                    cb_kwargs={'code': code},
+                    errback=self.errback,
+                    meta={'endpoint': 'base_details_url'},
                 )
                 return
             self.logger.error(
@@ -112,23 +320,32 @@ class InfomoneySpider(Spider):
             )
             return
 
+        is_fii = 'b3/fii/' in response.url
+        if self.asset_cache:
+            self.asset_cache.set_resolved(code, response.url, is_fii)
+        yield from self._make_data_requests(code, is_fii)
+
+    def _make_data_requests(self, code, is_fii):
         if not getattr(self, 'no_price', None) == 'True':
-            yield self._make_price_request(response, code)
+            yield self._make_price_request(code, is_fii)
         if not getattr(self, 'no_earnings', None) == 'True':
-            yield self._make_earnings_request(response, code)
+            yield self._make_earnings_request(code, is_fii)
 
-    def _make_earnings_request(self, response, code):
+    def _make_earnings_request(self, code, is_fii):
         # FIIs have a different endpoint from other assets
-        if 'b3/fii/' in response.url:
+        if is_fii:
             url = self.fii_earnings_api.format(asset_code=code)
             return Request(
-                url, callback=self.parse_fii_earnings, cb_kwargs={'code': code}
+                url, callback=self.parse_fii_earnings, cb_kwargs={'code': code},
+                errback=self.errback, meta={'endpoint': 'fii_earnings_api'},
             )
 
         return FormRequest(
             url=self.earnings_api,
             callback=self.parse_earnings_data,
             cb_kwargs={'code': code},
+            errback=self.errback,
+            meta={'endpoint': 'earnings_api'},
             formdata={
                 'symbol': code,
                 'type': 'null',
@@ -137,11 +354,14 @@ class InfomoneySpider(Spider):
             },
         )
 
-    def _make_price_request(self, response, code):
+    def _make_price_request(self, code, is_fii):
+        last_date = self._get_last_stored_date(code)
         # FIIs have a different endpoint from other assets
-        if 'b3/fii/' in response.url:
+        if is_fii:
             url = self.fii_price_api.format(asset_code=code)
-            start_date, end_date = self._get_date_attributes(st_offset=365 * 5)
+            start_date, end_date = self._get_date_attributes(
+                st_offset=365 * 5, initial_date=last_date
+            )
             url = add_or_replace_parameter(
                 url, 'DataInicio', start_date.replace('/', '-')
             )
@@ -149,17 +369,24 @@ class InfomoneySpider(Spider):
                 url, 'DataFim', end_date.replace('/', '-')
             )
             return Request(
-                url, callback=self.parse_fii_prices, cb_kwargs={'code': code}
+                url, callback=self.parse_fii_prices, cb_kwargs={'code': code},
+                errback=self.errback, meta={'endpoint': 'fii_price_api'},
             )
 
         start_date, end_date = '', ''
         if getattr(self, 'start_date', None) or getattr(self, 'end_date', None):  # noqa E501
             start_date, end_date = self._get_date_attributes()
+        elif last_date:
+            start_date, end_date = self._get_date_attributes(
+                initial_date=last_date
+            )
 
         return FormRequest(
             url=self.price_api,
             callback=self.parse_prices_data,
             cb_kwargs={'code': code},
+            errback=self.errback,
+            meta={'endpoint': 'price_api'},
             formdata={
                 'page': '0',
                 'numberItems': str(self.results_per_page),
@@ -173,63 +400,80 @@ class InfomoneySpider(Spider):
         """Parse JSON with FII earnings data into Item."""
         data = self._is_data_valid(response, code, 'earnings')
         if not data:
-            return get_retry_request(
-                response.request, spider=self, reason='Invalid response'
-            )
+            yield from self._retry(response)
+            return
 
-        data = response.json()
-        for row in data:
-            loader = AssetEarningsLoader(item=AssetEarningsItem())
-            loader.add_value('asset_code', code)
-            loader.add_value('type', 'Rendimento')
-            loader.add_value('value', row['rendimento'])
-            loader.add_value('pct_factor', row['yield'])
-            loader.add_value('date_of_payment', row['data'])
-            item = loader.load_item()
-            yield item
+        yield from decode_fii_earnings(data, code)
 
         self.logger.info('Parsed %s earning records for %s', len(data), code)
 
     def parse_fii_prices(self, response, code):
         """Parse JSON with FII historical price data into Item."""
+        if response.body and self.json_decoder.should_stream(response.body):
+            yield from self._parse_fii_prices_stream(response, code)
+            return
+
         data = self._is_data_valid(response, code, 'prices', 'dataValor')
         if not data:
-            return get_retry_request(
-                response.request, spider=self, reason='Invalid response'
-            )
+            yield from self._retry(response)
+            return
 
-        for row in data['dataValor']:
-            loader = AssetPriceLoader(item=AssetPriceItem())
-            loader.add_value('asset_code', code)
-            loader.add_value('date', row.get('data'))
-            loader.add_value('close', row['valor'])
-            item = loader.load_item()
-            yield item
+        yield from decode_fii_prices(data['dataValor'], code)
 
         self.logger.info(
             'Parsed %s price records for %s', len(data['dataValor']), code
         )
 
+    def _parse_fii_prices_stream(self, response, code):
+        """Parse the FII price history as a stream, items are yielded while
+        the `dataValor` array is parsed.
+        """
+        rows = self.json_decoder.iter_array(response.body, 'dataValor')
+        count = 0
+        try:
+            for item in decode_fii_prices(rows, code):
+                count += 1
+                yield item
+        except ValueError:
+            self.logger.exception(
+                'Response for %s prices couldn\'t be parsed after %s '
+                'records.', code, count
+            )
+            self._send_validation(response, 'unparseable')
+            yield from self._retry(response)
+            return
+
+        if not count:
+            is_empty, found_key = self.json_decoder.find_key(
+                response.body, 'dataValor'
+            )
+        if not count and not found_key:
+            # Same outcomes of _is_data_valid, without decoding the values.
+            if is_empty:
+                self.logger.warning(
+                    'Response for %s prices returned a malformed JSON.', code
+                )
+                self._send_validation(response, 'malformed')
+            else:
+                self.logger.warning(
+                    "Expected key dataValor for %s prices isn't included in "
+                    "the response", code
+                )
+                self._send_validation(response, 'missing_key')
+            yield from self._retry(response)
+            return
+
+        self._send_validation(response, 'valid')
+        self.logger.info('Parsed %s price records for %s', count, code)
+
     def parse_earnings_data(self, response, code):
         """Parse JSON with earnings data into Item."""
         data = self._is_data_valid(response, code, 'earnings', 'aaData')
         if not data:
-            return get_retry_request(
-                response.request, spider=self, reason='Invalid response'
-            )
+            yield from self._retry(response)
+            return
 
-        for row in data.get('aaData')[::-1]:
-            loader = AssetEarningsLoader(item=AssetEarningsItem())
-            loader.add_value('asset_code', code)
-            loader.add_value('type', row[0])
-            loader.add_value('value', row[1])
-            loader.add_value('pct_factor', row[2])
-            loader.add_value('emission_value', row[3])
-            loader.add_value('date_of_approval', row[4])
-            loader.add_value('date_of_record', row[5])
-            loader.add_value('date_of_payment', row[6])
-            item = loader.load_item()
-            yield item
+        yield from decode_earnings(data.get('aaData')[::-1], code)
 
         self.logger.info(
             'Parsed %s earnings records for %s', len(data.get('aaData')), code
@@ -239,23 +483,10 @@ class InfomoneySpider(Spider):
         """Parse JSON with historical price data into Item."""
         data = self._is_data_valid(response, code, 'prices')
         if not data:
-            return get_retry_request(
-                response.request, spider=self, reason='Invalid response'
-            )
+            yield from self._retry(response)
+            return
 
-        for row in data[::-1]:
-            loader = AssetPriceLoader(item=AssetPriceItem())
-            loader.add_value('asset_code', code)
-            loader.add_value('date', row[0].get('display'))
-            loader.add_value('timestamp', row[0].get('timestamp'))
-            loader.add_value('open', row[1])
-            loader.add_value('high', row[5])
-            loader.add_value('low', row[4])
-            loader.add_value('close', row[2])
-            loader.add_value('volume', row[6])
-            loader.add_value('variation', row[3])
-            item = loader.load_item()
-            yield item
+        yield from decode_prices(data[::-1], code)
 
         self.logger.info('Parsed %s price records for %s', len(data), code)
 
@@ -275,20 +506,23 @@ class InfomoneySpider(Spider):
             self.logger.warning(
                 'Response for %s %s returned empty.', code, _type
             )
+            self._send_validation(response, 'empty')
             return
 
         try:
-            data = response.json()
-        except json.decoder.JSONDecodeError:
+            data = self.json_decoder.decode(response.body)
+        except ValueError:
             self.logger.exception(
                 'Response for %s %s couldn\'t be parsed.', code, _type
             )
+            self._send_validation(response, 'unparseable')
             return
 
         if not data or isinstance(data, bool):
             self.logger.warning(
                 'Response for %s %s returned a malformed JSON.', code, _type
             )
+            self._send_validation(response, 'malformed')
             return
 
         for key in args:
@@ -297,22 +531,116 @@ class InfomoneySpider(Spider):
                     "Expected key %s for %s %s isn't included in the response",
                     key, code, _type
                 )
+                self._send_validation(response, 'missing_key')
                 return
 
+        self._send_validation(response, 'valid')
         return data
 
-    def _get_date_attributes(self, st_offset=730):
+    def _send_validation(self, response, outcome):
+        self.crawler.signals.send_catch_log(
+            signal=response_validated,
+            response=response,
+            spider=self,
+            outcome=outcome,
+        )
+
+    def _retry(self, response):
+        """Yields a copy of the request to be retried, unless the max number
+        of retries was reached.
+        """
+        retry_request = get_retry_request(
+            response.request, spider=self, reason='Invalid response'
+        )
+        if retry_request:
+            if 'cached' in response.flags:
+                # Skip the invalid response stored in the HTTP cache.
+                retry_request.meta['httpcache_refresh'] = True
+            yield retry_request
+        else:
+            self._asset_failed(
+                response.request.cb_kwargs.get('code'), 'Invalid response'
+            )
+
+    def _get_date_attributes(self, st_offset=730, initial_date=None):
         """Return date values according to received args or standard values.
         :param st_offset: Number of days to offset the initial date. Default to
         730 (2 years).
         :type st_offset: int
+        :param initial_date: Used instead of the offset when no start_date arg
+        is received.
+        :type initial_date: datetime
         """
         start_arg = getattr(self, 'start_date', None)
         end_arg = getattr(self, 'end_date', None)
 
-        initial_date = (
-            start_arg or
-            (datetime.today() - timedelta(days=st_offset)).strftime('%d/%m/%Y')
+        initial_date = initial_date or (
+            datetime.today() - timedelta(days=st_offset)
         )
+        initial_date = start_arg or initial_date.strftime('%d/%m/%Y')
         final_date = end_arg or datetime.today().strftime('%d/%m/%Y')
         return initial_date, final_date
+
+    def _get_last_stored_date(self, code):
+        """Return the date of the most recent price record already stored for
+        the asset, only when executed with the incremental arg. If the asset is
+        missing from any of the enabled storages returns None.
+        :param code: Asset code.
+        :type code: str
+        """
+        if not getattr(self, 'incremental', None) == 'True':
+            return
+
+        if code not in self.last_stored_dates:
+            dates = []
+            if (self.settings.get('DATABASE_URI') and
+                    self._is_pipeline_enabled('StoreInDatabasePipeline')):
+                dates.append(self._get_db_last_dates().get(code))
+            if (self.settings.get('FILES_STORAGE_PATH') and
+                    self._is_pipeline_enabled('SplitInCSVsPipeline')):
+                dates.append(self._get_csv_last_date(code))
+            # The request starts on the last stored date (instead of the day
+            # after) so it never asks for an empty period.
+            self.last_stored_dates[code] = (
+                min(dates) if dates and all(dates) else None
+            )
+        return self.last_stored_dates[code]
+
+    def _get_db_last_dates(self):
+        """Query the last price date of every asset stored in the database."""
+        if self.db_last_dates is None:
+            from sqlalchemy import func
+            from infomoney.models import Session, AssetPriceModel
+
+            query = Session().query(
+                AssetPriceModel.asset_code, func.max(AssetPriceModel.date)
+            ).group_by(AssetPriceModel.asset_code)
+            assets = getattr(self, 'assets', None)
+            if assets:
+                query = query.filter(
+                    AssetPriceModel.asset_code.in_(assets.split(','))
+                )
+            self.db_last_dates = dict(query.all())
+            Session.remove()
+            self.logger.info(
+                'Incremental mode: found stored prices for %s assets in the '
+                'database.', len(self.db_last_dates)
+            )
+        return self.db_last_dates
+
+    def _get_csv_last_date(self, code):
+        """Read the last price date exported to the asset CSV file."""
+        filename = os.path.join(
+            self.settings.get('FILES_STORAGE_PATH'), f'{code}.csv'
+        )
+        header, last_row = read_csv_edges(filename)
+        if not last_row or 'date' not in header:
+            return
+        return datetime.fromisoformat(last_row[header.index('date')])
+
+    def _is_pipeline_enabled(self, name):
+        pipelines = self.settings.getdict('ITEM_PIPELINES')
+        return any(
+            path.endswith(name) and order is not None
+            for path, order in pipelines.items()
+        )
@@ -0,0 +1,88 @@
+import csv
+import os
+from urllib.parse import urlsplit
+
+
+def read_csv_edges(filename, block_size=4096):
+    """Read the header and the last row of a CSV file without loading the
+    whole file, reading blocks backwards from its end.
+    :param filename: Path to the CSV file.
+    :type filename: str
+    :param block_size: Number of bytes read at a time from the end of file.
+    :type block_size: int
+    :returns: Tuple with the header and the last row, (None, None) if the
+    file doesn't exist or is empty, (header, None) if it only has a header.
+    """
+    if not os.path.exists(filename):
+        return None, None
+
+    with open(filename, 'rb') as file:
+        header_line = file.readline()
+        if not header_line.strip():
+            return None, None
+        header_end = file.tell()
+
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        tail = b''
+        # Needs at least one line break before the last line to be complete.
+        while position > header_end and tail.rstrip().count(b'\n') < 1:
+            step = min(block_size, position - header_end)
+            position -= step
+            file.seek(position)
+            tail = file.read(step) + tail
+
+    header = next(csv.reader([header_line.decode('utf-8')]))
+    lines = tail.rstrip(b'\r\n').splitlines()
+    if not lines or not lines[-1].strip():
+        return header, None
+    return header, next(csv.reader([lines[-1].decode('utf-8')]))
+
+
+def parse_volume(value):
+    """Convert the traded volume to an integer, the source may send it as a
+    number or as a string with thousands separators.
+    :returns: The volume or None if it isn't a valid number.
+    """
+    if value is None or isinstance(value, bool):
+        return
+    if isinstance(value, (int, float)):
+        return int(value)
+    # Same format of the prices, "." as thousands and "," decimal separator.
+    value = value.strip().replace('.', '').split(',')[0]
+    return int(value) if value.isdigit() else None
+
+
+def override_host(url, overrides):
+    """Replace the scheme and host of the URL by the base URL configured for
+    its host.
+    :param url: URL, or URL template, to be replaced.
+    :type url: str
+    :param overrides: Base URL (e.g. `http://127.0.0.1:8080`) by host name.
+    :type overrides: dict
+    :returns: The URL with the new base, unchanged if its host isn't in
+    `overrides`.
+    """
+    parts = urlsplit(url)
+    base = overrides.get(parts.hostname)
+    if not base:
+        return url
+    return base.rstrip('/') + url[len(f'{parts.scheme}://{parts.netloc}'):]
+
+
+def wrap_process_item(itemproc, wrap):
+    """Replace the process_item of each enabled pipeline.
+    :param itemproc: Item pipeline manager of the running crawler
+    (`crawler.engine.scraper.itemproc`).
+    :param wrap: Called with each pipeline and its process_item, returns the
+    function used instead.
+    :type wrap: function
+    """
+    # One method for each pipeline with process_item, in the same order.
+    pipelines = [
+        pipeline for pipeline in itemproc.middlewares
+        if hasattr(pipeline, 'process_item')
+    ]
+    methods = itemproc.methods['process_item']
+    for i, (pipeline, method) in enumerate(zip(pipelines, methods)):
+        methods[i] = wrap(pipeline, method)
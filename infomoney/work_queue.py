@@ -0,0 +1,257 @@
+"""Shared queue of assets used by the spider in distributed mode.
+
+Workers claim batches of assets, each claim is a lease that expires if it
+isn't renewed by heartbeats, so the assets of a worker that crashed return to
+the queue. The backend is set by `WORK_QUEUE_BACKEND`, any class implementing
+`BaseWorkQueue` can be used.
+"""
+import os
+import sqlite3
+import time
+
+from scrapy.utils.misc import load_object
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def get_work_queue(settings):
+    """Instantiate the backend set in `WORK_QUEUE_BACKEND`."""
+    return load_object(settings.get('WORK_QUEUE_BACKEND')).from_settings(
+        settings
+    )
+
+
+class BaseWorkQueue:
+    """Interface of the work queue backends."""
+
+    def __init__(self, lease=300, max_attempts=3):
+        """
+        :param lease: Seconds an asset stays claimed without a heartbeat.
+        :type lease: int
+        :param max_attempts: Times an asset is claimed before it's considered
+        failed.
+        :type max_attempts: int
+        """
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def try_seed(self, worker_id):
+        """Elect the worker that pushes the assets to the queue.
+        :returns: True for the first worker calling it.
+        """
+        raise NotImplementedError
+
+    def set_seeded(self):
+        """Mark that all the assets were pushed to the queue."""
+        raise NotImplementedError
+
+    def reset_if_finished(self):
+        """Empty the queue of a finished run, seeded and with every asset
+        done or failed, so the next run starts over.
+        :returns: True if the queue was reset.
+        """
+        raise NotImplementedError
+
+    def is_seeded(self):
+        raise NotImplementedError
+
+    def push(self, codes):
+        """Add the assets to the queue, existing ones are ignored."""
+        raise NotImplementedError
+
+    def claim(self, worker_id, count):
+        """Claim up to `count` pending assets, or assets whose lease expired.
+        Expired assets already claimed `max_attempts` times are marked as
+        failed instead, their worker probably crashed on them.
+        :returns: List of asset codes.
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, worker_id):
+        """Renew the lease of all the assets claimed by the worker."""
+        raise NotImplementedError
+
+    def complete(self, worker_id, codes):
+        raise NotImplementedError
+
+    def fail(self, worker_id, code, reason):
+        """Return the asset to the queue, or mark it as failed after
+        `max_attempts` claims.
+        """
+        raise NotImplementedError
+
+    def counts(self):
+        """:returns: Dict with the number of assets in each state."""
+        raise NotImplementedError
+
+
+class SQLiteWorkQueue(BaseWorkQueue):
+    """Work queue stored in a SQLite file, shared by the workers running in
+    the same machine (or with access to the same file).
+    """
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.connection = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.get('WORK_QUEUE_PATH'),
+            lease=settings.getint('WORK_QUEUE_LEASE'),
+            max_attempts=settings.getint('WORK_QUEUE_MAX_ATTEMPTS'),
+        )
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Autocommit, transactions are started explicitly where needed.
+        self.connection = sqlite3.connect(
+            self.path, timeout=30, isolation_level=None
+        )
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS assets (
+                code TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS ix_assets_status
+                ON assets (status, lease_until);
+            CREATE TABLE IF NOT EXISTS queue_info (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def try_seed(self, worker_id):
+        cursor = self.connection.execute(
+            'INSERT OR IGNORE INTO queue_info VALUES (?, ?)',
+            ('seeder', worker_id)
+        )
+        return cursor.rowcount == 1
+
+    def set_seeded(self):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO queue_info VALUES (?, ?)',
+            ('seeded', str(time.time()))
+        )
+
+    def is_seeded(self):
+        row = self.connection.execute(
+            'SELECT 1 FROM queue_info WHERE key = ?', ('seeded',)
+        ).fetchone()
+        return row is not None
+
+    def reset_if_finished(self):
+        with self._transaction():
+            if not self.is_seeded():
+                return False
+            unfinished = self.connection.execute(
+                'SELECT 1 FROM assets WHERE status IN (?, ?) LIMIT 1',
+                (PENDING, IN_FLIGHT)
+            ).fetchone()
+            if unfinished:
+                return False
+            self.connection.execute('DELETE FROM assets')
+            self.connection.execute('DELETE FROM queue_info')
+        return True
+
+    def push(self, codes):
+        now = time.time()
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO assets (code, status, updated_at) '
+            'VALUES (?, ?, ?)',
+            [(code, PENDING, now) for code in codes]
+        )
+
+    def claim(self, worker_id, count):
+        now = time.time()
+        with self._transaction():
+            self.connection.execute(
+                'UPDATE assets SET status = ?, lease_until = NULL, error = ?, '
+                'updated_at = ? WHERE status = ? AND lease_until < ? AND '
+                'attempts >= ?',
+                (FAILED, 'Lease expired', now, IN_FLIGHT, now,
+                 self.max_attempts)
+            )
+            codes = [row[0] for row in self.connection.execute(
+                'SELECT code FROM assets WHERE status = ? OR '
+                '(status = ? AND lease_until < ? AND attempts < ?) '
+                'ORDER BY updated_at LIMIT ?',
+                (PENDING, IN_FLIGHT, now, self.max_attempts, count)
+            )]
+            self.connection.executemany(
+                'UPDATE assets SET status = ?, worker = ?, lease_until = ?, '
+                'attempts = attempts + 1, updated_at = ? WHERE code = ?',
+                [(IN_FLIGHT, worker_id, now + self.lease, now, code)
+                 for code in codes]
+            )
+        return codes
+
+    def heartbeat(self, worker_id):
+        now = time.time()
+        self.connection.execute(
+            'UPDATE assets SET lease_until = ? WHERE status = ? AND worker = ?',
+            (now + self.lease, IN_FLIGHT, worker_id)
+        )
+
+    def complete(self, worker_id, codes):
+        now = time.time()
+        # Assets reassigned after the lease expired belong to the new worker.
+        self.connection.executemany(
+            'UPDATE assets SET status = ?, lease_until = NULL, updated_at = ? '
+            'WHERE code = ? AND worker = ? AND status = ?',
+            [(DONE, now, code, worker_id, IN_FLIGHT) for code in codes]
+        )
+
+    def fail(self, worker_id, code, reason):
+        self.connection.execute(
+            'UPDATE assets SET status = CASE WHEN attempts >= ? THEN ? '
+            'ELSE ? END, lease_until = NULL, error = ?, updated_at = ? '
+            'WHERE code = ? AND worker = ? AND status = ?',
+            (self.max_attempts, FAILED, PENDING, reason, time.time(), code,
+             worker_id, IN_FLIGHT)
+        )
+
+    def counts(self):
+        counts = dict.fromkeys((PENDING, IN_FLIGHT, DONE, FAILED), 0)
+        counts.update(self.connection.execute(
+            'SELECT status, COUNT(*) FROM assets GROUP BY status'
+        ))
+        return counts
+
+    def _transaction(self):
+        return _Transaction(self.connection)
+
+
+class _Transaction:
+    """Write transaction, locks the database so two workers can't claim the
+    same assets.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')